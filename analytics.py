@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  analytics.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Download rollups by mirror, country and file
+
+compact() in eventlog.py feeds every download to a Rollups, which keeps
+the heaviest (mirror, country, file) combinations for each day, and for
+each hour of it, in `ROLLUP_DIR/<YYYY-MM-DD>.json`. Each is a Space-Saving
+summary: at most `analytics_top_k` combinations a day and
+`analytics_hour_top_k` an hour are tracked, so memory and disk use stay
+bounded however many different files are asked for. There are separate
+summaries for mirrors, countries and files alone. Whatever isn't tracked
+still counts towards the totals, as "other".
+
+Counts of tracked combinations are overestimates by at most their error.
+Like the daily totals, every day file records the segments it has seen,
+so a segment is never counted twice, even after a crash.
+"""
+import datetime
+import hashlib
+import heapq
+import json
+import os
+import threading
+import common
+
+ROLLUP_DIR = "rollups"
+DIMENSIONS = {"mirrors": (0,), "countries": (1,), "files": (2,), "all": (0, 1, 2)}
+NAMES = ("mirror", "country", "file")
+# furthest apart start and end can be, in days. Every day in the range is
+# read and merged, so this bounds how long a query can take
+MAX_RANGE = 31
+# most merged ranges kept, oldest asked for dropped first
+MAX_CACHED = 16
+# (start, end, hour, directory): (etag, last modified, {dimension: merge()})
+CACHE = {}
+LOCK = threading.Lock()
+
+
+class TopK:
+    """Space-Saving summary of the keys with the most downloads
+
+    At most `size` keys are tracked. A new key takes the place of the one
+    with the fewest downloads and inherits its counts, which are kept as
+    the new key's error.
+    """
+    def __init__(self, size, data=None):
+        self.size = size
+        # key: [downloads, bytes, downloads error, bytes error]
+        self.entries = {}
+        # downloads and bytes of everything, tracked or not
+        self.total = [0, 0]
+        if data is not None:
+            self.total = data["total"]
+            for each in data["entries"]:
+                self.entries[tuple(each[:-4])] = each[-4:]
+        # (downloads, key), with stale records skipped when popped
+        self.heap = [(value[0], key) for key, value in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, key, downloads, size):
+        """Count `downloads` and `size` bytes for a key"""
+        self.total[0] += downloads
+        self.total[1] += size
+        entry = self.entries.get(key)
+        if entry is None:
+            if not downloads:
+                # the size of a download we no longer track. Only the total has room for it
+                return
+            if len(self.entries) < self.size:
+                entry = self.entries[key] = [0, 0, 0, 0]
+            else:
+                lightest = self.entries.pop(self.__lightest__())
+                entry = self.entries[key] = [lightest[0], lightest[1], lightest[0], lightest[1]]
+        entry[0] += downloads
+        entry[1] += size
+        if downloads:
+            heapq.heappush(self.heap, (entry[0], key))
+            if len(self.heap) > self.size * 4 + 64:
+                self.heap = [(value[0], key) for key, value in self.entries.items()]
+                heapq.heapify(self.heap)
+
+    def __lightest__(self):
+        """Key with the fewest downloads"""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == count:
+                return key
+
+    def to_json(self):
+        """Plain lists and numbers, for json.dump()"""
+        return {"size": self.size, "total": self.total,
+                "entries": [list(key) + value for key, value in self.entries.items()]}
+
+
+class Rollups:
+    """Day and hour summaries being added to by one compaction"""
+    def __init__(self, directory=ROLLUP_DIR):
+        self.directory = directory
+        self.size = common.get_setting("analytics_top_k", 1000)
+        self.hour_size = common.get_setting("analytics_hour_top_k", 100)
+        # day: {"applied": set, "day": summaries, "hours": [summaries or None]}
+        self.days = {}
+        # day: segments added to it this time
+        self.added = {}
+
+    def __summaries__(self, size, data=None):
+        """A summary for each dimension"""
+        data = data or {}
+        return {name: TopK(size, data.get(name)) for name in DIMENSIONS}
+
+    def __load__(self, day):
+        """Get a day's summaries, reading them from disk the first time"""
+        try:
+            with open(os.path.join(self.directory, f"{ day }.json"), "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = {"applied": [], "day": None, "hours": [None] * 24}
+        table = {"applied": set(data["applied"]),
+                 "day": self.__summaries__(self.size, data["day"]),
+                 "hours": [self.__summaries__(self.hour_size, each) if each is not None else None
+                           for each in data["hours"]]}
+        self.days[day] = table
+        self.added[day] = set()
+        return table
+
+    def add(self, segment, day, hour, key, downloads, size):
+        """Count (mirror, country, file) `key` from `segment`, logged during `hour` of `day`"""
+        table = self.days.get(day)
+        if table is None:
+            table = self.__load__(day)
+        if segment in table["applied"]:
+            return
+        self.added[day].add(segment)
+        if table["hours"][hour] is None:
+            table["hours"][hour] = self.__summaries__(self.hour_size)
+        for summaries in (table["day"], table["hours"][hour]):
+            for name, fields in DIMENSIONS.items():
+                summaries[name].add(key if len(fields) == 3 else (key[fields[0]],),
+                                    downloads, size)
+
+    def save(self, sealed, keep_days):
+        """Write every day added to, and delete days older than `keep_days`
+
+        Segments only need remembering while they are still in `sealed`.
+        """
+        if not os.path.exists(self.directory):
+            os.mkdir(self.directory)
+        sealed = set(sealed)
+        for day, table in self.days.items():
+            if not self.added[day]:
+                continue
+            data = {"applied": sorted((table["applied"] | self.added[day]) & sealed),
+                    "day": {name: each.to_json() for name, each in table["day"].items()},
+                    "hours": [{name: summary.to_json() for name, summary in each.items()}
+                              if each is not None else None for each in table["hours"]]}
+            path = os.path.join(self.directory, f"{ day }.json")
+            tmp = f"{ path }.{ os.getpid() }.tmp"
+            with open(tmp, "w") as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, path)
+        cutoff = (datetime.date.today() - datetime.timedelta(days=keep_days)).isoformat()
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") and name[:-5] < cutoff:
+                os.remove(os.path.join(self.directory, name))
+
+
+def merge(summaries):
+    """Add summaries together. Returns ({key: [downloads, bytes, errors]}, total)
+
+    A key missing from a full summary may have had as many downloads as
+    that summary's lightest key, so that goes on its error. Every key gets
+    the lightest of all of them, less those of the summaries it is in.
+    """
+    merged = {}
+    total = [0, 0]
+    missing = 0
+    for each in summaries:
+        total[0] += each.total[0]
+        total[1] += each.total[1]
+        lightest = 0
+        if each.entries and len(each.entries) >= each.size:
+            lightest = min(value[0] for value in each.entries.values())
+            missing += lightest
+        for key, value in each.entries.items():
+            entry = merged.setdefault(key, [0, 0, 0])
+            entry[0] += value[0]
+            entry[1] += value[1]
+            entry[2] += value[2] - lightest
+    for entry in merged.values():
+        entry[2] += missing
+    return merged, total
+
+
+def stamp(start, end, directory=ROLLUP_DIR):
+    """ETag and Last-Modified time for the day files from `start` to `end`"""
+    digest = hashlib.blake2b(digest_size=8)
+    modified = 0
+    day = start
+    while day <= end:
+        try:
+            stat = os.stat(os.path.join(directory, f"{ day.isoformat() }.json"))
+            digest.update(f"{ day } { stat.st_ino } { stat.st_size } { stat.st_mtime_ns }\n".encode())
+            modified = max(modified, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        day += datetime.timedelta(days=1)
+    return digest.hexdigest(), modified / 1000000000
+
+
+def summaries(start, end, hour=None, directory=ROLLUP_DIR):
+    """Get (etag, last modified, {dimension: merge()}) from `start` to `end`
+
+    Every dimension is merged at once, and kept until a day file in the
+    range changes, so queries differing only in what they pick out of it
+    don't read the day files again.
+    """
+    etag, modified = stamp(start, end, directory)
+    args = (start, end, hour, directory)
+    with LOCK:
+        cached = CACHE.get(args)
+    if cached is not None and cached[0] == etag:
+        return cached
+    merging = {name: [] for name in DIMENSIONS}
+    day = start
+    while day <= end:
+        try:
+            with open(os.path.join(directory, f"{ day.isoformat() }.json"), "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = None
+        if data is not None:
+            data = data["day"] if hour is None else data["hours"][hour]
+        if data is not None:
+            for name, each in merging.items():
+                each.append(TopK(data[name]["size"], data[name]))
+        day += datetime.timedelta(days=1)
+    cached = (etag, modified, {name: merge(each) for name, each in merging.items()})
+    with LOCK:
+        CACHE.pop(args, None)
+        while len(CACHE) >= MAX_CACHED:
+            del CACHE[next(iter(CACHE))]
+        CACHE[args] = cached
+    return cached
+
+
+def top(start, end, dimension="all", hour=None, limit=20, match=None, directory=ROLLUP_DIR):
+    """Get (etag, last modified, query())"""
+    etag, modified, merged = summaries(start, end, hour, directory)
+    return etag, modified, __pick__(start, end, dimension, hour, limit, match, merged)
+
+
+def query(start, end, dimension="all", hour=None, limit=20, match=None, directory=ROLLUP_DIR):
+    """Top mirrors, countries, files or combinations of them from `start` to `end`
+
+    `start` and `end` are dates, `hour` picks one hour of every day, and
+    `match` is (mirror, country, file) with None for anything. Every count
+    is at most `error` more than the real one. With `match`, counts are
+    added up from the combinations, which only bounds them from below, and
+    "other" isn't known since untracked downloads aren't broken down.
+    """
+    return top(start, end, dimension, hour, limit, match, directory)[2]
+
+
+def __pick__(start, end, dimension, hour, limit, match, merged):
+    """query() from merged summaries. Those are shared, so are left as they are"""
+    merged, total = merged[dimension if match is None else "all"]
+    fields = DIMENSIONS[dimension]
+    if match is not None:
+        groups = {}
+        for key, value in merged.items():
+            if any(want is not None and want != key[index] for index, want in enumerate(match)):
+                continue
+            group = groups.setdefault(tuple(key[index] for index in fields), [0, 0, 0])
+            group[0] += value[0]
+            group[1] += value[1]
+            # whatever went untracked could have been any of them
+            group[2] = None
+        merged = groups
+        total = [sum(each[0] for each in groups.values()), sum(each[1] for each in groups.values())]
+    ranked = heapq.nsmallest(limit, merged.items(), key=lambda each: (-each[1][0], each[0]))
+    top = []
+    for key, value in ranked:
+        row = {NAMES[index]: key[place] for place, index in enumerate(fields)}
+        row.update({"downloads": value[0], "bytes": value[1], "error": value[2]})
+        top.append(row)
+    output = {"start": start.isoformat(), "end": end.isoformat(), "hour": hour,
+              "dimension": dimension, "total": {"downloads": total[0], "bytes": total[1]},
+              "top": top, "other": None}
+    if match is None:
+        output["other"] = {"downloads": max(0, total[0] - sum(row["downloads"] for row in top)),
+                           "bytes": max(0, total[1] - sum(row["bytes"] for row in top))}
+    return output
@@ -21,10 +21,53 @@
 #  MA 02110-1301, USA.
 #
 #
+"""Statistical data archives
+
+An archive holds a year's worth of long-term count lines, in one of two
+formats, picked with the `archive_format` setting:
+
+ - "tar.xz" (the default): the lines in a single-file .tar.xz
+ - "xz", "bz2" or "gz": each month's lines compressed on their own, one
+   block after another, with an offset table at the end, so one month can
+   be read without decompressing the rest. See `write_blocks()`.
+
+An index next to them records, per archive, its first and last day, its row
+count, per-month totals, and where each month starts and ends, so most
+questions are answered without opening an archive at all. Archives that do
+have to be read are kept decompressed in a small per-process LRU cache.
+"""
+import bz2
+import calendar
+import collections
+import gzip
+import io
+import json
+import lzma
+import struct
 import tarfile as tar
 import os
+import zlib
 import common
 
+ARCHIVE_DIR = "archives"
+INDEX_FILE = os.path.join(ARCHIVE_DIR, "index.json")
+MONTHS = {name: number for number, name in enumerate(calendar.month_name) if name}
+# codec name: (module, file extension), for block archives
+CODECS = {"xz": (lzma, ".blk.xz"), "bz2": (bz2, ".blk.bz2"), "gz": (gzip, ".blk.gz")}
+SUFFIXES = (".tar.xz",) + tuple(each[1] for each in CODECS.values())
+BLOCK_MAGIC = b"DLSTATS1"
+# offset of the table, then the magic again
+TRAILER = struct.Struct("<Q8s")
+# name or (name, month): (mtime, decompressed text), least recently used first
+CACHE = collections.OrderedDict()
+# what reading a truncated or corrupt archive can raise
+ERRORS = (tar.TarError, lzma.LZMAError, zlib.error, EOFError, OSError, ValueError,
+          struct.error, KeyError, IndexError)
+# name: mtime of archives that couldn't be read, so they aren't tried again until they change
+BROKEN = {}
+INDEX = {"mtime": None, "data": {"archives": {}}}
+
+
 def create_archive():
     """Create an archive of statistical data"""
     with open(common.LONG_TERM_COUNT_FILE, "r") as file:
@@ -35,10 +78,8 @@ def create_archive():
     back_up = data[:366]
     keep = data[366:]
     keep = "\n".join(keep)
-    # with open(common.LONG_TERM_COUNT_FILE, "w") as file:
-    #    file.write(keep)
-    if not os.path.exists("archives"):
-        os.mkdir("archives")
+    if not os.path.exists(ARCHIVE_DIR):
+        os.mkdir(ARCHIVE_DIR)
     try:
         y_1 = back_up[0].split(" ")[2]
         y_2 = back_up[-1].split(" ")[2]
@@ -46,20 +87,239 @@ def create_archive():
         print("Incorrect Formatting for Archive. Trying again later...")
         return
     years = f"{ y_1 }-{ y_2 }"
-    with open(f"archives/{ years }.txt", "w+") as file:
-        file.write("\n".join(back_up))
-    with tar.open(f"archives/{ years }.tar.xz", "w:xz") as tarfile:
-        tarfile.add(f"archives/{ years }.txt")
-    os.remove(f"archives/{ years }.txt")
+    codec = common.get_setting("archive_format", "tar.xz")
+    if codec not in CODECS:
+        codec = "tar.xz"
+    index = load_index()
+    if codec == "tar.xz":
+        name = f"{ years }.tar.xz"
+        text = "\n".join(back_up)
+        # index it while we still have the text, so it never has to be decompressed for that
+        index["archives"][name] = index_text(text)
+        write_tar(f"{ ARCHIVE_DIR }/{ name }", f"{ years }.txt", text)
+    else:
+        name = years + CODECS[codec][1]
+        index["archives"][name] = write_blocks(f"{ ARCHIVE_DIR }/{ name }", back_up, codec)
+    save_index(index)
     with open(common.LONG_TERM_COUNT_FILE, "w") as file:
         file.write(keep)
 
 
+def write_tar(path, member, text):
+    """Atomically write `text` to a .tar.xz as the single file `member`"""
+    data = text.encode()
+    info = tar.TarInfo(f"archives/{ member }")
+    info.size = len(data)
+    info.mtime = int(os.path.getmtime(common.LONG_TERM_COUNT_FILE))
+    info.mode = 0o644
+    tmp = f"{ path }.{ os.getpid() }.tmp"
+    with open(tmp, "wb") as file:
+        with tar.open(fileobj=file, mode="w:xz") as tarfile:
+            tarfile.addfile(info, io.BytesIO(data))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+
+def write_blocks(path, lines, codec="xz"):
+    """Atomically write a block archive. Returns its index entry
+
+    The file is BLOCK_MAGIC, then every month's lines compressed on their
+    own, then a JSON table (the index entry, plus the codec), then TRAILER.
+    For block archives, the start and end in each month's index entry are
+    where its compressed block is in the file.
+    """
+    module = CODECS[codec][0]
+    entry = {"codec": codec, "first": None, "last": None, "rows": 0, "months": {}}
+    block = []
+    tmp = f"{ path }.{ os.getpid() }.tmp"
+    with open(tmp, "wb") as file:
+        file.write(BLOCK_MAGIC)
+
+        def flush():
+            if block:
+                data = module.compress(("\n".join(block[1]) + "\n").encode())
+                offset = file.tell()
+                file.write(data)
+                entry["months"][block[0]][2:] = [offset, offset + len(data)]
+                block.clear()
+
+        for line in lines:
+            if line == "":
+                continue
+            parsed = common.parse_line(line)
+            month, day, year = parsed[0]
+            key = f"{ year }-{ MONTHS[month]:02d}"
+            if not block or block[0] != key:
+                flush()
+                block.extend([key, []])
+            block[1].append(line)
+            date = f"{ key }-{ int(day):02d}"
+            if entry["first"] is None:
+                entry["first"] = date
+            entry["last"] = date
+            entry["rows"] += 1
+            totals = entry["months"].setdefault(key, [0, 0.0, 0, 0])
+            totals[0] += parsed[1]
+            totals[1] += parsed[2] if len(parsed) > 2 else 0.0
+        flush()
+        offset = file.tell()
+        file.write(json.dumps(entry).encode())
+        file.write(TRAILER.pack(offset, BLOCK_MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    return entry
+
+
+def read_table(path):
+    """Read the table at the end of a block archive"""
+    with open(path, "rb") as file:
+        file.seek(-TRAILER.size, os.SEEK_END)
+        end = file.tell()
+        offset, magic = TRAILER.unpack(file.read(TRAILER.size))
+        if magic != BLOCK_MAGIC:
+            raise ValueError(f"{ path } is not a block archive")
+        file.seek(offset)
+        return json.loads(file.read(end - offset))
+
+
+def index_text(text):
+    """Build the index entry for an archive's text"""
+    entry = {"first": None, "last": None, "rows": 0, "months": {}}
+    offset = 0
+    for line in text.split("\n"):
+        end = offset + len(line.encode()) + 1
+        if line != "":
+            parsed = common.parse_line(line)
+            month, day, year = parsed[0]
+            key = f"{ year }-{ MONTHS[month]:02d}"
+            date = f"{ key }-{ int(day):02d}"
+            if entry["first"] is None:
+                entry["first"] = date
+            entry["last"] = date
+            entry["rows"] += 1
+            # [downloads, GB, first byte, last byte]
+            totals = entry["months"].setdefault(key, [0, 0.0, offset, end])
+            totals[0] += parsed[1]
+            totals[1] += parsed[2] if len(parsed) > 2 else 0.0
+            totals[3] = end
+        offset = end
+    return entry
+
+
+def load_index():
+    """Get the archive index, indexing any archive it doesn't know about yet"""
+    try:
+        mtime = os.stat(INDEX_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime is not None and mtime != INDEX["mtime"]:
+        try:
+            with open(INDEX_FILE, "r") as file:
+                INDEX["data"] = json.load(file)
+        except ValueError:
+            print(f"{ INDEX_FILE } is corrupt. Rebuilding...")
+            INDEX["data"] = {"archives": {}}
+        INDEX["mtime"] = mtime
+    index = INDEX["data"]
+    try:
+        names = [each for each in os.listdir(ARCHIVE_DIR) if each.endswith(SUFFIXES)]
+    except FileNotFoundError:
+        names = []
+    missing = [each for each in names if each not in index["archives"] and not __broken__(each)]
+    indexed = False
+    for name in missing:
+        print(f"Indexing archive { name }...")
+        try:
+            if name.endswith(".tar.xz"):
+                index["archives"][name] = index_text(read_archive(name))
+            else:
+                index["archives"][name] = read_table(f"{ ARCHIVE_DIR }/{ name }")
+        except ERRORS as error:
+            # one bad archive shouldn't take the rest down with it
+            print(f"ERROR READING ARCHIVE { name }: { error }. Skipping it...")
+            __set_broken__(name)
+            continue
+        indexed = True
+    for name in [each for each in index["archives"] if each not in names]:
+        del index["archives"][name]
+    if indexed:
+        save_index(index)
+    return index
+
+
+def __broken__(name):
+    """Whether an archive couldn't be read last time, and hasn't changed since"""
+    if name not in BROKEN:
+        return False
+    try:
+        return os.stat(f"{ ARCHIVE_DIR }/{ name }").st_mtime_ns == BROKEN[name]
+    except FileNotFoundError:
+        return True
+
+
+def __set_broken__(name):
+    """Remember that an archive couldn't be read"""
+    try:
+        BROKEN[name] = os.stat(f"{ ARCHIVE_DIR }/{ name }").st_mtime_ns
+    except FileNotFoundError:
+        BROKEN[name] = None
+
+
+def save_index(index):
+    """Atomically replace the archive index"""
+    tmp = f"{ INDEX_FILE }.{ os.getpid() }.tmp"
+    with open(tmp, "w") as file:
+        json.dump(index, file)
+    os.replace(tmp, INDEX_FILE)
+    INDEX["data"] = index
+    INDEX["mtime"] = os.stat(INDEX_FILE).st_mtime_ns
+
+
+def query(beginning, end, days=False):
+    """Monthly totals, and optionally every day, from archives between two years
+
+    Months come straight from the index. Days need the archives themselves,
+    but only the lines for the months asked for are parsed.
+    """
+    output = {"months": {}}
+    if days:
+        output["days"] = []
+    index = load_index()
+    for name in sorted(index["archives"], key=lambda each: index["archives"][each]["first"] or ""):
+        entry = index["archives"][name]
+        if entry["first"] is None or int(entry["last"][:4]) < beginning or int(entry["first"][:4]) > end:
+            continue
+        months = {key: value for key, value in entry["months"].items()
+                  if beginning <= int(key[:4]) <= end}
+        for key, value in months.items():
+            totals = output["months"].setdefault(key, {"downloads": 0, "gb": 0.0})
+            totals["downloads"] += value[0]
+            totals["gb"] += value[1]
+        if days and months:
+            try:
+                if name.endswith(".tar.xz"):
+                    data = read_archive(name).encode()
+                    texts = [data[value[2]:value[3]].decode() for value in months.values()]
+                else:
+                    texts = [read_month(name, key) for key in months]
+            except ERRORS as error:
+                print(f"ERROR READING ARCHIVE { name }: { error }. Skipping its days...")
+                texts = []
+            for text in texts:
+                for line in text.split("\n"):
+                    if line != "":
+                        parsed = common.parse_line(line)
+                        output["days"].append({"date": " ".join(parsed[0]), "downloads": parsed[1],
+                                               "gb": parsed[2] if len(parsed) > 2 else 0.0})
+    return output
+
+
 def fetch_data(beginning, end):
     """Fetch data from beginning to end, where both are years"""
-    archives = os.listdir("archives")
     need = []
-    for each in archives:
+    for each in load_index()["archives"]:
         dates = __name_to_date_range__(each)
         if ((dates[0] >= beginning) and (dates[1] <= end)):
             need.append(each)
@@ -67,17 +327,20 @@ def fetch_data(beginning, end):
     need.sort()
     output = []
     for each in need:
-        data = common.parse_data(read_archive(each))
+        try:
+            data = common.parse_data(read_archive(each))
+        except ERRORS as error:
+            print(f"ERROR READING ARCHIVE { each }: { error }. Skipping it...")
+            continue
         output.append(data)
     return output
 
 
 def get_valid_year_range():
     """Get the range of years with statistical archives available to us"""
-    archives = os.listdir("archives")
     smallest = 0
     largest = 0
-    for each in archives:
+    for each in load_index()["archives"]:
         dates = __name_to_date_range__(each)
         if ((smallest <= 0) or (smallest > dates[0])):
             smallest = dates[0]
@@ -88,10 +351,69 @@ def get_valid_year_range():
 
 def __name_to_date_range__(name):
     """Convert an archive name to a date range"""
-    return [int(x) for x in name[:-7].split("-")]
+    return [int(x) for x in name.split(".")[0].split("-")]
 
 
 def read_archive(name):
-    """Read an archive, return data"""
-    with tar.open(f"archives/{name}", "r") as file:
-        return file.extractfile(file.getnames()[0]).read().decode()
+    """Read an archive, return data
+
+    The last few archives read are kept decompressed, per process.
+    """
+    if not name.endswith(".tar.xz"):
+        table = read_table(f"{ ARCHIVE_DIR }/{ name }")
+        return "".join(read_month(name, key) for key in table["months"])
+    mtime = os.stat(f"{ ARCHIVE_DIR }/{ name }").st_mtime_ns
+    cached = __cache_get__(name, mtime)
+    if cached is not None:
+        return cached
+    with tar.open(f"{ ARCHIVE_DIR }/{ name }", "r") as file:
+        data = file.extractfile(file.getnames()[0]).read().decode()
+    return __cache_set__(name, mtime, data)
+
+
+def read_month(name, month):
+    """Read one month's lines ("YYYY-MM") from an archive
+
+    Block archives only decompress that month's block. A .tar.xz is
+    decompressed whole, and the month cut out using the index.
+    """
+    path = f"{ ARCHIVE_DIR }/{ name }"
+    entry = load_index()["archives"].get(name)
+    if entry is None or month not in entry["months"]:
+        return ""
+    start, end = entry["months"][month][2:]
+    if name.endswith(".tar.xz"):
+        return read_archive(name).encode()[start:end].decode()
+    mtime = os.stat(path).st_mtime_ns
+    cached = __cache_get__((name, month), mtime)
+    if cached is not None:
+        return cached
+    with open(path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    data = CODECS[entry["codec"]][0].decompress(data).decode()
+    return __cache_set__((name, month), mtime, data)
+
+
+def __cache_get__(key, mtime):
+    """Get decompressed text from the cache, if it's still current"""
+    cached = CACHE.get(key)
+    if cached is not None and cached[0] == mtime:
+        CACHE.move_to_end(key)
+        return cached[1]
+    return None
+
+
+def __cache_set__(key, mtime, data):
+    """Cache decompressed text, evicting whatever was used longest ago"""
+    CACHE[key] = (mtime, data)
+    CACHE.move_to_end(key)
+    # a month block is about a twelfth of an archive
+    limit = common.get_setting("archive_cache_size", 4) * 12
+    size = 0
+    for each in CACHE:
+        size += 1 if isinstance(each, tuple) else 12
+    while size > limit and len(CACHE) > 1:
+        each = CACHE.popitem(last=False)[0]
+        size -= 1 if isinstance(each, tuple) else 12
+    return data
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  asgi.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""ASGI Loader
+
+Redirects are served natively on the event loop: ipinfo.io fallbacks and
+file size lookups go through one shared, pooled async HTTP client, so a
+slow upstream only holds up the requests that need it instead of a whole
+worker. Picking a mirror and counting the download touch SQLite and shared
+files, so they run in a thread. Every other route is handed to the Flask app.
+
+    uvicorn asgi:APP --uds download.sock
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import time
+import urllib.parse
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+import werkzeug.exceptions
+import werkzeug.urls
+import common
+import download
+import filemeta
+import geoip
+import metrics
+import mirrors
+import upstream
+
+WSGI_APP = WsgiToAsgi(download.create_app())
+ROUTES = download.APP.url_map.bind("localhost")
+ASYNC_ENDPOINTS = ("get_url", "get_url_blank")
+CLIENT = None
+# caps requests in flight to the pool's size. httpx gets slow with a long queue
+LIMIT = None
+# background size lookups, kept so they aren't garbage collected mid-flight
+TASKS = set()
+# path: callbacks waiting on the size lookup already running for it
+FETCHING = {}
+
+
+def get_client():
+    """Get the shared async HTTP client, creating it on first use"""
+    global CLIENT, LIMIT
+    if CLIENT is None:
+        timeout = common.get_setting("async_timeout", 2.0)
+        # httpx's pool gets slower per request the more connections it holds,
+        # so more isn't always better here
+        connections = common.get_setting("async_max_connections", 32)
+        CLIENT = httpx.AsyncClient(timeout=httpx.Timeout(timeout, connect=1.0),
+                                   limits=httpx.Limits(max_connections=connections,
+                                                       max_keepalive_connections=connections))
+        LIMIT = asyncio.Semaphore(connections)
+    return CLIENT
+
+
+async def request(method, url):
+    """Make a request with the shared client, behind the same circuit breakers as upstream.request()
+
+    Raises upstream.CircuitOpen, or any httpx HTTPError.
+    """
+    client = get_client()
+    host = urllib.parse.urlsplit(url).hostname
+    config = upstream.get_config(host)
+    circuit = upstream.get_breaker(host)
+    if not circuit.allow(config["cooldown"]):
+        metrics.count_upstream(host, rejected=1)
+        raise upstream.CircuitOpen(f"circuit open for { host }")
+    async with LIMIT:
+        try:
+            response = await client.request(method, url)
+        except httpx.HTTPError:
+            circuit.failure(config["failures"])
+            metrics.count_upstream(host, requests=1, errors=1)
+            raise
+    if response.status_code == 429:
+        circuit.failure(config["failures"], upstream.retry_after(response.headers.get("Retry-After"),
+                                                                 config["max_retry_after"]))
+    elif upstream.failed(response.status_code):
+        circuit.failure(config["failures"])
+    else:
+        circuit.success()
+    metrics.count_upstream(host, requests=1, errors=int(upstream.failed(response.status_code)))
+    return response
+
+
+def __locate_local__(key, ip_addr):
+    """Look an address up in the cache, then the local database. Returns (data, locator)"""
+    data = geoip.CACHE.get(key)
+    if data is not None:
+        return data, None
+    locator = geoip.get_locator()
+    return locator.locate(ip_addr, remote=False), locator
+
+
+async def locate(ip_addr):
+    """geoip.locate(), only waiting on ipinfo.io asynchronously
+
+    The cache and local database are read, and the cache written, in a
+    thread, so a locked SQLite file doesn't hold up the event loop.
+    """
+    key = geoip.cache_key(ip_addr)
+    data, locator = await asyncio.to_thread(__locate_local__, key, ip_addr)
+    if locator is not None:
+        if data is None:
+            data = {"bogon": True}
+            if locator.has_remote:
+                try:
+                    response = await request("GET", geoip.ipinfo_url(ip_addr))
+                    if response.status_code == 429:
+                        print("Rate limited by ipinfo.io. Backing off...")
+                        data = dict(geoip.UNAVAILABLE)
+                    else:
+                        data = response.json()
+                except upstream.CircuitOpen:
+                    data = dict(geoip.UNAVAILABLE)
+                except (httpx.HTTPError, ValueError):
+                    print("Could not reach ipinfo.io. No internet access?")
+        await asyncio.to_thread(geoip.store, key, data)
+    return data
+
+
+def __call_back__(callbacks, meta):
+    """Pass a file's metadata to every callback waiting on it. Run in a thread"""
+    for callback in callbacks:
+        callback(meta)
+
+
+async def fetch_size(server, path):
+    """HEAD a file on the event loop, cache its metadata and pass it to every callback waiting"""
+    start = time.perf_counter()
+    meta = None
+    try:
+        # the cache is SQLite, so not on the loop
+        cached = await asyncio.to_thread(filemeta.cached, path)
+        if cached is not None:
+            # another worker or the crawl got to it first, or found nothing there
+            meta = None if cached.get("missing") else cached
+        else:
+            response = await request("HEAD", server + urllib.parse.quote(path))
+            if 200 <= response.status_code < 300:
+                meta = await asyncio.to_thread(filemeta.store, path, response.headers)
+            else:
+                await asyncio.to_thread(filemeta.store_missing, path)
+    except (httpx.HTTPError, upstream.CircuitOpen) as error:
+        print(f"Could not get metadata for { server + path }: { error }")
+    finally:
+        metrics.observe("head", time.perf_counter() - start)
+        # only once it is cached, or another request would start a second HEAD
+        callbacks = FETCHING.pop(path, [])
+    if meta is not None:
+        # counting writes the event log
+        await asyncio.to_thread(__call_back__, callbacks, meta)
+
+
+def __fetch_soon__(server, path, callback):
+    """Start fetch_size() for `path`, unless it is already running. Run on the event loop"""
+    if path in FETCHING:
+        FETCHING[path].append(callback)
+        return
+    FETCHING[path] = [callback]
+    task = asyncio.get_running_loop().create_task(fetch_size(server, path))
+    TASKS.add(task)
+    task.add_done_callback(TASKS.discard)
+
+
+def fetch_size_later(loop, server, path, callback):
+    """Schedule fetch_size() on `loop` without waiting on it. Safe to call from any thread"""
+    loop.call_soon_threadsafe(__fetch_soon__, server, path, callback)
+
+
+def __choose__(loc, path, country, fetch):
+    """Pick a mirror and count the download. Run in a thread
+
+    Both can touch SQLite, shared files and the health table.
+    """
+    server = download.get_optimal_server(loc, path)
+    chosen = time.perf_counter()
+    download.count_download(server, path, country, fetch=fetch)
+    metrics.observe("count", time.perf_counter() - chosen)
+    return server
+
+
+async def get_url(scope, path):
+    """Async twin of download.get_url(). Returns the URL to redirect to"""
+    ip_addr = None
+    for name, value in scope["headers"]:
+        if name == b"host":
+            # same non-standard trick as download.get_url()
+            ip_addr = value.decode("latin-1")
+            break
+    if ip_addr is None and scope.get("client"):
+        ip_addr = scope["client"][0]
+    start = time.perf_counter()
+    data = await locate(ip_addr)
+    located = time.perf_counter()
+    loc = download.parse_location(data, ip_addr)
+    fetch = functools.partial(fetch_size_later, asyncio.get_running_loop())
+    server = await asyncio.to_thread(__choose__, loc, path, data.get("country"), fetch)
+    metrics.observe("geo", located - start)
+    metrics.observe("total", time.perf_counter() - start)
+    return server + path
+
+
+def __warm__():
+    """Open everything a redirect needs up front, rather than on the loop's first request"""
+    download.REGISTRY.refresh()
+    download.HEALTH.refresh()
+    download.get_counters()
+    download.get_decisions()
+    download.get_latency_table()
+    geoip.get_locator()
+
+
+async def lifespan(receive, send):
+    """Open and close the shared client with the server"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_client()
+            await asyncio.to_thread(__warm__)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if CLIENT is not None:
+                await CLIENT.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def call_wsgi(scope, receive, send):
+    """Hand a request to the Flask app, in a task of its own with an empty context
+
+    asgiref keeps the executor of a WSGI call in a context variable, and
+    uvicorn starts the next request on a kept-alive connection from inside
+    our send(). Without a clean context that request finds the finished
+    executor and fails.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, WSGI_APP(scope, receive, send))
+
+
+async def APP(scope, receive, send):
+    """ASGI entry point"""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return await WSGI_APP(scope, receive, send)
+    try:
+        endpoint = ROUTES.match(scope["path"], method=scope["method"])[0]
+    except werkzeug.exceptions.HTTPException:
+        endpoint = None
+    if endpoint not in ASYNC_ENDPOINTS:
+        return await call_wsgi(scope, receive, send)
+    try:
+        url = await get_url(scope, scope["path"][1:])
+    except mirrors.NoMirrors as error:
+        body, status = download.no_mirrors(error)
+        body = json.dumps(body).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+        return
+    # the path is decoded, so quote it again like werkzeug's redirects do
+    await send({"type": "http.response.start", "status": 302,
+                "headers": [(b"location", werkzeug.urls.iri_to_uri(url).encode()),
+                            (b"content-length", b"0")]})
+    await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  accesslog.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Synthetic access logs, in nginx's combined format
+
+Clients come from a few thousand networks with a Zipf-like popularity,
+several hosts to a network, and most of them want the newest ISO. Now and
+then someone looks at the stats pages or the archives. Real logs in the
+same format can be replayed just the same.
+
+Usage: python3 benchmarks/accesslog.py <output> [requests] [seed]
+"""
+import datetime
+import random
+import re
+import sys
+
+# (path, weight). Paths under ISOs/ and hash_files/ get redirected
+FILES = (("ISOs/Drauger_OS-7.6-AMD64.iso", 50), ("ISOs/Drauger_OS-7.5.1-AMD64.iso", 12),
+         ("ISOs/Drauger_OS-7.6-ARM64.iso", 4), ("ISOs/Drauger_OS-DEV-AMD64.iso", 2),
+         ("hash_files/Drauger_OS-7.6-AMD64.iso.sha256sum", 14),
+         ("hash_files/Drauger_OS-7.5.1-AMD64.iso.sha256sum", 3), ("ISOs/", 3), ("", 2))
+# share of requests for each kind of page
+PAGES = {"redirect": 0.9, "stats": 0.07, "archive": 0.03}
+# years with archives, see replay.py
+ARCHIVE_YEARS = (2019, 2023)
+AGENTS = ("Wget/1.21.3", "curl/8.5.0",
+          "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+          "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+          "Chrome/126.0 Safari/537.36")
+LINE = re.compile(r'^(\S+) \S+ \S+ \[[^\]]*\] "(\S+) (\S+)[^"]*"')
+
+
+def make_networks(count):
+    """Random public-looking IPv4 /24s"""
+    return [f"{ random.randint(11, 223) }.{ random.randint(0, 255) }.{ random.randint(0, 255) }"
+            for each in range(count)]
+
+
+def make_path(kind):
+    """Request path for one kind of page"""
+    if kind == "stats":
+        return "/stats"
+    if kind == "archive":
+        first = random.randint(*ARCHIVE_YEARS)
+        last = random.choice((first, random.randint(first, ARCHIVE_YEARS[1])))
+        date = str(first) if first == last else f"{ first }-{ last }"
+        return f"/stats/archive/{ date }" + ("?days=1" if random.random() < 0.2 else "")
+    return "/" + random.choices([each[0] for each in FILES], [each[1] for each in FILES])[0]
+
+
+def make_log(path, requests, networks=3000, start=None):
+    """Write `requests` lines of synthetic access log to `path`"""
+    nets = make_networks(networks)
+    weights = [1 / (rank + 1) for rank in range(networks)]
+    # a handful of hosts behind each network
+    hosts = {net: [random.randint(1, 254) for each in range(random.randint(1, 8))]
+             for net in nets}
+    kinds = list(PAGES)
+    when = start or datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+    with open(path, "w") as file:
+        for net in random.choices(nets, weights, k=requests):
+            kind = random.choices(kinds, list(PAGES.values()))[0]
+            when += datetime.timedelta(seconds=random.expovariate(20))
+            status = 200 if kind != "redirect" else 302
+            file.write(f'{ net }.{ random.choice(hosts[net]) } - - '
+                       f'[{ when.strftime("%d/%b/%Y:%H:%M:%S %z") }] '
+                       f'"GET { make_path(kind) } HTTP/1.1" { status } 0 "-" '
+                       f'"{ random.choice(AGENTS) }"\n')
+
+
+def read_log(path):
+    """(ip, path) for every GET in a combined format access log"""
+    entries = []
+    with open(path, "r") as file:
+        for line in file:
+            match = LINE.match(line)
+            if match is not None and match.group(2) == "GET":
+                entries.append((match.group(1), match.group(3)))
+    return entries
+
+
+def endpoint(path):
+    """Which endpoint a request path goes to, for grouping results"""
+    path = path.split("?")[0]
+    if path == "/stats":
+        return "/stats"
+    if path.startswith("/stats/archive/"):
+        return "/stats/archive/<date>"
+    if path.startswith(("/stats", "/about", "/metrics", "/status", "/do-assets/", "/robots.txt")):
+        return "other"
+    return "/<path>"
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 benchmarks/accesslog.py <output> [requests] [seed]")
+        sys.exit(1)
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    random.seed(int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    make_log(sys.argv[1], requests)
+    print(f"Wrote { requests } requests to { sys.argv[1] }")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  analytics_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Check the download rollups against exact counts, and time them
+
+Logs a day of downloads: a few releases most people want, and a long tail
+of paths only ever asked for once. Compacts them into rollups, then
+compares the top mirrors, countries and files with exact counts, checks
+every count is within its error and that the totals are exact, and that
+a crash between writing the rollups and the daily totals doesn't count
+anything twice.
+
+Usage: python3 benchmarks/analytics_bench.py [downloads] [top k]
+"""
+import collections
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analytics
+import common
+import eventlog
+
+SEGMENT = 50000
+SIZE = 2147483648
+
+
+def make_events(count):
+    """(mirror, country, path) for `count` downloads"""
+    mirrors = [f"https://mirror{ each }.example/" for each in range(8)]
+    countries = [f"C{ each }" for each in range(40)]
+    releases = [f"ISOs/Drauger_OS-7.{ each }-AMD64.iso" for each in range(50)]
+    events = []
+    for each in range(count):
+        if random.random() < 0.2:
+            path = f"ISOs/junk-{ random.getrandbits(64):x}.iso"
+        else:
+            path = random.choices(releases, [1 / (rank + 1) for rank in range(50)])[0]
+        events.append((random.choices(mirrors, [8 - rank for rank in range(8)])[0],
+                       random.choices(countries, [1 / (rank + 1) for rank in range(40)])[0],
+                       path))
+    return events
+
+
+def write_segments(events, stamp):
+    """Write events as sealed segments, each download's size logged afterwards"""
+    os.makedirs(eventlog.EVENT_LOG_DIR, exist_ok=True)
+    for start in range(0, len(events), SEGMENT):
+        with open(os.path.join(eventlog.EVENT_LOG_DIR, f"1-{ start:012d}.log"), "w") as file:
+            for mirror, country, path in events[start:start + SEGMENT]:
+                file.write(f"{ stamp:.3f}\t1\t0\t{ mirror }\t{ country }\t{ path }\n")
+                file.write(f"{ stamp:.3f}\t0\t{ SIZE }\t{ mirror }\t{ country }\t{ path }\n")
+
+
+def check(result, exact, name):
+    """Compare a query's top rows with exact counts. Returns True if all are in bounds"""
+    truth = sorted(exact.items(), key=lambda each: -each[1])[:len(result["top"])]
+    shown = {row[name]: row for row in result["top"]}
+    found = sum(1 for key, count in truth if key in shown)
+    bounded = all(row["downloads"] - row["error"] <= exact[row[name]] <= row["downloads"]
+                  for row in result["top"])
+    print(f"top { len(truth):3d} { result['dimension']:>10}: { found:3d} of the true top found, "
+          f"counts { 'within' if bounded else 'OUTSIDE' } their error")
+    return bounded
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    random.seed(1)
+    events = make_events(count)
+    stamp = time.mktime(datetime.date.today().timetuple()) + 12 * 3600
+    day = datetime.date.today()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open("settings.json", "w") as file:
+            json.dump({"analytics_top_k": size}, file)
+        common.reload_settings()
+        write_segments(events, stamp)
+        start = time.perf_counter()
+        eventlog.compact()
+        elapsed = time.perf_counter() - start
+        paths = len(set(each[2] for each in events))
+        print(f"{ count } downloads of { paths } paths, top { size } kept: compacted in "
+              f"{ elapsed:.2f} s, rollup file { os.path.getsize(f'rollups/{ day }.json') / 1024:.0f} KiB")
+        correct = True
+        for name, index in (("mirror", 0), ("country", 1), ("file", 2)):
+            exact = collections.Counter(each[index] for each in events)
+            result = analytics.query(day, day, {"country": "countries"}.get(name, name + "s"),
+                                     limit=20)
+            correct = check(result, exact, name) and correct
+        total = analytics.query(day, day, "all")["total"]
+        print(f"totals: { total['downloads'] } downloads, { total['bytes'] } bytes "
+              f"for { count } and { count * SIZE }")
+        correct = correct and total == {"downloads": count, "bytes": count * SIZE}
+        # a crash after the rollups are written, before the daily totals are
+        shutil.rmtree("rollups")
+        os.remove(eventlog.DAILY_FILE)
+        write_segments(events[:SEGMENT], stamp)
+        save = eventlog.__save__
+        eventlog.__save__ = lambda daily, path: os.kill(os.getpid(), 0) and None
+        eventlog.compact()
+        eventlog.__save__ = save
+        write_segments(events[:SEGMENT], stamp)
+        eventlog.compact()
+        again = analytics.query(day, day, "all")["total"]["downloads"]
+        print(f"crash between writes: { again } downloads counted for { SEGMENT }")
+        correct = correct and again == SEGMENT
+        for each in range(1, analytics.MAX_RANGE):
+            shutil.copy(f"rollups/{ day }.json", f"rollups/{ day - datetime.timedelta(days=each) }.json")
+        for days in (1, 7, analytics.MAX_RANGE):
+            start = time.perf_counter()
+            analytics.top(day - datetime.timedelta(days=days - 1), day, "files", limit=20)
+            middle = time.perf_counter()
+            # a different question about the same days
+            analytics.top(day - datetime.timedelta(days=days - 1), day, "countries", limit=5,
+                          match=(None, None, "ISOs/Drauger_OS-7.0-AMD64.iso"))
+            print(f"top files over { days:3d} days: { (middle - start) * 1000:8.1f} ms, "
+                  f"then top countries for one file { (time.perf_counter() - middle) * 1000:6.1f} ms")
+        os.chdir("/")
+    print("OK" if correct else "MISMATCH")
+    if not correct:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  archive_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Time historical queries against synthetic archives
+
+Compares decompressing every archive on every query, like the old
+read_archive(), with monthly totals from the index, and with days read
+through the decompressed-archive cache, cold and warm.
+
+Usage: python3 benchmarks/archive_bench.py [archives]
+"""
+import datetime
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive
+import common
+
+RUNS = 20
+
+
+def timed(function, runs=RUNS):
+    """Average time of `function()` in ms"""
+    start = time.perf_counter()
+    for each in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        day = datetime.date(2000, 1, 1)
+        lines = []
+        for each in range(count * 366):
+            lines.append(f"{ day.strftime('%B %d %Y') } - { random.randint(0, 500) } - "
+                         f"{ random.random() * 1000:.3f}")
+            day += datetime.timedelta(days=1)
+        for each in range(count):
+            with open(common.LONG_TERM_COUNT_FILE, "w") as file:
+                file.write("\n".join(lines[each * 366:]))
+            archive.create_archive()
+        names = sorted(archive.load_index()["archives"])
+        last = int(names[-1].split(".")[0].split("-")[1])
+
+        def legacy():
+            for name in names:
+                with tarfile.open(f"archives/{ name }", "r") as file:
+                    common.parse_data(file.extractfile(file.getnames()[0]).read().decode())
+
+        def cold():
+            archive.CACHE.clear()
+            archive.query(2000, last, days=True)
+
+        print(f"{ count } archives, { len(lines) } days")
+        print(f"decompress everything: { timed(legacy):8.2f} ms")
+        print(f"monthly totals, index: { timed(lambda: archive.query(2000, last), 1000):8.3f} ms")
+        print(f"every day, cold cache: { timed(cold):8.2f} ms")
+        with open("settings.json", "w") as file:
+            file.write(f'{{"archive_cache_size": { count }}}')
+        common.reload_settings()
+        archive.query(2000, last, days=True)
+        print(f"every day, warm cache: { timed(lambda: archive.query(2000, last, days=True)):8.2f} ms")
+        print(f"one year,  warm cache: { timed(lambda: archive.query(2005, 2005, days=True)):8.2f} ms")
+        os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
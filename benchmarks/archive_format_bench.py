@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  archive_format_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare archive formats: creation time, size and single-month reads
+
+Builds a year's archive from synthetic data with each format, then times
+reading one month from it with nothing cached, which is what a request for
+a month of an old year costs.
+
+Usage: python3 benchmarks/archive_format_bench.py [runs]
+"""
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive
+import common
+
+FORMATS = ("tar.xz",) + tuple(archive.CODECS)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    random.seed(0)
+    day = datetime.date(2020, 1, 1)
+    lines = []
+    for each in range(366 * 2):
+        lines.append(f"{ day.strftime('%B %d %Y') } - { random.randint(0, 5000) } - "
+                     f"{ random.random() * 1000:.3f}")
+        day += datetime.timedelta(days=1)
+    text = "\n".join(lines)
+    print(f"{ 'format':>7} { 'create ms':>10} { 'bytes':>8} { 'month ms':>9}  ok")
+    for codec in FORMATS:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            with open("settings.json", "w") as file:
+                json.dump({"archive_format": codec}, file)
+            common.reload_settings()
+            with open(common.LONG_TERM_COUNT_FILE, "w") as file:
+                file.write(text)
+            archive.INDEX.update({"mtime": None, "data": {"archives": {}}})
+            start = time.perf_counter()
+            archive.create_archive()
+            created = (time.perf_counter() - start) * 1000
+            name = os.listdir(archive.ARCHIVE_DIR)
+            name = [each for each in name if each.endswith(archive.SUFFIXES)][0]
+            size = os.path.getsize(os.path.join(archive.ARCHIVE_DIR, name))
+            start = time.perf_counter()
+            for each in range(runs):
+                archive.CACHE.clear()
+                month = archive.read_month(name, "2020-07")
+            read = (time.perf_counter() - start) / runs * 1000
+            # every line, in order, back out of the archive
+            good = archive.read_archive(name).split("\n")
+            good = [each for each in good if each] == lines[:366]
+            good = good and month.split("\n")[0].startswith("July 01 2020")
+            os.chdir("/")
+        print(f"{ codec:>7} { created:10.2f} { size:8d} { read:9.3f}  { good }")
+
+
+if __name__ == "__main__":
+    main()
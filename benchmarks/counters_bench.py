@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  counters_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Time the sharded counters against the lock they replaced
+
+Increments are timed against the old multiprocessing.Lock and RawValue
+pair. That counts stay exact under concurrent load from many processes is
+checked by tests/test_counters.py.
+
+Usage: python3 benchmarks/counters_bench.py [increments]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import counters
+
+SIZE = 2147483648
+
+
+def timing(increments):
+    """Single-thread cost of one counted download, old and new"""
+    lock = multiprocessing.Lock()
+    counter = multiprocessing.RawValue("i", 0)
+    data_counter = multiprocessing.RawValue("L", 0)
+    start = time.perf_counter()
+    for each in range(increments):
+        with lock:
+            counter.value += 1
+        with lock:
+            data_counter.value += SIZE // 1048576
+    old = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as tmp:
+        table = counters.CounterTable(os.path.join(tmp, "counters.bin"))
+        start = time.perf_counter()
+        for each in range(increments):
+            table.add(1, SIZE)
+        new = time.perf_counter() - start
+    print(f"lock + RawValue: { old / increments * 1000000000:.0f} ns per download")
+    print(f"CounterTable:    { new / increments * 1000000000:.0f} ns per download")
+
+
+def main():
+    timing(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+
+
+if __name__ == "__main__":
+    main()
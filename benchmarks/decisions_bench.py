@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  decisions_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Replay a synthetic access log through the redirect decision cache
+
+Clients come from a few thousand places with a Zipf-like popularity, each
+request a little way from its place, asking for a handful of paths. Halfway
+through, a mirror goes down. Each request is decided with and without the
+cache, and the two answers compared.
+
+Usage: python3 benchmarks/decisions_bench.py [requests] [mirrors]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import decisions
+import health
+import mirrors
+from mirrors_bench import make_servers
+
+PATHS = ("ISOs/Drauger_OS-7.6-AMD64.iso", "ISOs/Drauger_OS-7.5.1-AMD64.iso",
+         "hash_files/Drauger_OS-7.6-AMD64.iso.sha256", "")
+
+
+def make_log(path, requests, places=3000):
+    """Write a synthetic access log: one "lat lon path" line per request"""
+    spots = [(random.uniform(-60, 70), random.uniform(-180, 180)) for each in range(places)]
+    weights = [1 / (rank + 1) for rank in range(places)]
+    with open(path, "w") as file:
+        for spot in random.choices(spots, weights, k=requests):
+            path = random.choices(PATHS, (60, 20, 15, 5))[0]
+            file.write(f"{ spot[0] + random.gauss(0, 0.1):.4f} "
+                       f"{ spot[1] + random.gauss(0, 0.1):.4f} { path }\n")
+
+
+def write_health(registry, down=()):
+    """Write a health table with every mirror but `down` up"""
+    table = health.check_all([], {"generation": 0, "mirrors": {}})
+    for each in registry.get_mirrors():
+        table["mirrors"][each.url] = {"up": each.url not in down, "latency": 0.01,
+                                      "last_seen": table["checked"], "failures": 0}
+    table["generation"] = len(down)
+    health.write_table(table)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        make_servers("servers.json", count)
+        make_log("access.log", requests)
+        registry = mirrors.MirrorRegistry()
+        table = health.HealthTable()
+        write_health(registry)
+        cache = decisions.DecisionCache(registry, table)
+
+        def decide(loc):
+            for url in registry.rank(loc):
+                if table.is_up(url):
+                    return url
+            return registry.rank(loc)[0]
+
+        with open("access.log", "r") as file:
+            log = [line.rstrip("\n").split(" ", 2) for line in file]
+        half = len(log) // 2
+        # the closest mirror to the busiest place goes down halfway through
+        busiest = decide(log[0][:2])
+        timings = {"uncached": 0.0, "cached": 0.0}
+        differ = 0
+        for index, (lat, lon, path) in enumerate(log):
+            if index == half:
+                write_health(registry, down=(busiest,))
+            start = time.perf_counter()
+            expected = decide([lat, lon])
+            timings["uncached"] += time.perf_counter() - start
+            start = time.perf_counter()
+            got = cache.get([lat, lon], path, decide)
+            timings["cached"] += time.perf_counter() - start
+            differ += got != expected
+        stats = cache.stats()
+        # the same log again, with the cache warm
+        hits = stats["hits"]
+        start = time.perf_counter()
+        for lat, lon, path in log:
+            cache.get([lat, lon], path, decide)
+        warm = (time.perf_counter() - start) / len(log) * 1000000
+        warm_ratio = (cache.stats()["hits"] - hits) / len(log)
+        print(f"{ len(log) } requests, { count } mirrors")
+        print(f"uncached: { timings['uncached'] / len(log) * 1000000:7.2f} us per request")
+        print(f"  cached: { timings['cached'] / len(log) * 1000000:7.2f} us per request")
+        print(f"hit ratio { stats['hit_ratio']:.3f}, { stats['invalidations'] } invalidations, "
+              f"{ stats['entries'] } cells cached")
+        print(f"    warm: { warm:7.2f} us per request, hit ratio { warm_ratio:.3f}")
+        print(f"different mirror than uncached: { differ / len(log) * 100:.2f}% "
+              f"(clients near a cell edge)")
+        os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
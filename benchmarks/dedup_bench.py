@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  dedup_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Time dedup_entries() on synthetic long-term count files
+
+Each file has one entry per day, with about 1 day in 20 written twice,
+like the old midnight job used to. The nested-loop version this replaced
+is timed too, but only on the shorter files. On 100 years it would take
+hours.
+
+Usage: python3 benchmarks/dedup_bench.py [years ...]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import common
+
+# the legacy version is O(n^3) in the worst case. Don't bother past this
+LEGACY_MAX_YEARS = 10
+
+
+def generate(path, years):
+    """Write a long-term count file. Returns the total downloads and GB in it"""
+    day = datetime.date(2000, 1, 1)
+    downloads = 0
+    data = 0.0
+    with open(path, "w") as file:
+        lines = []
+        for each in range(years * 365):
+            for repeat in range(2 if random.random() < 0.05 else 1):
+                count = random.randint(0, 500)
+                size = round(count * 2.4, 3)
+                downloads += count
+                data += size
+                lines.append(f"{ day.strftime('%B %d %Y') } - { count } - { size:.3f}")
+            day += datetime.timedelta(days=1)
+        file.write("\n".join(lines))
+    return downloads, data
+
+
+def legacy_dedup(path):
+    """dedup_entries() as it was before"""
+    data = common.parse_data_file(path)
+    result = []
+    for each in enumerate(data):
+        add = []
+        for each1 in enumerate(data):
+            if each[1][0] == each1[1][0]:
+                if add == []:
+                    sentenal = False
+                    for each2 in result:
+                        if each[1][0] == each2[0]:
+                            sentenal = True
+                            break
+                    if sentenal:
+                        continue
+                    if each[0] == each1[0]:
+                        add = [each[1][0], each[1][1]]
+                    else:
+                        add = [each[1][0], (each[1][1] + each1[1][1])]
+                elif add[0] == each[1][0]:
+                    add[1] = add[1] + each1[1][1]
+                else:
+                    sentenal = False
+                    for each2 in result:
+                        if each[1][0] == each2[0]:
+                            sentenal = True
+                            break
+                    if sentenal:
+                        continue
+                    if each[0] == each1[0]:
+                        add = [each[1][0], each[1][1]]
+                    else:
+                        add = [each[1][0], (each[1][1] + each1[1][1])]
+        if add != []:
+            result.append(add)
+    os.remove(path)
+    for each in result:
+        common.write_data_file(path, write=each)
+
+
+def main():
+    years = [int(each) for each in sys.argv[1:]] or [1, 10, 100]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        import maintenance
+        path = os.path.join(tmp, "longterm.txt")
+        for count in years:
+            downloads, data = generate(path, count)
+            rows = sum(1 for each in open(path))
+            start = time.perf_counter()
+            maintenance.dedup_entries(path)
+            elapsed = time.perf_counter() - start
+            entries = common.parse_data_file(path)
+            correct = (len(entries) == count * 365 and
+                       sum(each[1] for each in entries) == downloads and
+                       abs(sum(each[2] for each in entries) - data) < 0.01 * len(entries))
+            line = f"{ count:>3} years, { rows } rows: { elapsed * 1000:9.1f} ms " \
+                   f"({ 'correct' if correct else 'WRONG' })"
+            if count <= LEGACY_MAX_YEARS:
+                generate(path, count)
+                start = time.perf_counter()
+                legacy_dedup(path)
+                line += f", legacy { (time.perf_counter() - start) * 1000:9.1f} ms"
+            print(line)
+        os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
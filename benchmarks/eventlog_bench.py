@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  eventlog_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Check the download event log keeps up, and survives a crash
+
+Times a single eventlog.log() call, which is what a redirect pays, then
+has several processes log as fast as they can under each fsync policy,
+compacting as they go, and checks the daily totals match exactly what was
+logged. Last, a process is killed without sealing its segment, and
+everything it flushed has to be recovered.
+
+Usage: python3 benchmarks/eventlog_bench.py [processes] [seconds]
+"""
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import common
+import eventlog
+
+SIZE = 2147483648
+FLUSHED = 5000
+
+
+def hammer(seconds, results):
+    """Log as fast as possible for `seconds`, then report how many"""
+    count = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for each in range(100):
+            eventlog.log("ISOs/Drauger_OS-7.7.iso", SIZE, "https://mirror.example/", "US")
+        count += 100
+    eventlog.flush(seal=True)
+    results.put(count)
+
+
+def crash():
+    """Flush some events, queue some more, then die without sealing anything"""
+    for each in range(FLUSHED):
+        eventlog.log("ISOs/Drauger_OS-7.7.iso", SIZE, "https://mirror.example/", "DE")
+    eventlog.flush()
+    for each in range(100):
+        eventlog.log("ISOs/Drauger_OS-7.7.iso", SIZE, "https://mirror.example/", "DE")
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def total(daily):
+    """Downloads and bytes across every day"""
+    return (sum(each["downloads"] for each in daily["days"].values()),
+            sum(each["bytes"] for each in daily["days"].values()))
+
+
+def throughput(processes, seconds, policy):
+    """Run the writers under one fsync policy. Returns True if nothing was lost"""
+    with open("settings.json", "w") as file:
+        json.dump({"eventlog_fsync": policy, "eventlog_segment_seconds": 0.5}, file)
+    # the writers are forked from us, settings and all
+    common.reload_settings()
+    results = multiprocessing.Queue()
+    pool = [multiprocessing.Process(target=hammer, args=(seconds, results))
+            for each in range(processes)]
+    for each in pool:
+        each.start()
+    compactions = 0
+    while any(each.is_alive() for each in pool):
+        eventlog.compact()
+        compactions += 1
+        time.sleep(0.2)
+    logged = sum(results.get() for each in pool)
+    for each in pool:
+        each.join()
+    daily = eventlog.compact()
+    downloads, size = total(daily)
+    print(f"fsync { policy:>8}: { logged / seconds:10.0f} events/s from { processes } processes, "
+          f"{ compactions } concurrent compactions, compacted { downloads } of { logged }")
+    os.remove(eventlog.DAILY_FILE)
+    return downloads == logged and size == logged * SIZE
+
+
+def recovery():
+    """Kill a writer mid-segment and check compact() picks up what it flushed"""
+    proc = multiprocessing.Process(target=crash)
+    proc.start()
+    proc.join()
+    daily = eventlog.compact()
+    downloads = total(daily)[0]
+    print(f"crash recovery: { downloads } recovered, { FLUSHED } flushed before the crash")
+    # compacting again must not count anything twice
+    return downloads == FLUSHED and total(eventlog.compact())[0] == FLUSHED
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        start = time.perf_counter()
+        for each in range(100000):
+            eventlog.log("ISOs/Drauger_OS-7.7.iso", SIZE, "https://mirror.example/", "US")
+        elapsed = time.perf_counter() - start
+        # none of these count towards the checks below
+        eventlog.QUEUE.clear()
+        eventlog.flush(seal=True)
+        eventlog.compact()
+        os.remove(eventlog.DAILY_FILE)
+        print(f"request path: { elapsed / 100000 * 1000000000:.0f} ns per log()")
+        correct = all([throughput(processes, seconds, each) for each in ("never", "interval", "always")])
+        correct = recovery() and correct
+        os.chdir("/")
+    print("OK" if correct else "MISMATCH")
+    if not correct:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
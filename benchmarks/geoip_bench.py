@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  geoip_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare local GeoIP lookups against the per-request ipinfo.io HTTP path
+
+Usage: python3 benchmarks/geoip_bench.py [ranges] [lookups]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import urllib3
+import geoip
+from stubs import IPInfoHandler, StubServer
+
+
+def make_csv(path, ranges):
+    """Write `ranges` contiguous IPv4 ranges covering public address space"""
+    step = (2 ** 32) // ranges
+    with open(path, "w") as file:
+        file.write("ip_start,ip_end,country,latitude,longitude\n")
+        for each in range(ranges):
+            file.write(f"{ each * step },{ ((each + 1) * step) - 1 },US,"
+                       f"{ random.uniform(-90, 90):.4f},{ random.uniform(-180, 180):.4f}\n")
+
+
+def random_ips(count):
+    """Random public IPv4 addresses"""
+    return [f"{ random.randint(1, 223) }.{ random.randint(0, 255) }."
+            f"{ random.randint(0, 255) }.{ random.randint(1, 254) }" for each in range(count)]
+
+
+def main():
+    ranges = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    ips = random_ips(lookups)
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "ranges.csv")
+        db_path = os.path.join(tmp, "geoip.db")
+        make_csv(csv_path, ranges)
+        start = time.perf_counter()
+        geoip.compile_database(csv_path, db_path)
+        print(f"compile: { ranges } ranges in { time.perf_counter() - start:.2f}s, "
+              f"{ os.path.getsize(db_path) / 1048576:.1f} MiB")
+        start = time.perf_counter()
+        locator = geoip.GeoLocator([geoip.LocalBackend(db_path)])
+        print(f"load: { (time.perf_counter() - start) * 1000:.1f} ms")
+        start = time.perf_counter()
+        for each in ips:
+            locator.locate(each)
+        elapsed = time.perf_counter() - start
+        print(f"local: { lookups / elapsed:,.0f} lookups/s")
+
+    # The old code path: a fresh PoolManager and a GET per redirect
+    http_lookups = min(lookups, 2000)
+    with StubServer(IPInfoHandler) as server:
+        url = [server.url, "/json"]
+        start = time.perf_counter()
+        for each in ips[:http_lookups]:
+            http = urllib3.PoolManager()
+            json.loads(http.request("GET", each.join(url)).data)
+        elapsed = time.perf_counter() - start
+    print(f"http (local stub, no network latency): { http_lookups / elapsed:,.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    main()
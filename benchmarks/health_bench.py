@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  health_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Run the health checker against healthy, slow and dead stub mirrors
+
+A full check should take about one timeout no matter how many mirrors are
+slow or dead, and reading health on the request path should cost next to
+nothing.
+
+Usage: python3 benchmarks/health_bench.py [healthy] [slow] [dead]
+"""
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import health
+from stubs import MirrorHandler, StubServer, dead_url
+
+TIMEOUT = 1.0
+
+
+def main():
+    counts = [int(each) for each in sys.argv[1:4]] + [4, 2, 2][len(sys.argv[1:4]):]
+    servers = [StubServer(MirrorHandler) for each in range(counts[0])]
+    servers += [StubServer(MirrorHandler, latency=TIMEOUT * 3) for each in range(counts[1])]
+    for each in servers:
+        each.__enter__()
+    urls = [each.url for each in servers] + [dead_url() for each in range(counts[2])]
+    start = time.perf_counter()
+    table = health.check_all(urls, timeout=TIMEOUT)
+    elapsed = time.perf_counter() - start
+    up = sum(each["up"] for each in table["mirrors"].values())
+    print(f"checked { len(urls) } mirrors ({ counts[0] } healthy, { counts[1] } slow, "
+          f"{ counts[2] } dead) in { elapsed:.2f}s with a { TIMEOUT }s timeout")
+    print(f"up: { up }, down: { len(urls) - up }, expected up: { counts[0] }")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "health.json")
+        health.write_table(table, path)
+        reader = health.HealthTable(path)
+        start = time.perf_counter()
+        for each in range(100000):
+            reader.is_up(urls[each % len(urls)])
+        elapsed = time.perf_counter() - start
+    print(f"request path: { elapsed / 100000 * 1000000:.2f} us per is_up()")
+    for each in servers:
+        each.__exit__()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  latency_sim.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Send a day of clients to the mirrors by distance, and by measured latency
+
+Clients in a few parts of the world download an ISO from the mirrors in
+servers.json, each with its own real round trip time and throughput that
+distance doesn't predict: the au mirror is badly peered, so even
+Australians do better from us. A share of the clients report how their
+download went with a beacon, and the "measured" policy learns from those.
+Also checks the shared table stays within its slots however many regions
+report, and times its hot paths.
+
+Usage: python3 benchmarks/latency_sim.py [clients] [share reporting]
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import common
+import latency
+import mirrors
+import policy
+
+ISO = 2.6e9
+US = "https://us.download.draugeros.org/"
+AU = "https://au.download.draugeros.org/"
+DE = "https://de.download.draugeros.org/"
+SE = "https://se.download.draugeros.org/"
+# name, share of clients, lat range, lon range, {mirror: (rtt s, MB/s)}
+ZONES = (("australia", 0.15, (-38, -27), (115, 153),
+          {AU: (0.03, 2), US: (0.18, 12), DE: (0.3, 6), SE: (0.32, 5)}),
+         ("se asia", 0.15, (-8, 15), (95, 125),
+          {AU: (0.12, 1.5), US: (0.2, 8), DE: (0.18, 10), SE: (0.2, 7)}),
+         ("north america", 0.35, (28, 50), (-123, -70),
+          {AU: (0.18, 3), US: (0.04, 25), DE: (0.11, 10), SE: (0.13, 8)}),
+         ("europe", 0.35, (40, 60), (-5, 25),
+          {AU: (0.3, 2), US: (0.11, 10), DE: (0.02, 30), SE: (0.03, 15)}))
+
+
+def client():
+    """Zone and [lat, lon] of a random client"""
+    share = random.random()
+    for zone in ZONES:
+        if share < zone[1]:
+            break
+        share -= zone[1]
+    return zone, [random.uniform(*zone[2]), random.uniform(*zone[3])]
+
+
+def simulate(registry, name, clients, reporting, table):
+    """Run a day of clients through one policy. Returns download seconds per zone"""
+    random.seed(5)
+    times = {zone[0]: [] for zone in ZONES}
+    for each in range(clients):
+        now = each * 86400 / clients
+        zone, loc = client()
+        area = latency.region(loc)
+        found = policy.candidates(registry, loc, policy=name)
+        expected = lambda km, mirror: table.expected(area, mirror.url, km, ISO, now=now)
+        url = policy.choose(found, policy=name, now=now, expected=expected)
+        rtt, speed = zone[4][url]
+        # a bad or good day on the client's end
+        speed *= random.lognormvariate(0, 0.3) * 1e6
+        rtt *= random.lognormvariate(0, 0.2)
+        times[zone[0]].append(rtt + (ISO / speed))
+        if random.random() < reporting:
+            table.record(area, url, rtt, speed, now=now)
+    return times
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    reporting = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        shutil.copy(os.path.join(REPO, "servers.json"), "servers.json")
+        with open("settings.json", "w") as file:
+            json.dump({"latency_half_life": 6 * 3600}, file)
+        common.reload_settings()
+        registry = mirrors.MirrorRegistry()
+        registry.refresh()
+        print(f"{ clients } clients over a day, { reporting * 100:.0f}% reporting back")
+        for name in ("nearest", "measured"):
+            table = latency.LatencyTable(f"{ name }.bin", slots=4096)
+            times = simulate(registry, name, clients, reporting, table)
+            everything = sorted(sum(times.values(), []))
+            print(f"\n{ name }: mean { sum(everything) / len(everything):6.0f} s, "
+                  f"p90 { everything[int(len(everything) * 0.9)]:6.0f} s")
+            for zone, values in times.items():
+                # the last half, once there has been something to learn from
+                late = values[len(values) // 2:]
+                print(f"  { zone:>14}: mean { sum(values) / len(values):6.0f} s, "
+                      f"second half { sum(late) / len(late):6.0f} s")
+        table = latency.LatencyTable("bounded.bin", slots=1024)
+        start = time.perf_counter()
+        for each in range(20000):
+            table.record(random.randrange(100000), US, 0.1, 1e7)
+        recorded = (time.perf_counter() - start) / 20000
+        start = time.perf_counter()
+        for each in range(20000):
+            table.expected(random.randrange(100000), US, 1000, ISO)
+        estimated = (time.perf_counter() - start) / 20000
+        entries = table.stats()["entries"]
+        print(f"\n20000 reports from 100000 regions into 1024 slots: { entries } in use, "
+              f"record() { recorded * 1e6:.1f} us, expected() { estimated * 1e6:.1f} us")
+        os.chdir("/")
+    if entries > 1024:
+        print("OVERFLOW")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
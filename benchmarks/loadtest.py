@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  loadtest.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare the sync (WSGI, 5 processes) and async (ASGI) serving modes
+
+Both run against local stub upstreams: an ipinfo.io stand-in with
+configurable latency, and stub mirrors. Every request comes from a new
+IP address so every one of them misses the geolocation cache and has to
+wait on the stub ipinfo.io.
+
+Usage: python3 benchmarks/loadtest.py [requests] [concurrency] [upstream latency]
+"""
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from stubs import IPInfoHandler, MirrorHandler, StubServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 5 single-threaded workers forked after the app is loaded, like download.ini
+SYNC_SERVER = """
+import os
+import socket
+import sys
+sys.path.insert(0, sys.argv[1])
+import werkzeug.serving
+import download
+import maintenance
+APP = download.create_app()
+maintenance.start()
+sock = socket.socket()
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+sock.bind(("127.0.0.1", int(sys.argv[2])))
+sock.listen(1024)
+for each in range(4):
+    if os.fork() == 0:
+        break
+werkzeug.serving.make_server("127.0.0.1", int(sys.argv[2]), APP,
+                             fd=sock.fileno()).serve_forever()
+"""
+# uvicorn, with maintenance.py's services running next to it
+ASYNC_SERVER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import uvicorn
+import maintenance
+maintenance.start()
+uvicorn.run("asgi:APP", port=int(sys.argv[2]), log_level="warning", access_log=False)
+"""
+
+
+def free_port():
+    """Get a local port nothing is using"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def random_ip():
+    """Random public-looking IPv4 address"""
+    return f"{ random.randint(11, 99) }.{ random.randint(0, 255) }." \
+           f"{ random.randint(0, 255) }.{ random.randint(1, 254) }"
+
+
+def setup(directory, ipinfo_url, mirror_urls):
+    """Write the config files the app reads from its working directory"""
+    with open(os.path.join(directory, "servers.json"), "w") as file:
+        json.dump({"na": [[url, ["32.9462", "-96.7058"]] for url in mirror_urls]}, file)
+    with open(os.path.join(directory, "settings.json"), "w") as file:
+        json.dump({"ipinfo_url": ipinfo_url, "health_interval": 5}, file)
+    shutil.copytree(os.path.join(REPO, "templates"), os.path.join(directory, "templates"))
+
+
+def start(mode, directory, port):
+    """Start the app in `mode` ("sync" or "async") in the background"""
+    if mode == "sync":
+        command = [sys.executable, "-c", SYNC_SERVER, REPO, str(port)]
+    else:
+        command = [sys.executable, "-c", ASYNC_SERVER, REPO, str(port)]
+    proc = subprocess.Popen(command, cwd=directory, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    stop(proc)
+    raise RuntimeError(f"{ mode } server did not start")
+
+
+def stop(proc):
+    """Stop the app and every process it started"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+async def drive(url, requests, concurrency, path="ISOs/test.iso", host=random_ip):
+    """Send `requests` GETs, `concurrency` at a time. Returns (elapsed, latencies, errors)"""
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal errors, remaining
+        # one client per worker. A single shared pool spends more time
+        # looking for a free connection than the server spends answering
+        async with httpx.AsyncClient(timeout=30) as client:
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url + path, headers={"Host": host()})
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for each in range(concurrency)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(elapsed, latencies, errors):
+    """Throughput and latency percentiles (ms) for one run"""
+    return {"requests": len(latencies), "errors": errors,
+            "rps": len(latencies) / elapsed,
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "p99": percentile(latencies, 99) * 1000}
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    print(f"{ requests } requests, { concurrency } concurrent, "
+          f"{ latency * 1000:.0f} ms upstream latency")
+    with StubServer(IPInfoHandler, latency=latency, fork=True) as ipinfo, \
+         StubServer(MirrorHandler, fork=True) as mirror_1, \
+         StubServer(MirrorHandler, fork=True) as mirror_2:
+        for mode in ("sync", "async"):
+            with tempfile.TemporaryDirectory() as directory:
+                setup(directory, ipinfo.url, [mirror_1.url, mirror_2.url])
+                port = free_port()
+                proc = start(mode, directory, port)
+                try:
+                    result = summarize(*asyncio.run(drive(f"http://127.0.0.1:{ port }/",
+                                                          requests, concurrency)))
+                finally:
+                    stop(proc)
+            print(f"{ mode:>6}: { result['rps']:8.1f} req/s  p50 { result['p50']:7.1f} ms  "
+                  f"p90 { result['p90']:7.1f} ms  p99 { result['p99']:7.1f} ms  "
+                  f"errors { result['errors'] }")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Check metrics add up across processes and threads, and time recording
+
+Several processes, each with several threads, record known latencies and
+upstream counts at the same time. The histograms and counters rendered
+afterwards have to match exactly. Then the cost of one observe(), and of
+rendering /metrics, is timed.
+
+Usage: python3 benchmarks/metrics_bench.py [processes] [threads] [observations]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+import metrics
+
+# one value per bucket, plus one past the last
+VALUES = [bound * 0.9 for bound in metrics.BUCKETS] + [60.0]
+
+
+def record(threads, observations):
+    """Record from several threads of one process"""
+    def work():
+        for each in range(observations):
+            metrics.observe("total", VALUES[each % len(VALUES)])
+            metrics.count_upstream(f"mirror{ each % 3 }.example.org", requests=1, errors=each % 2)
+
+    pool = [threading.Thread(target=work) for each in range(threads)]
+    for each in pool:
+        each.start()
+    for each in pool:
+        each.join()
+
+
+def parse(text):
+    """Sample name with labels: value, from the text format"""
+    output = {}
+    for line in text.split("\n"):
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            output[name] = float(value)
+    return output
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    observations = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    children = []
+    for each in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            record(threads, observations)
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+    samples = parse(metrics.render())
+    recorded = processes * threads * observations
+    # every value was recorded the same number of times, give or take one
+    good = samples['download_optimizer_stage_seconds_count{stage="total"}'] == recorded
+    for index, bound in enumerate(metrics.BUCKETS):
+        per_value = recorded // len(VALUES)
+        got = samples[f'download_optimizer_stage_seconds_bucket{{stage="total",le="{ bound }"}}']
+        good = good and per_value * (index + 1) <= got <= (per_value + processes * threads) * (index + 1)
+    requests = sum(samples[f'download_optimizer_upstream_requests_total{{host="mirror{ each }.example.org"}}']
+                   for each in range(3))
+    errors = sum(samples[f'download_optimizer_upstream_errors_total{{host="mirror{ each }.example.org"}}']
+                 for each in range(3))
+    good = good and requests == recorded and errors == recorded // 2
+    print(f"{ processes } processes x { threads } threads x { observations } observations: "
+          f"{ 'exact' if good else 'WRONG' }")
+    runs = 200000
+    start = time.perf_counter()
+    for each in range(runs):
+        metrics.observe("geo", 0.0003)
+    print(f"observe(): { (time.perf_counter() - start) / runs * 1000000000:.0f} ns")
+    start = time.perf_counter()
+    for each in range(runs):
+        metrics.count_upstream("mirror0.example.org", requests=1)
+    print(f"count_upstream(): { (time.perf_counter() - start) / runs * 1000000000:.0f} ns")
+    start = time.perf_counter()
+    for each in range(20):
+        metrics.render()
+    print(f"render(): { (time.perf_counter() - start) / 20 * 1000:.1f} ms")
+    directory = os.getcwd()
+    os.chdir("/")
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mirrors_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare mirror selection cost: reading servers.json per request vs. the registry
+
+With NumPy installed, batch ranking of many locations is timed as well.
+
+Usage: python3 benchmarks/mirrors_bench.py [sizes...]
+"""
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mirrors
+
+REGIONS = ("na", "sa", "af", "au", "eu", "as")
+
+
+def make_servers(path, count):
+    """Write a servers.json with `count` randomly placed mirrors"""
+    data = {each: [] for each in REGIONS}
+    for each in range(count):
+        data[REGIONS[each % len(REGIONS)]].append(
+            [f"https://mirror{ each }.example.org/",
+             [f"{ random.uniform(-90, 90):.4f}", f"{ random.uniform(-180, 180):.4f}"]])
+    with open(path, "w") as file:
+        json.dump(data, file)
+
+
+def legacy_haversine(point_1, point_2):
+    """haversine() as it was in download.py"""
+    lat1, lon1 = point_1
+    lat2, lon2 = point_2
+    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    return 2 * math.asin(math.sqrt(a)) * 6371
+
+
+def legacy_select(path, loc):
+    """get_optimal_server() + calculate_distance() as they were, minus probing"""
+    with open(path, "r") as file:
+        data = json.load(file)
+    servers = {}
+    distances = []
+    for continents in data:
+        for server in data[continents]:
+            point_1 = [float(each) for each in loc]
+            point_2 = [float(each) for each in server[1]]
+            distance = legacy_haversine(point_1, point_2)
+            servers[distance] = server[0]
+            distances.append(distance)
+    distances.sort()
+    return servers[distances[0]]
+
+
+def time_per_call(func, locs):
+    """Average microseconds per call of func(loc)"""
+    start = time.perf_counter()
+    for each in locs:
+        func(each)
+    return (time.perf_counter() - start) / len(locs) * 1000000
+
+
+def main():
+    sizes = [int(each) for each in sys.argv[1:]] or [4, 100, 1000]
+    locs = [[f"{ random.uniform(-90, 90):.4f}", f"{ random.uniform(-180, 180):.4f}"]
+            for each in range(2000)]
+    print(f"{ 'mirrors':>8} { 'legacy us':>10} { 'registry us':>12} { 'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = os.path.join(tmp, f"servers-{ size }.json")
+            make_servers(path, size)
+            registry = mirrors.MirrorRegistry(path)
+            registry.refresh()
+            calls = locs[:max(20, 20000 // size)]
+            legacy = time_per_call(lambda loc: legacy_select(path, loc), calls)
+            new = time_per_call(lambda loc: registry.rank(loc)[0], calls)
+            print(f"{ size:>8} { legacy:>10.1f} { new:>12.1f} { legacy / new:>7.1f}x")
+            if mirrors.numpy is not None:
+                start = time.perf_counter()
+                registry.rank_many(locs, 3)
+                elapsed = (time.perf_counter() - start) / len(locs) * 1000000
+                print(f"{ '':>8} batch of { len(locs) }, top 3: { elapsed:.1f} us per location")
+
+
+if __name__ == "__main__":
+    main()
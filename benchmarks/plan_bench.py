@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  plan_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Fetch the mirrors for an install's files one redirect at a time, and with one plan
+
+An installer wants an ISO, its checksum and its signature. Geolocation is
+given a fixed cost, standing in for a lookup that misses the cache.
+
+Usage: python3 benchmarks/plan_bench.py [files] [geolocation latency]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+RUNS = 200
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.002
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        shutil.copytree(os.path.join(REPO, "templates"), "templates")
+        shutil.copy(os.path.join(REPO, "servers.json"), "servers.json")
+        with open("settings.json", "w") as file:
+            file.write('{"ipinfo_fallback": false, "file_meta_crawl_interval": 3600}')
+        import download
+        import geoip
+
+        def locate(ip_addr):
+            time.sleep(latency)
+            return {"loc": "48.85,2.35", "country": "FR"}
+
+        geoip.locate = locate
+        client = download.create_app().test_client()
+        paths = [f"ISOs/Drauger_OS-7.6-AMD64.part{ each }" for each in range(count)]
+        query = "&".join(f"path={ each }" for each in paths)
+        client.get("/plan?" + query)
+        start = time.perf_counter()
+        for each in range(RUNS):
+            for path in paths:
+                client.get("/" + path)
+        separate = (time.perf_counter() - start) / RUNS * 1000
+        start = time.perf_counter()
+        for each in range(RUNS):
+            client.get("/plan?" + query)
+        planned = (time.perf_counter() - start) / RUNS * 1000
+        print(f"{ count } files, { latency * 1000:.1f} ms geolocation")
+        print(f"one redirect each: { separate:7.2f} ms, { count } requests")
+        print(f"one plan:          { planned:7.2f} ms, 1 request")
+        os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  policy_sim.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Replay a release-day load curve against each mirror selection policy
+
+A fleet of mirrors with different capacities serves two days of
+downloads, with a release halfway through day one. Every minute, new
+clients are sent to a mirror by the policy, and every mirror splits its
+bandwidth evenly over the downloads it has going, up to what each client
+can take. A mirror's latency, as the health checker would see it, goes up
+with how busy it is.
+
+Usage: python3 benchmarks/policy_sim.py [release peak per minute]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mirrors
+import policy
+
+# url, lat, lon, Gbit/s
+FLEET = (("https://de.example.org/", 50.1155, 8.6842, 10),
+         ("https://se.example.org/", 59.3294, 18.0687, 2),
+         ("https://nl.example.org/", 52.3676, 4.9041, 5),
+         ("https://fr.example.org/", 48.8566, 2.3522, 5),
+         ("https://pl.example.org/", 52.2297, 21.0122, 2),
+         ("https://us.example.org/", 32.9462, -96.7058, 10),
+         ("https://au.example.org/", -33.8707, 151.2068, 2))
+# where clients are: (share, lat range, lon range)
+CLIENTS = ((0.7, (36, 62), (-9, 30)), (0.25, (25, 50), (-123, -70)), (0.05, (-38, -12), (115, 153)))
+ISO_GB = 2.6
+# fastest a single client can download, Gbit/s
+CLIENT_GBPS = 0.05
+MINUTES = 2 * 24 * 60
+RELEASE = 12 * 60
+
+
+def load_curve(peak):
+    """New downloads in each minute: a daily baseline, and the release"""
+    curve = []
+    for minute in range(MINUTES):
+        baseline = 10 + (5 * ((minute % 1440) > 480))
+        release = 0
+        if minute >= RELEASE:
+            # the rush dies off with a half-life of 3 hours
+            release = peak * (0.5 ** ((minute - RELEASE) / 180))
+        curve.append(baseline + release)
+    return curve
+
+
+def client():
+    """Where a random client is"""
+    share = random.random()
+    for weight, lat, lon in CLIENTS:
+        if share < weight:
+            break
+        share -= weight
+    return [random.uniform(*lat), random.uniform(*lon)]
+
+
+def simulate(registry, name, curve):
+    """Run the load curve through one policy. Returns per-mirror and overall results"""
+    random.seed(3)
+    load = policy.LoadTracker(half_life=60)
+    capacity = {each.url: each.capacity for each in registry.mirrors}
+    # url: remaining GB of each download in progress, with the minute it started
+    active = {url: [] for url in capacity}
+    served = {url: 0.0 for url in capacity}
+    busy = {url: 0.0 for url in capacity}
+    peak = {url: 0.0 for url in capacity}
+    times = []
+    # GB served by the whole fleet, per minute
+    total = []
+    for minute, arrivals in enumerate(curve):
+        now = minute * 60
+        count = int(arrivals) + (random.random() < arrivals - int(arrivals))
+        for each in range(count):
+            found = policy.candidates(registry, client(), policy=name)
+            url = policy.choose(found, lambda url: 0.02 + (0.2 * busy[url]), name, load, now)
+            active[url].append([ISO_GB, minute])
+        for url, downloads in active.items():
+            if not downloads:
+                busy[url] = 0.0
+                continue
+            # GB each download can get this minute
+            share = min(CLIENT_GBPS, capacity[url] / len(downloads)) * 60 / 8
+            used = 0.0
+            still = []
+            for download in downloads:
+                got = min(share, download[0])
+                download[0] -= got
+                used += got
+                if download[0] > 1e-9:
+                    still.append(download)
+                else:
+                    times.append(minute + 1 - download[1])
+            active[url] = still
+            served[url] += used
+            busy[url] = used / (capacity[url] * 60 / 8)
+            peak[url] = max(peak[url], busy[url])
+        total.append(sum(busy[url] * capacity[url] * 60 / 8 for url in capacity))
+    seconds = MINUTES * 60
+    usage = {url: (served[url] / (capacity[url] * seconds / 8), peak[url]) for url in capacity}
+    times.sort()
+    unfinished = sum(len(each) for each in active.values())
+    # fleet throughput over the busiest hour, Gbit/s
+    hour = max(sum(total[start:start + 60]) for start in range(len(total) - 59)) * 8 / 3600
+    return usage, hour, times, unfinished
+
+
+def main():
+    peak = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    curve = load_curve(peak)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "servers.json")
+        with open(path, "w") as file:
+            json.dump({"all": [[url, [str(lat), str(lon)], {"capacity": gbps}]
+                               for url, lat, lon, gbps in FLEET]}, file)
+        registry = mirrors.MirrorRegistry(path)
+        registry.refresh()
+        print(f"{ int(sum(curve)) } downloads over { MINUTES // 60 } hours, "
+              f"release peak { peak:.0f}/min")
+        # "measured" needs clients reporting back. See latency_sim.py
+        for name in [each for each in policy.POLICIES if each != "measured"]:
+            usage, hour, times, unfinished = simulate(registry, name, curve)
+            print(f"\n{ name }: busiest hour { hour:.1f} Gbit/s, { unfinished } unfinished, "
+                  f"download time p50 { times[len(times) // 2] } min, "
+                  f"p95 { times[int(len(times) * 0.95)] } min")
+            for url, (mean, top) in usage.items():
+                print(f"  { url:<26} mean { mean * 100:5.1f}%  peak { top * 100:5.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  replay.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Replay an access log against the app, and report each endpoint
+
+The app runs in a scratch directory with a few years of download history,
+against local stub upstreams: an ipinfo.io stand-in that puts every /16 in
+its own place, and mirrors around the world. Both can be made slow and
+flaky. Requests are sent `concurrency` at a time, each one from the IP
+address in the log, and throughput and latency percentiles are reported
+for redirects, /stats and /stats/archive/<date>.
+
+Results are written as JSON, which --compare reads back to show what
+changed between two runs.
+
+Usage: python3 benchmarks/replay.py [--log access.log] [--requests 20000]
+           [--concurrency 50] [--latency 0.05] [--failure-rate 0.0]
+           [--modes sync async] [--output replay.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import accesslog
+import loadtest
+from stubs import IPInfoHandler, MirrorHandler, StubServer
+
+REPO = loadtest.REPO
+# where the stub mirrors are
+PLACES = (("32.9462", "-96.7058"), ("50.1155", "8.6842"), ("-33.8688", "151.2093"),
+          ("59.3293", "18.0686"))
+# first day of download history. Every year up to accesslog.ARCHIVE_YEARS[1] is archived
+HISTORY_START = datetime.date(accesslog.ARCHIVE_YEARS[0], 1, 1)
+HISTORY_END = datetime.date(2024, 5, 31)
+
+
+def setup(directory, ipinfo_url, mirror_urls):
+    """Config files and download history for the app, in its working directory"""
+    loadtest.setup(directory, ipinfo_url, mirror_urls)
+    with open(os.path.join(directory, "servers.json"), "w") as file:
+        json.dump({"world": [[url, list(PLACES[index % len(PLACES)])]
+                             for index, url in enumerate(mirror_urls)]}, file)
+    lines = []
+    day = HISTORY_START
+    while day <= HISTORY_END:
+        lines.append(f"{ day.strftime('%B %d %Y') } - { random.randint(0, 500) } - "
+                     f"{ random.random() * 1000:.3f}")
+        day += datetime.timedelta(days=1)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        sys.path.insert(0, REPO)
+        import archive
+        import common
+        with open(common.LONG_TERM_COUNT_FILE, "w") as file:
+            file.write("\n".join(lines))
+        for each in range(accesslog.ARCHIVE_YEARS[1] - accesslog.ARCHIVE_YEARS[0] + 1):
+            archive.create_archive()
+    finally:
+        os.chdir(cwd)
+
+
+async def replay(url, entries, concurrency):
+    """Send every (ip, path) in `entries`. Returns (elapsed, [(endpoint, latency, failed)])"""
+    results = []
+    remaining = iter(entries)
+
+    async def worker():
+        async with httpx.AsyncClient(timeout=30) as client:
+            for ip_addr, path in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url + path.lstrip("/"), headers={"Host": ip_addr})
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                results.append((accesslog.endpoint(path), time.perf_counter() - start, failed))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for each in range(concurrency)))
+    return time.perf_counter() - start, results
+
+
+def summarize(elapsed, results):
+    """Throughput and latency percentiles (ms) per endpoint, and for everything"""
+    groups = {"all": results}
+    for each in results:
+        groups.setdefault(each[0], []).append(each)
+    output = {}
+    for name, group in sorted(groups.items()):
+        latencies = [each[1] for each in group]
+        output[name] = {"requests": len(group), "errors": sum(each[2] for each in group),
+                        # what this endpoint got through while sharing the server
+                        "rps": len(group) / elapsed,
+                        "mean": sum(latencies) / len(latencies) * 1000,
+                        "p50": loadtest.percentile(latencies, 50) * 1000,
+                        "p90": loadtest.percentile(latencies, 90) * 1000,
+                        "p99": loadtest.percentile(latencies, 99) * 1000}
+    return output
+
+
+def report(mode, endpoints, previous=None):
+    """Print one mode's results, with the change from `previous` if given"""
+    print(f"{ mode }:")
+    for name, result in endpoints.items():
+        line = (f"  { name:>22}: { result['requests']:7d} req { result['rps']:8.1f} req/s  "
+                f"p50 { result['p50']:7.1f} ms  p90 { result['p90']:7.1f} ms  "
+                f"p99 { result['p99']:7.1f} ms  errors { result['errors'] }")
+        old = (previous or {}).get(name)
+        if old is not None:
+            line += (f"  (req/s { (result['rps'] / old['rps'] - 1) * 100:+.1f}%, "
+                     f"p50 { (result['p50'] / old['p50'] - 1) * 100:+.1f}%, "
+                     f"p99 { (result['p99'] / old['p99'] - 1) * 100:+.1f}%)")
+        print(line)
+
+
+def revision():
+    """Commit the working tree is on, with + if it has changes"""
+    try:
+        commit = subprocess.run(["git", "-C", REPO, "rev-parse", "--short", "HEAD"],
+                                stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+        dirty = subprocess.run(["git", "-C", REPO, "status", "--porcelain", "--untracked-files=no"],
+                               stdout=subprocess.PIPE, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if dirty else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an access log against the app")
+    parser.add_argument("--log", help="access log to replay. Made up if not given")
+    parser.add_argument("--requests", type=int, default=20000,
+                        help="requests in the made up log, or how many of --log to replay")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds every stub upstream waits before answering")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="share of upstream requests answered with a 503")
+    parser.add_argument("--mirrors", type=int, default=4)
+    parser.add_argument("--modes", nargs="+", choices=("sync", "async"), default=["sync", "async"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="replay.json", help="where to write the results")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            previous = json.load(file)
+    output = {"date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+              "revision": revision(), "options": vars(args), "modes": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        log = args.log
+        if log is None:
+            log = os.path.join(tmp, "access.log")
+            accesslog.make_log(log, args.requests)
+        entries = accesslog.read_log(log)[:args.requests]
+        print(f"{ len(entries) } requests, { args.concurrency } concurrent, "
+              f"{ args.latency * 1000:.0f} ms upstream latency, "
+              f"{ args.failure_rate * 100:.0f}% upstream failures")
+        stubs = [StubServer(IPInfoHandler, latency=args.latency, fork=True, spread=True,
+                            failure_rate=args.failure_rate)]
+        stubs += [StubServer(MirrorHandler, latency=args.latency, fork=True,
+                             failure_rate=args.failure_rate) for each in range(args.mirrors)]
+        for each in stubs:
+            each.__enter__()
+        try:
+            for mode in args.modes:
+                directory = os.path.join(tmp, mode)
+                os.mkdir(directory)
+                setup(directory, stubs[0].url, [each.url for each in stubs[1:]])
+                port = loadtest.free_port()
+                proc = loadtest.start(mode, directory, port)
+                try:
+                    elapsed, results = asyncio.run(replay(f"http://127.0.0.1:{ port }/",
+                                                          entries, args.concurrency))
+                finally:
+                    loadtest.stop(proc)
+                output["modes"][mode] = summarize(elapsed, results)
+                report(mode, output["modes"][mode],
+                       previous["modes"].get(mode) if previous else None)
+        finally:
+            for each in stubs:
+                each.__exit__()
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    print(f"Results written to { args.output }")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  spatial_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Time the k-d tree against brute force, up to 10k mirrors
+
+For every fleet size, random clients are matched to their closest k
+mirrors, with a random third of the mirrors down, by the k-d tree and by
+ranking every mirror with haversine(). That the answers agree is checked
+by tests/test_spatial.py.
+
+Usage: python3 benchmarks/spatial_bench.py [sizes...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mirrors
+import spatial
+from mirrors_bench import legacy_haversine, make_servers
+
+CLIENTS = 500
+
+
+def brute_force(registry, loc, k, healthy):
+    """The closest `k` healthy mirrors, by checking every one with haversine()"""
+    point = [float(each) for each in loc]
+    ranked = sorted((legacy_haversine(point, [each.lat, each.lon]), index)
+                    for index, each in enumerate(registry.get_mirrors()) if healthy(each.url))
+    return ranked[:k]
+
+
+def main():
+    sizes = [int(each) for each in sys.argv[1:]] or [10, 100, 1000, 10000]
+    random.seed(2)
+    locs = [[f"{ random.uniform(-90, 90):.4f}", f"{ random.uniform(-180, 180):.4f}"]
+            for each in range(CLIENTS)]
+    print(f"{ 'mirrors':>8} { 'build ms':>9} { 'brute us':>9} { 'rank us':>8} { 'tree us':>8} "
+          f"{ 'k=5 us':>7} { 'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = os.path.join(tmp, f"servers-{ size }.json")
+            make_servers(path, size)
+            registry = mirrors.MirrorRegistry(path)
+            registry.refresh()
+            down = {each.url for each in random.sample(registry.mirrors, size // 3)}
+
+            def healthy(url):
+                return url not in down
+
+            start = time.perf_counter()
+            tree = spatial.KDTree(spatial.to_vector(each.lat, each.lon)
+                                  for each in registry.mirrors)
+            build = (time.perf_counter() - start) * 1000
+            calls = locs[:max(20, min(CLIENTS, 200000 // size))]
+            start = time.perf_counter()
+            for loc in calls:
+                brute_force(registry, loc, 5, healthy)
+            brute = (time.perf_counter() - start) / len(calls) * 1000000
+            # every mirror ranked, vectorized if NumPy is installed
+            start = time.perf_counter()
+            for loc in calls:
+                registry.rank(loc)
+            ranked = (time.perf_counter() - start) / len(calls) * 1000000
+            # always through the tree, whatever TREE_THRESHOLD says
+            accept = lambda index: healthy(registry.mirrors[index].url)
+            start = time.perf_counter()
+            for loc in locs:
+                tree.nearest(spatial.to_vector(*loc), 1, accept)
+            single = (time.perf_counter() - start) / len(locs) * 1000000
+            start = time.perf_counter()
+            for loc in calls:
+                tree.nearest(spatial.to_vector(*loc), 5, accept)
+            five = (time.perf_counter() - start) / len(calls) * 1000000
+            print(f"{ size:>8} { build:>9.1f} { brute:>9.1f} { ranked:>8.1f} { single:>8.1f} { five:>7.1f} "
+                  f"{ brute / single:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
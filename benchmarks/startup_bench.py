@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  startup_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Time a cold start: importing download, setting the app up, first redirects
+
+Each run is a fresh interpreter in an empty directory, like a newly forked
+worker with nothing cached. Also counts the processes and files that
+importing download leaves behind. Pass a git revision to compare against
+it, e.g. the commit before the app factory.
+
+Usage: python3 benchmarks/startup_bench.py [runs] [revision]
+"""
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHILD = """
+import json
+import multiprocessing
+import os
+import sys
+import time
+sys.path.insert(0, sys.argv[1])
+before = set(os.listdir("."))
+start = time.perf_counter()
+import download
+imported = time.perf_counter()
+children = len(multiprocessing.active_children())
+files = len(set(os.listdir(".")) - before)
+app = download.create_app() if hasattr(download, "create_app") else download.APP
+ready = time.perf_counter()
+import geoip
+geoip.locate = lambda ip: {"loc": "48.85,2.35", "country": "FR"}
+client = app.test_client()
+client.get("/ISOs/test.txt")
+first = time.perf_counter()
+client.get("/ISOs/test.txt")
+second = time.perf_counter()
+print(json.dumps({"import": imported - start, "create_app": ready - imported,
+                  "first": first - ready, "second": second - first,
+                  "children": children, "files": files}), flush=True)
+# anything started on import isn't ours to wait for. The caller kills it
+os._exit(0)
+"""
+
+
+def run_once(tree):
+    """Cold start the app from `tree` once. Returns the child's measurements, or None"""
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copy(os.path.join(REPO, "servers.json"), directory)
+        shutil.copytree(os.path.join(REPO, "templates"), os.path.join(directory, "templates"))
+        with open(os.path.join(directory, "settings.json"), "w") as file:
+            # nothing on the network, so the numbers are about us
+            json.dump({"ipinfo_fallback": False, "file_meta_crawl_interval": 3600}, file)
+        # a file, not a pipe: anything it started would hold a pipe open forever
+        with open(os.path.join(directory, "output.txt"), "w+") as output:
+            proc = subprocess.Popen([sys.executable, "-c", CHILD, tree], cwd=directory,
+                                    start_new_session=True, stdout=output,
+                                    stderr=subprocess.STDOUT)
+            try:
+                proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                pass
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+            output.seek(0)
+            lines = [each for each in output if each.startswith("{")]
+    if not lines:
+        return None
+    return json.loads(lines[-1])
+
+
+def measure(tree, runs):
+    """Median of every measurement over `runs` cold starts"""
+    results = [each for each in (run_once(tree) for each in range(runs)) if each is not None]
+    if len(results) < runs:
+        print(f"{ runs - len(results) } of { runs } runs failed")
+    return {key: statistics.median(each[key] for each in results) for key in results[0]}
+
+
+def report(name, result):
+    """Print one tree's results"""
+    total = result["import"] + result["create_app"] + result["first"]
+    print(f"{ name:>10}: import { result['import'] * 1000:7.1f} ms, "
+          f"create_app { result['create_app'] * 1000:6.1f} ms, "
+          f"first redirect { result['first'] * 1000:6.1f} ms, "
+          f"second { result['second'] * 1000:5.2f} ms, cold start { total * 1000:7.1f} ms; "
+          f"import started { result['children']:.0f} processes and made { result['files']:.0f} files")
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    report("working", measure(REPO, runs))
+    if len(sys.argv) > 2:
+        with tempfile.TemporaryDirectory() as tree:
+            archive = subprocess.run(["git", "-C", REPO, "archive", sys.argv[2]],
+                                     stdout=subprocess.PIPE, check=True).stdout
+            subprocess.run(["tar", "-x", "-C", tree], input=archive, check=True)
+            report(sys.argv[2][:10], measure(tree, runs))
+
+
+if __name__ == "__main__":
+    main()
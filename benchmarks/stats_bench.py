@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  stats_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Time /stats on synthetic histories of different lengths
+
+For each history: the first render, a repeat hit served from the cached
+page, a conditional hit answered with a 304, a hit right after a new day
+was added, which only folds that day into the rollups, and the API
+queries the page makes for its charts.
+
+Usage: python3 benchmarks/stats_bench.py [years ...]
+"""
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+RUNS = 200
+
+
+def timed(function, runs=RUNS):
+    """Average time of `function()` in ms"""
+    start = time.perf_counter()
+    for each in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    years = [int(each) for each in sys.argv[1:]] or [1, 10, 50]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        shutil.copytree(os.path.join(REPO, "templates"), "templates")
+        import common
+        import download
+        client = download.create_app().test_client()
+        for count in years:
+            start = datetime.date(2000, 1, 1).toordinal()
+            rows = [(start + each, random.randint(0, 500), 0) for each in range(count * 365)]
+            common.get_store().replace(rows)
+            begin = time.perf_counter()
+            response = client.get("/stats")
+            first = (time.perf_counter() - begin) * 1000
+            etag = response.headers["ETag"]
+            cached = timed(lambda: client.get("/stats"))
+            not_modified = timed(lambda: client.get("/stats", headers={"If-None-Match": etag}))
+            day = [start + len(rows)]
+
+            def new_day():
+                common.get_store().add(day[0], 1)
+                day[0] += 1
+                client.get("/stats")
+
+            appended = timed(new_day, 20)
+            end = datetime.date.fromordinal(day[0] - 1)
+            days = f"/stats/api/day?per_page=1000&start={ end - datetime.timedelta(days=89) }&end={ end }"
+            months = f"/stats/api/month?per_page=1000&start={ end - datetime.timedelta(days=729) }&end={ end }"
+            api = timed(lambda: (client.get(days), client.get(months)))
+            size = len(client.get(days).data) + len(client.get(months).data)
+            print(f"{ count:>3} years: first { first:7.2f} ms, cached { cached:5.2f} ms, "
+                  f"304 { not_modified:5.2f} ms, after a new day { appended:5.2f} ms, "
+                  f"page { len(response.data) // 1024 } KiB, "
+                  f"API { api:5.2f} ms for { size // 1024 } KiB")
+        os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  statstore_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare reading long-term stats from the text file and from the store
+
+Usage: python3 benchmarks/statstore_bench.py [years]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import common
+import statstore
+
+RUNS = 20
+
+
+def timed(function, runs=RUNS):
+    """Average time of `function()` in ms"""
+    start = time.perf_counter()
+    for each in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        text = os.path.join(tmp, "longterm.txt")
+        day = datetime.date(2000, 1, 1)
+        lines = []
+        for each in range(years * 365):
+            lines.append(f"{ (day + datetime.timedelta(days=each)).strftime('%B %d %Y') } - "
+                         f"{ random.randint(0, 500) } - { random.random() * 1000:.3f}")
+        with open(text, "w") as file:
+            file.write("\n".join(lines))
+        path = os.path.join(tmp, "stats.bin")
+        start = time.perf_counter()
+        statstore.migrate(text, path)
+        print(f"{ years } years, { len(lines) } days. Migration took "
+              f"{ (time.perf_counter() - start) * 1000:.1f} ms")
+        store = statstore.StatStore(path)
+        last = store.ordinals[-1]
+
+        def parse_text():
+            with open(text, "r") as file:
+                return common.parse_data(file.read())
+
+        def month_text():
+            data = parse_text()
+            return sum(each[1] for each in data if each[0][0] == "June" and each[0][2] == "2005")
+
+        def month_store():
+            start = datetime.date(2005, 6, 1).toordinal()
+            return sum(store.downloads.__getitem__(slice(*store.span(start, start + 29))))
+
+        print(f"parse whole text file:      { timed(parse_text):9.3f} ms")
+        print(f"store, every row as entries:{ timed(store.entries):9.3f} ms")
+        print(f"store, total of every row:  { timed(lambda: sum(store.downloads)):9.3f} ms")
+        print(f"one month total, text:      { timed(month_text):9.3f} ms")
+        print(f"one month total, store:     { timed(month_store, 10000):9.3f} ms")
+        append = timed(lambda: store.add(last + 1, 1, 1), 10000)
+        print(f"add to the last day:        { append:9.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
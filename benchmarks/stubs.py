@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  stubs.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Local stub servers standing in for ipinfo.io and the mirrors"""
+import hashlib
+import http.server
+import json
+import multiprocessing
+import random
+import socket
+import threading
+import time
+
+
+class _QuietHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler that doesn't log every request to stderr"""
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately. Without this, delayed ACKs
+    # add 40 ms to every response
+    disable_nagle_algorithm = True
+    latency = 0.0
+    # share of requests answered with a 503
+    failure_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _failed(self):
+        """Wait out the latency, then maybe fail the request. Returns True if it did"""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return True
+        return False
+
+    def _send(self, body, content_type="application/json"):
+        if self._failed():
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+COUNTRIES = ("US", "DE", "FR", "GB", "BR", "IN", "JP", "AU", "SE", "CA", "RU", "ZA")
+
+
+def place(ip_addr):
+    """Made up but stable location and country for an IPv4 address's /16"""
+    digest = hashlib.blake2b(".".join(ip_addr.split(".")[:2]).encode(), digest_size=4).digest()
+    lat = digest[0] / 255 * 120 - 55
+    lon = int.from_bytes(digest[1:3], "big") / 65535 * 360 - 180
+    return f"{ lat:.4f},{ lon:.4f}", COUNTRIES[digest[3] % len(COUNTRIES)]
+
+
+class IPInfoHandler(_QuietHandler):
+    """Answer /<ip>/json the way ipinfo.io does
+
+    Everyone is in Dallas, unless `spread` is set, in which case every /16
+    gets its own place.
+    """
+    spread = False
+
+    def do_GET(self):
+        ip_addr = self.path.strip("/").split("/")[0]
+        loc, country = place(ip_addr) if self.spread else ("32.9462,-96.7058", "US")
+        body = json.dumps({"ip": ip_addr, "country": country, "loc": loc}).encode()
+        self._send(body)
+
+
+class MirrorHandler(_QuietHandler):
+    """Answer any GET or HEAD like a mirror serving a file of `size` bytes
+
+    Directories (paths ending in /) list `files`, like nginx's autoindex.
+    """
+    size = 2147483648
+    files = ("Drauger_OS-7.6-AMD64.iso", "Drauger_OS-7.6-AMD64.iso.sha256sum")
+
+    def _send_file(self):
+        if self._failed():
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(self.size))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_file()
+
+    def do_GET(self):
+        if self.path.endswith("/"):
+            links = "".join(f'<a href="{ each }">{ each }</a>\n' for each in self.files)
+            self._send(f'<html><body><a href="../">../</a>\n{ links }</body></html>'.encode(),
+                       "text/html")
+            return
+        if self._failed():
+            return
+        # never actually send gigabytes, the body is not what is being tested
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def dead_url():
+    """URL of a local port nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{ port }/"
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    """Threaded HTTP server with a listen backlog big enough for load tests"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubServer:
+    """Run a handler class on a local port in the background
+
+    With `fork` set, the server runs in its own process so it doesn't
+    compete for the GIL with whatever is generating load. Any other keyword
+    arguments override the handler's class attributes, like `failure_rate`.
+    """
+    def __init__(self, handler, latency=0.0, fork=False, **attributes):
+        handler = type(handler.__name__, (handler,), dict(attributes, latency=latency))
+        self.server = _Server(("127.0.0.1", 0), handler)
+        if fork:
+            self.worker = multiprocessing.Process(target=self.server.serve_forever, daemon=True)
+        else:
+            self.worker = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Base URL of the server, with trailing slash"""
+        return f"http://127.0.0.1:{ self.server.server_address[1] }/"
+
+    def __enter__(self):
+        self.worker.start()
+        return self
+
+    def __exit__(self, *args):
+        if isinstance(self.worker, multiprocessing.Process):
+            self.worker.terminate()
+            self.worker.join()
+        else:
+            self.server.shutdown()
+        self.server.server_close()
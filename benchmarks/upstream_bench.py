@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  upstream_bench.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare a new PoolManager per request with the shared upstream pool
+
+Also times a run of requests against an upstream that never answers, to
+show the circuit breaker cutting them off after a few timeouts.
+
+Usage: python3 benchmarks/upstream_bench.py [requests]
+"""
+import os
+import sys
+import time
+import urllib3
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import upstream
+from stubs import MirrorHandler, StubServer
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with StubServer(MirrorHandler) as mirror:
+        url = mirror.url + "ISOs/test.iso"
+        start = time.perf_counter()
+        for each in range(requests):
+            urllib3.PoolManager().request("HEAD", url)
+        fresh = time.perf_counter() - start
+        start = time.perf_counter()
+        for each in range(requests):
+            upstream.request("HEAD", url)
+        shared = time.perf_counter() - start
+        print(f"new pool per request: { fresh / requests * 1000:.3f} ms per request")
+        print(f"shared pool:          { shared / requests * 1000:.3f} ms per request")
+        print(f"shared pool stats: { upstream.stats() }")
+    with StubServer(MirrorHandler, latency=10) as slow:
+        config = upstream.get_config("127.0.0.1")
+        start = time.perf_counter()
+        rejected = 0
+        for each in range(20):
+            try:
+                upstream.request("HEAD", slow.url + "ISOs/test.iso", timeout=0.2, retries=False)
+            except upstream.CircuitOpen:
+                rejected += 1
+            except urllib3.exceptions.HTTPError:
+                pass
+        elapsed = time.perf_counter() - start
+        print(f"20 requests to a hung upstream with a 0.2s timeout: { elapsed:.2f}s, "
+              f"{ rejected } rejected by the breaker (opens after { config['failures'] } failures)")
+
+
+if __name__ == "__main__":
+    main()
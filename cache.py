@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""TTL + LRU cache shared between worker processes
+
+Entries live in an SQLite database so every uWSGI worker sees the same
+cache. Each entry has its own expiry time and the least recently used
+entries are evicted once the cache grows past its size limit.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# how often, in seconds, per-process counters are written to the shared stats
+STATS_INTERVAL = 5
+# how many sets to allow between size checks
+EVICT_INTERVAL = 64
+# most hits to remember before their last-used times are written out early
+TOUCH_BATCH = 1024
+
+
+class SharedCache:
+    """Bounded, file-backed key/value cache with per-entry TTLs"""
+    def __init__(self, path, size=100000, ttl=3600):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        # one connection per thread, opened again in a forked child
+        self.local = threading.local()
+        # the schema is only created once per process
+        self.pid = None
+        self.lock = threading.Lock()
+        self.sets = 0
+        self.pending = {"hits": 0, "misses": 0, "evictions": 0}
+        # key: when it was last hit, not yet written to the database
+        self.touched = {}
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        # what stats() returns if the database is busy
+        self.last_stats = {"hits": 0, "misses": 0, "evictions": 0, "entries": 0}
+
+    def __connect__(self):
+        """Get this thread's connection
+
+        SQLite connections can't cross a fork, and aren't safe to share
+        between threads, so every thread of every process opens its own.
+        """
+        local = self.local
+        if getattr(local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if self.pid != os.getpid():
+                with self.lock:
+                    if self.pid != os.getpid():
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                            key TEXT PRIMARY KEY, value TEXT,
+                                            expires REAL, used REAL)""")
+                        conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+                        conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                                            name TEXT PRIMARY KEY, value INTEGER)""")
+                        self.pid = os.getpid()
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def __count__(self, name, amount=1):
+        """Bump a counter, writing counters out every STATS_INTERVAL seconds"""
+        self.pending[name] += amount
+        if time.monotonic() - self.last_flush >= STATS_INTERVAL or \
+           len(self.touched) >= TOUCH_BATCH:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Add this process's counters into the shared stats table
+
+        Last-used times of entries hit since the last flush go out with
+        them. If the database is busy, everything is kept for next time.
+        """
+        # another thread is already at it
+        if not self.flush_lock.acquire(blocking=False):
+            return
+        try:
+            self.__flush__()
+        finally:
+            self.flush_lock.release()
+
+    def __flush__(self):
+        """flush_stats(), with the lock held"""
+        conn = self.__connect__()
+        self.last_flush = time.monotonic()
+        pending = [(name, value) for name, value in self.pending.items() if value]
+        touched = [(used, key) for key, used in list(self.touched.items())]
+        if not pending and not touched:
+            return
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("""INSERT INTO stats VALUES (?, ?) ON CONFLICT(name)
+                                    DO UPDATE SET value = value + excluded.value""", pending)
+                conn.executemany("UPDATE entries SET used = max(used, ?) WHERE key = ?", touched)
+                conn.execute("COMMIT")
+            except sqlite3.OperationalError:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as error:
+            print(f"Cache error: { error }")
+            return
+        for name, value in pending:
+            self.pending[name] -= value
+        for used, key in touched:
+            if self.touched.get(key) == used:
+                self.touched.pop(key, None)
+
+    def get(self, key):
+        """Get the value stored under `key`, or None if it is missing or stale"""
+        conn = self.__connect__()
+        now = time.time()
+        try:
+            row = conn.execute("SELECT value, expires FROM entries WHERE key = ?",
+                               (key,)).fetchone()
+        except sqlite3.OperationalError as error:
+            # A locked or broken cache should never break a redirect
+            print(f"Cache error: { error }")
+            return None
+        if row is None or row[1] < now:
+            self.__count__("misses")
+            return None
+        # written out with the counters, rather than an UPDATE on every hit
+        self.touched[key] = now
+        self.__count__("hits")
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key` for `ttl` seconds"""
+        if ttl is None:
+            ttl = self.ttl
+        conn = self.__connect__()
+        now = time.time()
+        try:
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                         (key, json.dumps(value), now + ttl, now))
+            self.sets += 1
+            if self.sets % EVICT_INTERVAL == 0:
+                self.evict()
+        except sqlite3.OperationalError as error:
+            print(f"Cache error: { error }")
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones over the limit"""
+        self.flush_stats()
+        conn = self.__connect__()
+        conn.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+        over = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.size
+        if over > 0:
+            conn.execute("""DELETE FROM entries WHERE key IN
+                            (SELECT key FROM entries ORDER BY used LIMIT ?)""", (over,))
+            self.__count__("evictions", over)
+
+    def stats(self):
+        """Get hit, miss and eviction counts across all processes"""
+        self.flush_stats()
+        conn = self.__connect__()
+        output = {"hits": 0, "misses": 0, "evictions": 0}
+        try:
+            output.update(conn.execute("SELECT name, value FROM stats").fetchall())
+            output["entries"] = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        except sqlite3.OperationalError as error:
+            # counters going back to 0 would look like a restart, so the last ones it got
+            print(f"Cache error: { error }")
+            return dict(self.last_stats)
+        self.last_stats = output
+        return dict(output)
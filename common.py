@@ -22,26 +22,132 @@
 #
 #
 """Common functions"""
+import fcntl
+import json
 import os
+import time
+import statstore
 
 CURRENT_COUNT_FILE = "daily_count.txt"
 LONG_TERM_COUNT_FILE = "download_count_longterm.txt"
+SETTINGS_FILE = "settings.json"
+SETTINGS = {"mtime": None, "data": {}, "checked": None}
+# how often, in seconds, settings.json is checked for changes
+SETTINGS_INTERVAL = 1
+STORE = None
+
+
+def get_setting(key, default=None):
+    """Get a value from settings.json, re-reading it only when it changes
+
+    It is checked for changes at most every SETTINGS_INTERVAL seconds,
+    rather than stat()ed on every call.
+    """
+    now = time.monotonic()
+    if SETTINGS["checked"] is None or now - SETTINGS["checked"] >= SETTINGS_INTERVAL:
+        SETTINGS["checked"] = now
+        __load_settings__()
+    return SETTINGS["data"].get(key, default)
+
+
+def __load_settings__():
+    """Re-read settings.json if it has changed since we last did"""
+    try:
+        mtime = os.stat(SETTINGS_FILE).st_mtime
+    except (FileNotFoundError, PermissionError):
+        SETTINGS["data"] = {}
+        SETTINGS["mtime"] = None
+        return
+    if mtime != SETTINGS["mtime"]:
+        try:
+            with open(SETTINGS_FILE, "r") as file:
+                data = json.load(file)
+        except ValueError:
+            print(f"{ SETTINGS_FILE } is not valid JSON. Using defaults...")
+            data = {}
+        SETTINGS["data"] = data
+        SETTINGS["mtime"] = mtime
+
+
+def reload_settings():
+    """Check settings.json again on the next get_setting(), for when it was just written"""
+    SETTINGS["mtime"] = None
+    SETTINGS["checked"] = None
+
+
+def pid_alive(pid):
+    """Whether a process exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def parse_line(line):
+    """Parse one line of a data file: [[month, day, year], count] with GB on the end if present"""
+    fields = line.split(" - ")
+    entry = [fields[0].split(" "), int(fields[1])]
+    if len(fields) > 2:
+        entry.append(float(fields[2]))
+    return entry
+
+
+def format_line(entry):
+    """Inverse of parse_line()"""
+    if len(entry) > 2:
+        return f"{ ' '.join(entry[0]) } - { entry[1] } - { entry[2]:.3f}"
+    return f"{ ' '.join(entry[0]) } - { entry[1] }"
+
 
 def parse_data(data):
     """Parse data file text"""
-    data_parsed = data.split("\n")
-    for each in range(len(data_parsed) - 1, -1, -1):
-        if data_parsed[each] == "":
-            del data_parsed[each]
-            continue
-        data_parsed[each] = data_parsed[each].split(" - ")
-        data_parsed[each][1] = int(data_parsed[each][1])
-        data_parsed[each][0] = data_parsed[each][0].split(" ")
-    return data_parsed
+    return [parse_line(each) for each in data.split("\n") if each != ""]
+
+
+def iter_data_file(file):
+    """Parse a data file one line at a time"""
+    with open(file, "r") as contents:
+        for line in contents:
+            line = line.rstrip("\n")
+            if line != "":
+                yield parse_line(line)
+
+
+def get_store():
+    """Get the long-term statistics store, building it from the text files the first time
+
+    maintenance.py builds it on startup. If a worker gets here first, an
+    flock makes sure only one process builds it, and nobody writes to it
+    until it is done.
+    """
+    global STORE
+    if STORE is None:
+        if not os.path.exists(statstore.STATS_STORE_FILE):
+            fd = os.open(f"{ statstore.STATS_STORE_FILE }.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # someone else may have built it while we waited
+                if not os.path.exists(statstore.STATS_STORE_FILE):
+                    print(f"Building { statstore.STATS_STORE_FILE } from { LONG_TERM_COUNT_FILE } and archives...")
+                    statstore.migrate(LONG_TERM_COUNT_FILE)
+            finally:
+                # closing it lets go of the lock
+                os.close(fd)
+        STORE = statstore.StatStore()
+    return STORE
 
 
 def parse_data_file(file):
-    """Parse data file"""
+    """Parse data file
+
+    The long-term count file is read from the statistics store, which has
+    every day, archived or not.
+    """
+    if file == LONG_TERM_COUNT_FILE:
+        return get_store().entries()
     try:
         with open(file, "r") as contents:
             return parse_data(contents.read())
@@ -51,13 +157,38 @@ def parse_data_file(file):
 
 
 def write_data_file(file, write=""):
-    """Append data to data file"""
+    """Append data to data file
+
+    Entries for the long-term count file go into the statistics store too.
+    """
+    if file == LONG_TERM_COUNT_FILE and write != "":
+        size = round(write[2] * statstore.GB) if len(write) > 2 else 0
+        get_store().add(statstore.to_ordinal(write[0]), write[1], size)
     if not os.path.exists(file):
         with open(file, "w") as file:
             if write == "":
                 file.write("")
             else:
-                file.write(f"{ ' '.join(write[0]) } - { write[1] }")
+                file.write(format_line(write))
     else:
         with open(file, "a") as file:
-            file.write(f"\n{ ' '.join(write[0]) } - { write[1] }")
+            file.write(f"\n{ format_line(write) }")
+
+
+def init_data_files():
+    """Make the download count files if they don't exist yet"""
+    if not os.path.exists(CURRENT_COUNT_FILE):
+        with open(CURRENT_COUNT_FILE, "w") as file:
+            file.write("0,0")
+    if not os.path.exists(LONG_TERM_COUNT_FILE):
+        write_data_file(LONG_TERM_COUNT_FILE)
+
+
+def replace_data_file(file, entries):
+    """Atomically replace a data file with `entries`"""
+    tmp = f"{ file }.{ os.getpid() }.tmp"
+    with open(tmp, "w") as contents:
+        contents.write("\n".join(format_line(each) for each in entries))
+        contents.flush()
+        os.fsync(contents.fileno())
+    os.replace(tmp, file)
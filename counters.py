@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  counters.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Sharded download counters in shared memory
+
+Every thread of every worker gets its own slot in a small memory-mapped
+file, so counting a download is a plain add to memory nothing else writes
+to: no lock, no syscall. Slots only ever go up. The aggregator remembers,
+per slot, how much it has already collected, so collecting is a matter of
+summing the differences and moving those marks forward.
+
+Counts that haven't been collected yet survive a restart, since they live
+in the file, not in the workers.
+"""
+import fcntl
+import mmap
+import os
+import threading
+import common
+
+COUNTERS_FILE = "download_counters.bin"
+MAGIC = 0x5443_4e54_4f44  # "DOTNCT"
+VERSION = 1
+# 64 bit words before the first slot
+HEADER_WORDS = 8
+# slot 0 is shared, under the file lock, by anyone who can't get a slot of their own
+OVERFLOW = 0
+# os.getpid() is a syscall, and add() is on the request path
+PID = os.getpid()
+
+
+class CounterTable:
+    """Monotonic counters, one shard per thread, with delta collection
+
+    Each slot holds the owner's pid and thread id, the live value of each
+    field, then the value of each field as of the last collect(). Slots are
+    padded to 64 bytes so two threads never write the same cache line.
+    """
+    def __init__(self, path=COUNTERS_FILE, fields=("downloads", "bytes"), slots=256):
+        self.path = path
+        self.fields = tuple(fields)
+        self.slots = slots
+        self.width = -(-(2 + (2 * len(self.fields))) // 8) * 8
+        self.local = threading.local()
+        self.lock = None
+        self.lock_pid = None
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = (HEADER_WORDS + (self.width * slots)) * 8
+        with self.__locked__():
+            if os.fstat(self.fd).st_size != size or not self.__valid__():
+                print(f"Creating new counter table at { path }...")
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                self.mmap = mmap.mmap(self.fd, size)
+                self.words = memoryview(self.mmap).cast("Q")
+                self.words[1] = VERSION
+                self.words[2] = len(self.fields)
+                self.words[3] = slots
+                # magic last, so a half-written header is never taken as valid
+                self.words[0] = MAGIC
+            else:
+                self.mmap = mmap.mmap(self.fd, size)
+                self.words = memoryview(self.mmap).cast("Q")
+
+    def __valid__(self):
+        """Whether the file on disk has the layout we expect"""
+        header = os.pread(self.fd, 32, 0)
+        if len(header) != 32:
+            return False
+        header = memoryview(header).cast("Q")
+        return tuple(header) == (MAGIC, VERSION, len(self.fields), self.slots)
+
+    def __locked__(self):
+        """Context manager holding the table lock, across processes and threads"""
+        if self.lock_pid != os.getpid():
+            # flock() doesn't exclude anyone sharing our file descriptor,
+            # which includes anything we forked, so every process opens its own
+            self.lock = _FileLock(os.open(self.path, os.O_RDWR))
+            self.lock_pid = os.getpid()
+        return self.lock
+
+    def __base__(self, slot):
+        """Index of a slot's first word"""
+        return HEADER_WORDS + (slot * self.width)
+
+    def __claim__(self):
+        """Find this thread a free slot. Returns its index, or OVERFLOW"""
+        pid = os.getpid()
+        tid = threading.get_native_id()
+        live = {each.native_id for each in threading.enumerate()}
+        with self.__locked__():
+            for slot in range(1, self.slots):
+                base = self.__base__(slot)
+                owner = self.words[base]
+                if owner == pid and self.words[base + 1] not in live:
+                    # a thread of ours that has exited
+                    pass
+                elif owner != 0 and common.pid_alive(owner):
+                    continue
+                # values are left as they are. Whatever the last owner
+                # counted and nobody has collected yet is still owed
+                self.words[base + 1] = tid
+                self.words[base] = pid
+                return slot
+        print(f"WARNING: All { self.slots } counter slots in use. Sharing one...")
+        return OVERFLOW
+
+    def __slot__(self):
+        """Get the index of this thread's first field"""
+        local = self.local
+        if getattr(local, "pid", None) != PID:
+            # new thread, or the thread we were forked from
+            local.slot = self.__claim__()
+            local.base = self.__base__(local.slot) + 2
+            local.pid = PID
+        return local.base
+
+    def add(self, *amounts):
+        """Add `amounts` to this thread's counters, in the order of `fields`"""
+        base = self.__slot__()
+        words = self.words
+        if self.local.slot == OVERFLOW:
+            with self.__locked__():
+                for amount in amounts:
+                    words[base] += amount
+                    base += 1
+            return
+        for amount in amounts:
+            words[base] += amount
+            base += 1
+
+    def add_at(self, *pairs):
+        """Add to fields by their index in `fields`, as (index, amount) pairs"""
+        base = self.__slot__()
+        words = self.words
+        if self.local.slot == OVERFLOW:
+            with self.__locked__():
+                for index, amount in pairs:
+                    words[base + index] += amount
+            return
+        for index, amount in pairs:
+            words[base + index] += amount
+
+    def __deltas__(self, commit):
+        """Sum what hasn't been collected, moving the marks up if `commit`"""
+        fields = len(self.fields)
+        totals = [0] * fields
+        for slot in range(self.slots):
+            base = self.__base__(slot) + 2
+            for index in range(fields):
+                # read once. The owner may bump it again before we're done
+                value = self.words[base + index]
+                totals[index] += value - self.words[base + fields + index]
+                if commit:
+                    self.words[base + fields + index] = value
+        return tuple(totals)
+
+    def collect(self):
+        """Take everything counted since the last collect(), across all processes
+
+        Only one process can collect at a time, and every increment is
+        returned by exactly one collect().
+        """
+        with self.__locked__():
+            return self.__deltas__(True)
+
+    def pending(self):
+        """Everything counted since the last collect(), without taking it"""
+        return self.__deltas__(False)
+
+    def totals(self):
+        """Everything ever counted in this table"""
+        fields = len(self.fields)
+        totals = [0] * fields
+        for slot in range(self.slots):
+            base = self.__base__(slot) + 2
+            for index in range(fields):
+                totals[index] += self.words[base + index]
+        return tuple(totals)
+
+
+class _FileLock:
+    """flock() held for the length of a with block
+
+    flock() doesn't exclude other threads of the same process, so a thread
+    lock is taken first.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+def __forked__():
+    """Keep PID right in a forked child"""
+    global PID
+    PID = os.getpid()
+
+
+os.register_at_fork(after_in_child=__forked__)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  decisions.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Redirect decision cache
+
+Which mirrors a client may be sent to only depends on roughly where it is,
+what part of the site it asked for, the mirror list and which mirrors are
+up. So decisions are cached per process, keyed by a grid cell of
+`decision_cell_degrees` and the first part of the path, and every decision
+for a cell is made from the middle of that cell. Everything cached is
+thrown out when servers.json is reloaded, a mirror changes state or
+settings.json changes.
+
+Hit, miss, invalidation and eviction counts are kept in a counter table
+shared by every worker.
+"""
+import collections
+import math
+import threading
+import time
+import common
+import counters
+
+DECISION_COUNTERS_FILE = "decision_counters.bin"
+FIELDS = ("hits", "misses", "invalidations", "evictions")
+
+
+class DecisionCache:
+    """Bounded, per-process LRU of (cell, path prefix) -> decision, with a TTL"""
+    def __init__(self, registry, health_table, path=DECISION_COUNTERS_FILE, check_interval=1):
+        self.registry = registry
+        self.health = health_table
+        self.check_interval = check_interval
+        # key: (expires, decision), least recently used first
+        self.entries = collections.OrderedDict()
+        self.state = None
+        # bumped whenever entries are thrown out
+        self.epoch = 0
+        self.last_check = None
+        self.config = (0, 0.5, 300)
+        self.lock = threading.Lock()
+        self.counters = counters.CounterTable(path, fields=FIELDS, slots=64)
+
+    def refresh(self):
+        """Re-read settings and throw everything out if the mirrors changed
+
+        Done at most every `check_interval` seconds, so a hit costs no more
+        than a dictionary lookup.
+        """
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        self.config = (common.get_setting("decision_cache_size", 10000),
+                       common.get_setting("decision_cell_degrees", 0.5),
+                       common.get_setting("decision_cache_ttl", 300))
+        self.registry.refresh()
+        # a stale health table means every mirror counts as up, and any
+        # change to settings.json may change how mirrors are picked
+        state = (self.registry.version, self.health.generation, self.health.is_stale(),
+                 common.SETTINGS["mtime"])
+        with self.lock:
+            if state != self.state:
+                if self.entries:
+                    self.counters.add(0, 0, 1)
+                self.entries.clear()
+                self.epoch += 1
+                self.state = state
+
+    def cell(self, loc):
+        """Get the grid cell a (lat, lon) pair is in"""
+        size = self.config[1]
+        return (math.floor(float(loc[0]) / size), math.floor(float(loc[1]) / size))
+
+    def get(self, loc, path, decide):
+        """Get the decision for a client at `loc` asking for `path`
+
+        `decide(loc)` makes the decision when nothing is cached for the cell.
+        It is given the middle of the cell, so every client in the cell gets
+        the same answer, cached or not.
+        """
+        self.refresh()
+        size, degrees, ttl = self.config
+        if size <= 0:
+            return decide(loc)
+        cell = self.cell(loc)
+        key = (cell, path.split("/", 1)[0])
+        now = time.monotonic()
+        with self.lock:
+            epoch = self.epoch
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.counters.add(1)
+                return entry[1]
+        decision = decide([(cell[0] + 0.5) * degrees, (cell[1] + 0.5) * degrees])
+        evicted = 0
+        with self.lock:
+            # don't cache anything decided on before a reload
+            if epoch == self.epoch:
+                self.entries[key] = (now + ttl, decision)
+                self.entries.move_to_end(key)
+                while len(self.entries) > size:
+                    self.entries.popitem(last=False)
+                    evicted += 1
+        self.counters.add(0, 1, 0, evicted)
+        return decision
+
+    def stats(self):
+        """Hit, miss, invalidation and eviction counts across every worker"""
+        output = dict(zip(FIELDS, self.counters.totals()))
+        lookups = output["hits"] + output["misses"]
+        output["hit_ratio"] = output["hits"] / lookups if lookups else None
+        output["entries"] = len(self.entries)
+        return output
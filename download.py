@@ -22,17 +22,29 @@
 #
 #
 """Redirect to the server closest to you for the fastest downloads!"""
+import datetime
+import functools
 import json
-import multiprocessing
-import os
+import random
 import sys
+import threading
 import time
-import math
-from flask import Flask, request, redirect, render_template, send_from_directory, url_for
-import urllib3
+from flask import Flask, request, redirect, render_template, send_from_directory, url_for, make_response
+import analytics
 import archive
-import random as rand
 import common
+import counters
+import decisions
+import eventlog
+import filemeta
+import geoip
+import health
+import latency
+import metrics
+import mirrors
+import policy
+import stats
+import upstream
 
 MODE = False
 if __name__ == "__main__":
@@ -40,152 +52,83 @@ if __name__ == "__main__":
         MODE = True
 
 
-def haversine(point_1, point_2, units="km"):
-    """
-    Calculate the great circle distance in kilometers between two points
-    on the earth (specified in decimal degrees)
-    """
-    # convert decimal degrees to radians
-    lat1, lon1 = point_1
-    lat2, lon2 = point_2
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
-
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    # Radius of earth in kilometers. Use 3956 for miles. Determines return value units.
-    if units.lower() in ("k", "km", "kilo", "kilometers", "kilometer", "metric"):
-        r = 6371
-    elif units.lower() in ("m", "mi", "miles", "mile", "imperial"):
-        r = 3956
-    return c * r
-
-
-IPINFO = ["https://ipinfo.io/", "/json"]
 APP = Flask(__name__)
 START_TIME = time.time()
+REGISTRY = mirrors.MirrorRegistry()
+HEALTH = health.HealthTable()
+STATS = stats.StatsEngine()
+# downloads and bytes served, shared by every worker, the redirect decision
+# cache and measured latencies. All open files, so they're made on first use
+COUNTERS = None
+DECISIONS = None
+LATENCY = None
+SOURCES = None
+LOCK = threading.Lock()
+
+
+def create_app():
+    """Get the app ready to serve, and return it
+
+    Nothing is started in the background. The event log compactor, the
+    health checker and the crawler all belong to maintenance.py, which is
+    run once next to the app.
+    """
+    global START_TIME
+    START_TIME = time.time()
+    common.init_data_files()
+    return APP
 
-# Multithreading stuffs
-LOCK = multiprocessing.Lock()
-COUNTER = multiprocessing.RawValue("i", 0)
-DATA_COUNTER = multiprocessing.RawValue("L", 0)
 
-if not os.path.exists(common.CURRENT_COUNT_FILE):
-    with open(common.CURRENT_COUNT_FILE, "w") as file:
-        file.write("0,0")
+def get_counters():
+    """Get the shared download counters"""
+    global COUNTERS
+    if COUNTERS is None:
+        with LOCK:
+            if COUNTERS is None:
+                COUNTERS = counters.CounterTable()
+    return COUNTERS
+
 
-if not os.path.exists(common.LONG_TERM_COUNT_FILE):
-    common.write_data_file(common.LONG_TERM_COUNT_FILE)
+def get_decisions():
+    """Get this process's redirect decision cache"""
+    global DECISIONS
+    if DECISIONS is None:
+        with LOCK:
+            if DECISIONS is None:
+                DECISIONS = decisions.DecisionCache(REGISTRY, HEALTH)
+    return DECISIONS
 
 
-def update_download_count():
-    """periodically update stored download count"""
-    global COUNTER, DATA_COUNTER, LOCK
-    while True:
-        # We dont have to be fast about this since this process is quick as it is
-        time.sleep(900)
+def get_latency_table():
+    """Get the latencies clients have reported to the mirrors"""
+    global LATENCY
+    if LATENCY is None:
         with LOCK:
-            with open(common.CURRENT_COUNT_FILE, "r") as file:
-                values = file.read().split(',')
-            count = values[0]
-            print("values: " + str(values))
-            data_count = values[1]
-            try:
-                count = int(count)
-                data_count = float(data_count)
-            except ValueError:
-                count = 0
-                data_count = 0
-
-            count = count + COUNTER.value
-            data_count = data_count + DATA_COUNTER.value / 1024 # converting the data counter MB value into GB rounded to the 3rds place
-            COUNTER.value = 0
-            DATA_COUNTER.value = 0
-            with open(common.CURRENT_COUNT_FILE, "w") as file:
-                file.write(f"{count},{data_count}")
-        # At this point the multitreading-sensitive stuff is done, so release the lock
-        hour = time.localtime()[3]
-        if hour == 0:
-            # we didn't delete the `count` var. So we can reuse that.
-            # also, log download counts in multiple places in case of data corruption.
-            # we need to backdate the download count by a day since we commit the data to long-term storage
-            # the day after it is collected
-            date = time.time() - 86400
-            date = time.localtime(date)
-            date = time.strftime("%B %d %Y", date).split(" ")
-            common.write_data_file(common.LONG_TERM_COUNT_FILE, write=[date, count, data_count])
-            with open(common.CURRENT_COUNT_FILE, "w") as file:
-                file.write("0,0")
-            print(f"Download count for { date }: { count }, { data_count } GB")
-            dedup_entries()
-            archive.create_archive()
-
-
-def dedup_entries():
-    """Deduplicate download count entries"""
-    data = common.parse_data_file(common.LONG_TERM_COUNT_FILE)
-    result = []
-    for each in enumerate(data):
-        add = []
-        for each1 in enumerate(data):
-            if each[1][0] == each1[1][0]:
-                if add == []:
-                    sentenal = False
-                    for each2 in result:
-                        if each[1][0] == each2[0]:
-                            sentenal = True
-                            break
-                    if sentenal:
-                        continue
-                    if each[0] == each1[0]:
-                        add = [each[1][0], each[1][1]]
-                    else:
-                        add = [each[1][0], (each[1][1] + each1[1][1])]
-                elif add[0] == each[1][0]:
-                    add[1] = add[1] + each1[1][1]
-                else:
-                    sentenal = False
-                    for each2 in result:
-                        if each[1][0] == each2[0]:
-                            sentenal = True
-                            break
-                    if sentenal:
-                        continue
-                    if each[0] == each1[0]:
-                        add = [each[1][0], each[1][1]]
-                    else:
-                        add = [each[1][0], (each[1][1] + each1[1][1])]
-        if add != []:
-            result.append(add)
-    os.remove(common.LONG_TERM_COUNT_FILE)
-    for each in result:
-        common.write_data_file(common.LONG_TERM_COUNT_FILE, write=each)
+            if LATENCY is None:
+                LATENCY = latency.LatencyTable()
+    return LATENCY
 
 
-@APP.route("/<path:path>")
-def get_url(path, mode=MODE):
-    """get IP address of client and return optimal URL for user"""
-    # I know this is really bad to do but it works so meh?
-    global COUNTER, DATA_COUNTER, LOCK
-    # todo: set DATA_COUNTER to 0 at some point before using
-    # get ip address
-    # I know this is non-standard but with the reverse proxy we use it works
-    if mode:
-        ip_addr = request.remote_addr
-    else:
-        ip_addr = request.host
-    http = urllib3.PoolManager()
-    backup = {"country": "US", "loc": "0,0"}
-    try:
-        data = http.request("GET", str(ip_addr).join(IPINFO)).data
-    except urllib3.exceptions.MaxRetryError:
-        print("No internet access. In testing?")
-        print("Assuming IP is bogon...")
-        data = '{"bogon": true}'
-    data = json.loads(data)
+def get_beacon_sources():
+    """Get when each client last sent a beacon about each mirror"""
+    global SOURCES
+    if SOURCES is None:
+        with LOCK:
+            if SOURCES is None:
+                SOURCES = latency.LatencyTable(latency.SOURCES_FILE,
+                                               common.get_setting("latency_beacon_sources", 65536))
+    return SOURCES
+
+
+def count_data(meta, server, path, country):
+    """Count a file's size, once its metadata has been fetched"""
+    get_counters().add(0, meta["size"])
+    eventlog.log(path, meta["size"], server, country, downloads=0)
+
 
+def parse_location(data, ip_addr):
+    """Turn ipinfo-style data into a [lat, lon] pair of strings"""
+    backup = {"country": "US", "loc": "0,0"}
     # This should only be triggered during local development
     if (("bogon" in data) or ("error" in data)):
         try:
@@ -198,236 +141,306 @@ def get_url(path, mode=MODE):
     # doing it this way saves us having to do an if statement, and therefore
     # fewer lines of code, and potentially not missing a branch prediction
     try:
-        data["loc"] = data["loc"].split(",")
+        return data["loc"].split(",")
     except KeyError:
         print(f"ERROR PARSING LOCATION FOR IP ADDRESS: { ip_addr }")
         print(f"Returned info from ipinfo.io:\n{ json.dumps(data, indent=2) }\n")
         print("Assuming location of 0,0...")
-        data["loc"] = ["0", "0"]
-    server = get_optimal_server(data["loc"])
+        return ["0", "0"]
+
 
-    # Get the Content-Length header from the response, which contains the file size in bytes
-    file_info = http.request("HEAD", server + path)
-    file_size_bytes = file_info.headers.get('Content-Length', 0)
-    file_size = str(int(file_size_bytes) // 1048576) #convert from bytes to MB
+def count_download(server, path, country=None, fetch=filemeta.fetch_async):
+    """Count a download, if it is one we count
 
+    `fetch(server, path, callback)` is used to look up the file size
+    when it isn't cached. With `fetch` None, the size isn't looked up.
+    """
     # Only count ISO downloads, but not DEV ISOs as those are super informal
     if ((path[-4:] == ".iso") and ("DEV" not in path)):
-        with LOCK:
-            COUNTER.value += 1
-            DATA_COUNTER.value += int(file_size)
+        meta = filemeta.get(path)
+        if meta is None:
+            get_counters().add(1)
+            eventlog.log(path, 0, server, country)
+            if fetch is None:
+                return
+            # don't make the user wait on a HEAD. Count the data once we know the size
+            fetch(server, path, functools.partial(count_data, server=server, path=path,
+                                                  country=country))
+        else:
+            get_counters().add(1, meta["size"])
+            eventlog.log(path, meta["size"], server, country)
+
+
+def get_client_ip(mode=MODE):
+    """get IP address of client"""
+    # I know this is non-standard but with the reverse proxy we use it works
+    if mode:
+        return request.remote_addr
+    return request.host
+
+
+@APP.route("/<path:path>")
+def get_url(path, mode=MODE):
+    """get IP address of client and return optimal URL for user"""
+    ip_addr = get_client_ip(mode)
+    start = time.perf_counter()
+    data = geoip.locate(ip_addr)
+    located = time.perf_counter()
+    loc = parse_location(data, ip_addr)
+    server = get_optimal_server(loc, path)
+    chosen = time.perf_counter()
+    count_download(server, path, data.get("country"))
+    done = time.perf_counter()
+    metrics.observe("geo", located - start)
+    metrics.observe("count", done - chosen)
+    metrics.observe("total", done - start)
     return redirect(server + path)
 
 
+@APP.errorhandler(mirrors.NoMirrors)
+def no_mirrors(error):
+    """Nowhere to send anyone until a mirror list loads"""
+    print(f"ERROR: { error }")
+    return {"error": "no mirrors available, try again later"}, 503
+
+
 @APP.route("/")
 def get_url_blank():
     """Handle the root directory of the mirrors"""
     return get_url("")
 
 
-def get_optimal_server(loc):
+@APP.route("/plan", methods=["GET", "POST"])
+def get_plan(mode=MODE):
+    """Pick a mirror for several files at once
+
+    Takes the paths as `path` query parameters, or as {"paths": [...]} in a
+    JSON body. The client is located and the mirrors ranked once. Every
+    file gets the same mirror, the mirrors to fall back on in order, and
+    its size, ETag and Last-Modified if they are known. ISOs are counted
+    as downloads, just like a redirect.
+    """
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        paths = body.get("paths") if isinstance(body, dict) else None
+    else:
+        paths = request.args.getlist("path")
+    limit = common.get_setting("plan_max_paths", 50)
+    if not isinstance(paths, list) or not 0 < len(paths) <= limit or \
+       not all(isinstance(each, str) for each in paths):
+        return {"error": f"give from 1 to { limit } paths"}, 400
+    ip_addr = get_client_ip(mode)
+    start = time.perf_counter()
+    data = geoip.locate(ip_addr)
+    metrics.observe("geo", time.perf_counter() - start)
+    loc = parse_location(data, ip_addr)
+    server = get_optimal_server(loc, paths[0].lstrip("/"))
+    fallbacks = get_fallbacks(loc, server)
+    files = []
+    for path in paths:
+        path = path.lstrip("/")
+        # only what the crawl or an earlier download already found. Looking up
+        # anything a client cares to send would have the mirrors HEAD it all
+        meta = filemeta.get(path)
+        count_download(server, path, data.get("country"), fetch=None)
+        meta = meta or {}
+        files.append({"path": path, "url": server + path,
+                      "fallbacks": [each + path for each in fallbacks],
+                      "size": meta.get("size"), "etag": meta.get("etag"),
+                      "last_modified": meta.get("last_modified")})
+    return {"mirror": server, "fallbacks": fallbacks, "files": files}
+
+
+def get_fallbacks(loc, server):
+    """Mirrors to try, in order, if `server` doesn't work out"""
+    count = common.get_setting("plan_fallbacks", 3)
+    if loc == ["0", "0"]:
+        # nowhere in particular, so no order is better than any other
+        urls = [each.url for each in REGISTRY.get_mirrors()]
+        random.shuffle(urls)
+    else:
+        urls = REGISTRY.nearest(loc, count + 1, HEALTH.is_up)
+    return [each for each in urls if each != server][:count]
+
+
+def get_optimal_server(loc, path=""):
     """Get optimal server for location"""
-    # Get our server list
-    back_up = "https://raw.githubusercontent.com/drauger-os-development/download-optimizer/master/servers.json"
-    try:
-        with open("servers.json", "r") as file:
-            data = json.load(file)
-    except (FileNotFoundError, PermissionError):
-        http = urllib3.PoolManager()
-        data = http.request("GET", back_up).data
-        data = json.loads(data)
-    if	 loc == ["0", "0"]:
+    if loc == ["0", "0"]:
         # randomly select a server
-        while True:
-            area = rand.sample(sorted(data.keys()), 1)[0]
-            if data[area] != []:
-                break
-        data = data[area]
         # go ahead and return the server. If this server is down, the user is most likely going to try again
         # if they do, they will likely get a different server
-        return data[0][0]
-    servers = {}
-    distances = []
-    for continents in data:
-        if len(data[continents]) != 0:
-            for server in data[continents]:
-                distance = calculate_distance(loc, server[1])
-                servers[distance] = server[0]
-                distances.append(distance)
-    distances.sort()
-    return check_online(servers, distances)
-
-
-def check_online(servers: dict, distances: list) -> str:
-    """Return first server that is online"""
-    http = urllib3.PoolManager()
-    errors = (urllib3.exceptions.MaxRetryError,
-              #urllib3.exceptions.NameResolutionError,
-              urllib3.exceptions.NewConnectionError,
-              urllib3.exceptions.ProtocolError)
-    for each in distances:
-        url = servers[each]
-        print(f"Trying { url }")
-        try:
-            http.request("GET", url + "ISOs")
-        except errors:
-            try:
-                http.request("GET", url + "hash_files")
-            except errors:
-                print(f"WARNING: { url } MAY BE **DOWN**")
-                continue
-        return url
-
-
-def calculate_distance(point_1, point_2):
-    """Calculate distance between 2 points"""
-    if not isinstance(point_1, list):
-        raise TypeError("point_1 is not of type 'list'")
-    if not isinstance(point_2, list):
-        raise TypeError("point_2 is not of type 'list'")
-    for each in enumerate(point_1):
-        point_1[each[0]] = float(point_1[each[0]])
-    for each in enumerate(point_2):
-        point_2[each[0]] = float(point_2[each[0]])
-
-    # Calculate distance between the points
-    distance = haversine(point_1, point_2, units='km')
-    return distance
+        return REGISTRY.random_url()
+    start = time.perf_counter()
+    HEALTH.refresh()
+    checked = time.perf_counter()
+    found = get_decisions().get(loc, path, closest_online)
+    ranked = time.perf_counter()
+    expected = get_expected(loc, path) if policy.get_policy() == "measured" else None
+    server = policy.choose(found, latency=get_latency, expected=expected)
+    metrics.observe("health", checked - start)
+    metrics.observe("rank", ranked - checked)
+    metrics.observe("select", time.perf_counter() - ranked)
+    return server
+
+
+def closest_online(loc):
+    """Get the mirrors the selection policy picks from for `loc`, out of those online"""
+    found = policy.candidates(REGISTRY, loc, HEALTH.is_up)
+    if found:
+        return found
+    print("WARNING: EVERY MIRROR MAY BE **DOWN**")
+    # everything is down as far as we know. The closest is as good a bet as any
+    found = policy.candidates(REGISTRY, loc)
+    if not found:
+        raise mirrors.NoMirrors(f"no mirror list: { REGISTRY.path } could not be loaded")
+    return found
+
+
+def get_expected(loc, path):
+    """Get expected(km, mirror): seconds to download `path` from a mirror, for a client at `loc`"""
+    meta = filemeta.get(path) if path else None
+    size = meta["size"] if meta else common.get_setting("latency_default_size", 2147483648)
+    area = latency.region(loc)
+    table = get_latency_table()
+    return lambda km, mirror: table.expected(area, mirror.url, km, size, get_latency(mirror.url))
+
+
+@APP.route("/beacon", methods=["GET", "POST"])
+def get_beacon(mode=MODE):
+    """Take a client's report of how a download from a mirror went
+
+    Takes `mirror`, the URL it was sent to, and `rtt` (seconds) and/or
+    `throughput` (bytes per second), as query parameters or form fields.
+    Each client gets one report per mirror every `latency_beacon_interval`
+    seconds, so no one client can outweigh everyone else.
+    """
+    if not common.get_setting("latency_beacon", True):
+        return {"error": "beacons are turned off"}, 404
+    try:
+        url = request.values.get("mirror", "")
+        rtt = request.values.get("rtt")
+        rtt = float(rtt) if rtt else None
+        throughput = request.values.get("throughput")
+        throughput = float(throughput) if throughput else None
+    except ValueError:
+        return {"error": "rtt and throughput must be numbers"}, 400
+    if url not in {each.url for each in REGISTRY.get_mirrors()}:
+        return {"error": "mirror must be the URL of one of our mirrors"}, 400
+    if (rtt is None and throughput is None) or (rtt is not None and not 0 < rtt <= 60) or \
+       (throughput is not None and not 1000 <= throughput <= 1e11):
+        return {"error": "give rtt from 0 to 60 seconds, and/or throughput in bytes per second"}, 400
+    ip_addr = get_client_ip(mode)
+    interval = common.get_setting("latency_beacon_interval", 300)
+    if interval and not get_beacon_sources().claim(latency.source(ip_addr), url, interval):
+        return {"error": f"one report per mirror every { interval } seconds"}, 429
+    loc = parse_location(geoip.locate(ip_addr), ip_addr)
+    if loc == ["0", "0"]:
+        # nowhere we could tell, so nothing to learn about anywhere
+        return "", 204
+    get_latency_table().record(latency.region(loc), url, rtt, throughput)
+    return "", 204
+
+
+def get_latency(url):
+    """Latency of a mirror at its last health check, or None"""
+    entry = HEALTH.get(url)
+    return entry["latency"] if entry is not None else None
 
 
 @APP.route("/stats")
 def get_stats():
     """Get download stats"""
-    # settings
-    if os.path.exists("settings.json"):
-        with open("settings.json", "r") as file:
-            link = json.load(file)["about_link"]
-    else:
-        link = "https://download-optimizer.draugeros.org/about"
-    # Get data
-    data = common.parse_data_file(common.LONG_TERM_COUNT_FILE)
-    # parse the data. Keep the unparsed data or display later
+    etag, modified, page = STATS.render()
+    response = make_response(page)
+    response.set_etag(etag)
+    response.last_modified = modified
+    # let browsers keep it, but check back every time
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@APP.route("/stats/api/<any(day, week, month, year):granularity>")
+def get_stats_api(granularity):
+    """Downloads and bytes per day, week, month or year, a page at a time
+
+    Takes `start` and `end` (YYYY-MM-DD, both optional), `page` and
+    `per_page` as query parameters.
+    """
     try:
-        with open(common.CURRENT_COUNT_FILE, "r") as file:
-            current = file.read()
-    except (IOError, FileNotFoundError):
-        current = 0
+        start = request.args.get("start")
+        start = datetime.date.fromisoformat(start).toordinal() if start else None
+        end = request.args.get("end")
+        end = datetime.date.fromisoformat(end).toordinal() if end else None
+        page = int(request.args.get("page", 1))
+        per_page = int(request.args.get("per_page", 100))
+    except ValueError:
+        return {"error": "start and end must be YYYY-MM-DD, page and per_page numbers"}, 400
+    if page < 1 or not 1 <= per_page <= stats.MAX_PAGE:
+        return {"error": f"page must be at least 1, per_page from 1 to { stats.MAX_PAGE }"}, 400
+    etag, modified = STATS.etag(live=False)
+    response = make_response(STATS.query(granularity, start, end, page, per_page))
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@APP.route("/stats/api/top/<any(mirrors, countries, files, all):dimension>")
+def get_stats_top(dimension):
+    """Mirrors, countries, files or combinations of the three with the most downloads
+
+    Takes `start` and `end` (YYYY-MM-DD, today by default), `hour` (0-23)
+    and `limit` as query parameters, and `mirror`, `country` and `file` to
+    only count downloads matching them.
+    """
     try:
-        current = int(current) + COUNTER.value
+        end = request.args.get("end")
+        end = datetime.date.fromisoformat(end) if end else datetime.date.today()
+        start = request.args.get("start")
+        start = datetime.date.fromisoformat(start) if start else end
+        hour = request.args.get("hour")
+        hour = int(hour) if hour else None
+        limit = int(request.args.get("limit", 20))
     except ValueError:
-        current = COUNTER.value
-    if not isinstance(current, int):
-        current = 0
-    if data in ([], ""):
-        return render_template("stats-none.html", daily_total=current)
-    # get monthly totals
-    monthly_totals = {data[0][0][0]: {"total": 0, "days": 0}}
-    month_name_ptr = 0
-    for each in enumerate(data):
-        if data[month_name_ptr][0][0] != data[each[0]][0][0]:
-            month_name_ptr = each[0]
-            monthly_totals[data[month_name_ptr][0][0]] = {"total": 0, "days": 0}
-        monthly_totals[data[month_name_ptr][0][0]]["total"] += data[each[0]][1]
-        monthly_totals[data[month_name_ptr][0][0]]["days"] += 1
-    # get overall total
-    overall_total = 0
-    for each in monthly_totals:
-        overall_total = monthly_totals[each]["total"] + overall_total
-    # generate output for monthly_totals
-    mt_output = {}
-    for each in monthly_totals:
-        mt_output[each] = monthly_totals[each]['total']
-    # get weekly average
-    week_avrg = 0
-    if len(data) >= 7:
-        for each in range(len(data) - 1, len(data) - 8, -1):
-            week_avrg = week_avrg + data[each][1]
-        week_avrg = "%.2f" % (week_avrg / 7)
-        week_avrg = " ".join(data[-7][0][:-1]) + " thru " + " ".join(data[-1][0][:-1]) + " - " + week_avrg
-    else:
-        week_avrg = "0"
-    # generate output for monthly_avgrs
-    ma_output = {}
-    for each in monthly_totals:
-        ma_output[each] = monthly_totals[each]["total"] / monthly_totals[each]["days"]
-    # add today's numbers into the mix
-    month = list(ma_output.keys())[-1]
-    new_avg = (monthly_totals[month]["total"] + current) / monthly_totals[month]["days"] + 1
-    ma_output[month] = new_avg
-    # Generate output for previous 7 days
-    sdt = {}
-    max = 7
-    if len(data) < 7:
-        max = len(data)
-    for each in range(max, 0, -1):
-        each = each * -1
-        sdt[" ".join(data[each][0])] = data[each][1]
-    # Generate output for previous ALL days
-    att = {}
-    for each in range(len(data) - 1, 0, -1):
-        each = each * -1
-        att[" ".join(data[each][0])] = data[each][1]
-    output = render_template("stats.html",
-                             overall_total=overall_total + current,
-                             monthly_totals_labels=list(mt_output.keys()),
-                             monthly_totals_values=list(mt_output.values()),
-                             monthly_avrgs_labels=list(ma_output.keys()),
-                             monthly_avrgs_values=list(ma_output.values()),
-                             week_avrg=week_avrg,
-                             week_total_labels=list(sdt.keys()),
-                             week_total_values=list(sdt.values()),
-                             daily_total_labels=list(att.keys()),
-                             daily_total_values=list(att.values()),
-                             daily_total=current,
-                             about_link=link
-                             )
-    output = output.replace("&lt;", "<")
-    output = output.replace("&gt;", ">")
-    output = output.replace("&#34;", '"')
-    output = output.replace("&#39;", "'")
-    return output
+        return {"error": "start and end must be YYYY-MM-DD, hour and limit numbers"}, 400
+    if not 0 <= (end - start).days < analytics.MAX_RANGE:
+        return {"error": f"start must be before end, and at most { analytics.MAX_RANGE } days apart"}, 400
+    if (hour is not None and not 0 <= hour < 24) or not 1 <= limit <= stats.MAX_PAGE:
+        return {"error": f"hour must be from 0 to 23, limit from 1 to { stats.MAX_PAGE }"}, 400
+    match = tuple(request.args.get(each) for each in analytics.NAMES)
+    etag, modified, result = analytics.top(start, end, dimension, hour, limit,
+                                           match if any(each is not None for each in match) else None)
+    response = make_response(result)
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @APP.route("/about")
 def about():
     """Serve about page"""
-    if os.path.exists("settings.json"):
-        with open("settings.json", "r") as file:
-            link = json.load(file)["stats_link"]
-    else:
-        link = "https://download-optimizer.draugeros.org/stats"
+    link = common.get_setting("stats_link", "https://download-optimizer.draugeros.org/stats")
     return render_template("about.html", stats_link=link)
 
 
 @APP.route("/stats/archive/<date>")
 def get_historical_stats(date):
-    """Get historical statistics data"""
-    if "-" in date:
-        date = date.split("-")
-        for each in enumerate(date):
-            date[each[0]] = int(each[1])
-    elif date.isnumeric():
-        date = int(date)
-    else:
-        # not a valid entry. Return error page
-        return ""
+    """Get historical statistics data
+
+    `date` is a year, or a range of years like 2023-2025. Monthly totals
+    come from the archive index. Add ?days=1 for every day as well.
+    """
     try:
-        archives = os.listdir("archives")
-    except FileNotFoundError:
-        # return no data available error
-        return ""
-    use = []
-    if isinstance(date, int):
-        for each in archives:
-            if date in each:
-                use.append(each)
-    else:
-        for each in date:
-            for each1 in archives:
-                if each in each1:
-                    use.append(each1)
-    # we now have our archive list in `use`
-    return ""
+        years = [int(each) for each in date.split("-")]
+    except ValueError:
+        years = []
+    if len(years) not in (1, 2):
+        return {"error": "date must be a year, or a range of years like 2023-2025"}, 400
+    data = archive.query(years[0], years[-1], days=request.args.get("days") not in (None, "", "0"))
+    if not data["months"]:
+        return {"error": f"no archived data for { date }"}, 404
+    return data
 
 
 @APP.route("/do-assets/<path:path>")
@@ -449,21 +462,42 @@ def get_valid_date_ranges():
     """Help user define valid date ranges for historical archives"""
     dates = archive.get_valid_year_range()
     valid = []
-    for each in range(int(dates[0]), int(dates[1]) + 1):
-        valid.append(each)
-    print(valid)
-    return ""
+    if dates[0] != "0":
+        for each in range(int(dates[0]), int(dates[1]) + 1):
+            valid.append(each)
+    return {"years": valid}
+
+
+@APP.route("/metrics")
+def get_metrics():
+    """Metrics for every worker, in the Prometheus text format"""
+    text = metrics.render(caches={"geo": geoip.CACHE.stats(),
+                                  "file_meta": filemeta.CACHE.stats(),
+                                  "decisions": get_decisions().stats()},
+                          mirrors=HEALTH.table["mirrors"], downloads=get_counters().totals())
+    response = make_response(text)
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
 
 
 @APP.route("/status")
 def return_status():
     global START_TIME
     return {"status": True,
-            "START_TIME": START_TIME}
-
+            "START_TIME": START_TIME,
+            "geo_cache": geoip.CACHE.stats(),
+            "file_meta_cache": filemeta.CACHE.stats(),
+            "upstreams": upstream.stats(),
+            "decisions": get_decisions().stats(),
+            "latency": get_latency_table().stats(),
+            "uncollected": dict(zip(get_counters().fields, get_counters().pending())),
+            "mirrors": HEALTH.table["mirrors"]}
 
-proc = multiprocessing.Process(target=update_download_count)
-proc.start()
 
 if __name__ == "__main__":
-    APP.run(host="0.0.0.0", debug=MODE)
+    # no uWSGI mule here, so run maintenance ourselves
+    import maintenance
+    create_app()
+    maintenance.start()
+    APP.run(host="0.0.0.0", debug=MODE, use_reloader=False)
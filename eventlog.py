@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  eventlog.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Download event log
+
+Every counted download is appended to a log as a line of tab-separated
+fields: timestamp, downloads, bytes, mirror, country and path. A download
+whose size isn't known yet is logged with 0 bytes, and its size is logged
+later as a line with 0 downloads.
+
+Each worker buffers lines in memory and a background thread writes them
+out in batches, to a segment file only that process writes to. Segments
+are sealed by renaming them once they get old enough, or once the process
+that wrote them is gone. compact() folds sealed segments into per-day
+totals, recording which segments it has applied in the same atomic write,
+so every segment is counted exactly once even if we crash halfway.
+
+How often writes are fsync()ed is set by "eventlog_fsync" in settings.json:
+"always" (every batch), "interval" (every "eventlog_fsync_interval"
+seconds, the default) or "never".
+"""
+import atexit
+import collections
+import json
+import os
+import threading
+import time
+import analytics
+import common
+import metrics
+
+EVENT_LOG_DIR = "events"
+DAILY_FILE = "download_daily.json"
+# lines waiting to be written by this process
+QUEUE = collections.deque()
+WAKE = threading.Event()
+# queued lines that wake the writer early
+BATCH = 256
+THREAD = None
+LOCK = threading.Lock()
+# this process's open segment: [fd, path, opened, last fsync]
+SEGMENT = None
+
+
+def day_key(stamp):
+    """Local date a timestamp falls on, as YYYY-MM-DD"""
+    return time.strftime("%Y-%m-%d", time.localtime(stamp))
+
+
+def log(path, size, mirror, country, downloads=1):
+    """Record a download. Cheap enough to call on the request path"""
+    global THREAD
+    path = path.replace("\t", " ").replace("\n", " ")
+    QUEUE.append(f"{ time.time():.3f}\t{ downloads }\t{ size }\t{ mirror }\t{ country or '-' }\t{ path }\n")
+    if THREAD is None:
+        with LOCK:
+            if THREAD is None:
+                # started on first use so every forked worker gets its own
+                THREAD = threading.Thread(target=__writer__, daemon=True)
+                THREAD.start()
+    if len(QUEUE) >= BATCH:
+        WAKE.set()
+
+
+def __writer__():
+    """Write queued lines out every so often, or as soon as a batch is full"""
+    while True:
+        WAKE.wait(common.get_setting("eventlog_flush_interval", 1.0))
+        WAKE.clear()
+        try:
+            flush()
+        except (OSError, ValueError) as error:
+            print(f"ERROR WRITING EVENT LOG: { error }")
+
+
+def flush(seal=False):
+    """Write this process's queued lines to its segment
+
+    With `seal`, or once the segment is older than "eventlog_segment_seconds",
+    the segment is closed and handed over to compact().
+    """
+    global SEGMENT
+    with LOCK:
+        lines = []
+        while QUEUE:
+            lines.append(QUEUE.popleft())
+        now = time.monotonic()
+        if lines:
+            if SEGMENT is None:
+                os.makedirs(EVENT_LOG_DIR, exist_ok=True)
+                path = os.path.join(EVENT_LOG_DIR, f"{ os.getpid() }-{ time.time_ns() }.open")
+                SEGMENT = [os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644),
+                           path, now, now]
+            data = "".join(lines).encode()
+            while data:
+                data = data[os.write(SEGMENT[0], data):]
+            policy = common.get_setting("eventlog_fsync", "interval")
+            interval = common.get_setting("eventlog_fsync_interval", 5.0)
+            if policy == "always" or (policy == "interval" and now - SEGMENT[3] >= interval):
+                os.fsync(SEGMENT[0])
+                SEGMENT[3] = now
+            metrics.observe("flush", time.monotonic() - now)
+        age = common.get_setting("eventlog_segment_seconds", 60)
+        if SEGMENT is not None and (seal or now - SEGMENT[2] >= age):
+            __seal__(SEGMENT[0], SEGMENT[1])
+            SEGMENT = None
+
+
+def __seal__(fd, path):
+    """Make an open segment durable and visible to compact()"""
+    if common.get_setting("eventlog_fsync", "interval") != "never":
+        os.fsync(fd)
+    os.close(fd)
+    os.replace(path, path[:-5] + ".log")
+
+
+def __forked__():
+    """Forget the parent's queue and segment. The parent still writes those"""
+    global THREAD, SEGMENT, LOCK
+    QUEUE.clear()
+    if SEGMENT is not None:
+        os.close(SEGMENT[0])
+    THREAD = None
+    SEGMENT = None
+    LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=__forked__)
+atexit.register(flush, seal=True)
+
+
+def load(path=DAILY_FILE):
+    """Read the daily totals written by compact()"""
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"days": {}, "applied": []}
+
+
+def __save__(daily, path):
+    """Atomically replace the daily totals"""
+    tmp = f"{ path }.{ os.getpid() }.tmp"
+    with open(tmp, "w") as file:
+        json.dump(daily, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+
+def __new_day__():
+    """Empty totals for one day"""
+    return {"downloads": 0, "bytes": 0, "hours": [[0, 0] for each in range(24)],
+            "mirrors": {}, "countries": {}}
+
+
+def seed(date, downloads, size, path=DAILY_FILE):
+    """Start the daily totals off with what was counted before there was an event log
+
+    Only ever does anything before the first compact(), so nothing is
+    carried over twice. There is no telling which hour, mirror or country
+    those downloads were, so only the day's totals get them. Returns
+    whether anything was written.
+    """
+    if os.path.exists(path) or not (downloads or size):
+        return False
+    daily = load(path)
+    day = daily["days"][date] = __new_day__()
+    day["downloads"] = downloads
+    day["bytes"] = size
+    __save__(daily, path)
+    return True
+
+
+def __apply__(daily, segment, rollups):
+    """Add one segment's lines to the daily totals and the rollups"""
+    # added up by minute, mirror, country and path first, which there are far
+    # fewer of. Every time zone is a whole number of minutes off UTC
+    totals = {}
+    with open(segment, "r", errors="replace") as file:
+        for line in file:
+            fields = line.rstrip("\n").split("\t", 5)
+            if len(fields) != 6 or not line.endswith("\n"):
+                # torn write from a crash. Only ever the last line
+                continue
+            try:
+                stamp = float(fields[0])
+                downloads = int(fields[1])
+                size = int(fields[2])
+            except ValueError:
+                continue
+            key = (int(stamp // 60), fields[3], fields[4], fields[5])
+            entry = totals.get(key)
+            if entry is None:
+                totals[key] = [downloads, size]
+            else:
+                entry[0] += downloads
+                entry[1] += size
+    name = os.path.basename(segment)
+    for (minute, mirror, country, path), (downloads, size) in totals.items():
+        date = day_key(minute * 60)
+        day = daily["days"].get(date)
+        if day is None:
+            day = daily["days"][date] = __new_day__()
+        day["downloads"] += downloads
+        day["bytes"] += size
+        hour = time.localtime(minute * 60)[3]
+        day["hours"][hour][0] += downloads
+        day["hours"][hour][1] += size
+        for field, value in (("mirrors", mirror), ("countries", country)):
+            counts = day[field].setdefault(value, [0, 0])
+            counts[0] += downloads
+            counts[1] += size
+        rollups.add(name, date, hour, (mirror, country, path), downloads, size)
+
+
+def compact(directory=EVENT_LOG_DIR, path=DAILY_FILE, keep_days=None,
+            rollup_dir=analytics.ROLLUP_DIR):
+    """Fold every sealed segment into the daily totals and rollups, then delete them
+
+    Segments left open by processes that have died are sealed first. Safe
+    to run again after a crash at any point: segments already applied are
+    only deleted, never counted twice. Returns the daily totals.
+    """
+    if keep_days is None:
+        keep_days = common.get_setting("eventlog_keep_days", 90)
+    daily = load(path)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return daily
+    for name in names:
+        if name.endswith(".open") and not common.pid_alive(int(name.split("-")[0])):
+            print(f"Recovering event log segment { name }...")
+            os.replace(os.path.join(directory, name), os.path.join(directory, name[:-5] + ".log"))
+    sealed = sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+    applied = set(daily["applied"])
+    new = [name for name in sealed if name not in applied]
+    rollups = analytics.Rollups(rollup_dir)
+    for name in new:
+        __apply__(daily, os.path.join(directory, name), rollups)
+    # rollups go first. They remember what they've seen, the totals can't tell
+    rollups.save(sealed, common.get_setting("analytics_keep_days", 400))
+    # names only need remembering until their files are gone
+    daily["applied"] = sealed
+    cutoff = day_key(time.time() - (keep_days * 86400))
+    for day in [day for day in daily["days"] if day < cutoff]:
+        del daily["days"][day]
+    if new or len(daily["applied"]) != len(applied):
+        __save__(daily, path)
+    for name in sealed:
+        os.remove(os.path.join(directory, name))
+    return daily
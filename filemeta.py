@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  filemeta.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""File metadata cache
+
+Size, ETag and Last-Modified for files on the mirrors, keyed by path.
+Entries are filled by a periodic crawl of the mirrors' `ISOs/` listing,
+or lazily by a HEAD request made from a background thread when a path is
+missing, so redirects never wait on a mirror.
+"""
+import html.parser
+import queue
+import threading
+import time
+import urllib.parse
+import urllib3
+import cache
+import common
+import metrics
+import upstream
+
+FILE_META_CACHE_FILE = "file_metadata.sqlite3"
+CACHE = cache.SharedCache(FILE_META_CACHE_FILE, size=common.get_setting("file_meta_size", 10000))
+# path: callbacks waiting on its HEAD in this process
+PENDING = {}
+QUEUE = queue.Queue()
+THREAD = None
+LOCK = threading.Lock()
+
+
+class _LinkParser(html.parser.HTMLParser):
+    """Collect hrefs from a directory listing"""
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            for name, value in attrs:
+                if name == "href" and value:
+                    self.links.append(value)
+
+
+def get(path):
+    """Get cached metadata for a path, or None"""
+    meta = CACHE.get(path)
+    if meta is None or meta.get("missing"):
+        return None
+    return meta
+
+
+def cached(path):
+    """Get whatever is cached for a path: metadata, {"missing": True} or None"""
+    return CACHE.get(path)
+
+
+def head(server, path):
+    """HEAD a file on a mirror and cache what we learn. Returns the metadata
+
+    `path` is decoded, as it was requested, and quoted for the mirror.
+    """
+    start = time.perf_counter()
+    try:
+        response = upstream.request("HEAD", server + urllib.parse.quote(path))
+    finally:
+        metrics.observe("head", time.perf_counter() - start)
+    if not 200 <= response.status < 300:
+        store_missing(path)
+        return None
+    return store(path, response.headers)
+
+
+def store(path, headers):
+    """Cache metadata for a path from a HEAD response's headers. Returns the metadata"""
+    meta = {"size": int(headers.get("Content-Length", 0)),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")}
+    CACHE.set(path, meta, ttl=common.get_setting("file_meta_ttl", 3600))
+    return meta
+
+
+def store_missing(path):
+    """Remember, for a little while, that a mirror had nothing at a path
+
+    Otherwise every request for a made up path would send another HEAD.
+    """
+    CACHE.set(path, {"missing": True}, ttl=common.get_setting("file_meta_negative_ttl", 300))
+
+
+def __worker__():
+    """Work through queued HEAD requests for this process"""
+    while True:
+        server, path = QUEUE.get()
+        # the crawl or another worker may have got to it first, or found nothing there
+        meta = CACHE.get(path)
+        if meta is not None and meta.get("missing"):
+            meta = None
+        elif meta is None:
+            try:
+                meta = head(server, path)
+            except (urllib3.exceptions.HTTPError, ValueError) as error:
+                print(f"Could not get metadata for { server + path }: { error }")
+        with LOCK:
+            callbacks = PENDING.pop(path, [])
+        if meta is not None:
+            for callback in callbacks:
+                callback(meta)
+
+
+def fetch_async(server, path, callback=None):
+    """Queue a background HEAD for a path, calling callback(meta) when done
+
+    A path already queued isn't HEADed again. Its callback is called along
+    with the others when the first HEAD is done.
+    """
+    global THREAD
+    with LOCK:
+        if THREAD is None or not THREAD.is_alive():
+            # started on first use so every forked worker gets its own
+            THREAD = threading.Thread(target=__worker__, daemon=True)
+            THREAD.start()
+        callbacks = PENDING.get(path)
+        queued = callbacks is not None
+        if not queued:
+            callbacks = PENDING[path] = []
+        if callback is not None:
+            callbacks.append(callback)
+    if not queued:
+        QUEUE.put((server, path))
+
+
+def crawl(server, directory="ISOs/", depth=2):
+    """Fill the cache with every file under `directory` on a mirror
+
+    Paths are cached decoded, the way a request for them is looked up.
+    """
+    response = upstream.request("GET", server + urllib.parse.quote(directory))
+    if response.status >= 400:
+        return 0
+    parser = _LinkParser()
+    parser.feed(response.data.decode(errors="replace"))
+    count = 0
+    for each in parser.links:
+        link = urllib.parse.urlsplit(each)
+        if link.scheme or link.netloc or each.startswith(("/", "?", "#", "..")):
+            # sorting links, parent directory and anything off the mirror
+            continue
+        path = directory + urllib.parse.unquote(link.path)
+        if path.endswith("/"):
+            if depth > 1:
+                count += crawl(server, path, depth - 1)
+        elif head(server, path) is not None:
+            count += 1
+    return count
+
+
+def run(registry, health_table=None):
+    """Crawl a mirror's ISO listing forever. Meant to be the target of its own process"""
+    while True:
+        for each in registry.get_mirrors():
+            if health_table is not None and not health_table.is_up(each.url):
+                continue
+            # every mirror carries the same files, so one good crawl is enough
+            try:
+                count = crawl(each.url)
+            except (urllib3.exceptions.HTTPError, ValueError) as error:
+                print(f"Could not crawl { each.url }: { error }")
+                continue
+            print(f"Cached metadata for { count } files from { each.url }")
+            break
+        time.sleep(common.get_setting("file_meta_crawl_interval", 3600))
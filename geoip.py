@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  geoip.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Local IP geolocation
+
+IP ranges are compiled from a CSV file into a compact binary database
+(`GEOIP_DB_FILE`) which is loaded once per process and searched with
+bisect. Results use the same shape as ipinfo.io's JSON so callers do not
+care where the answer came from. ipinfo.io is kept as a fallback for
+addresses the local database does not cover, and every answer is kept in
+a cache shared by all workers.
+
+To compile a database:
+
+    python3 geoip.py compile <ranges.csv> [geoip.db]
+
+The CSV needs a start IP, end IP, country code, latitude and longitude for
+each range. If the first row is a header, columns are found by name
+(ip_start/start, ip_end/end, country/country_code, latitude/lat,
+longitude/lon), otherwise they are assumed to be in that order.
+"""
+import array
+import bisect
+import csv
+import ipaddress
+import json
+import os
+import struct
+import sys
+import urllib3
+import cache
+import common
+import upstream
+
+GEOIP_DB_FILE = "geoip.db"
+GEOIP_CACHE_FILE = "geoip_cache.sqlite3"
+IPINFO = ["https://ipinfo.io/", "/json"]
+# ipinfo.io asked us to back off, or we already are. Not cached, so the
+# address is looked up again once it lets us
+UNAVAILABLE = {"bogon": True, "unavailable": True}
+
+MAGIC = b"DOGEOIP1"
+# magic, IPv4 range count, IPv6 range count, location count
+HEADER = struct.Struct("<8sIII")
+
+COLUMNS = {"start": ("ip_start", "start", "start_ip", "network_start"),
+           "end": ("ip_end", "end", "end_ip", "network_end"),
+           "country": ("country", "country_code", "cc"),
+           "lat": ("latitude", "lat"),
+           "lon": ("longitude", "lon", "lng")}
+
+
+class _IPv6Column:
+    """Read-only sequence of 128-bit integers packed into a bytes object
+
+    Lets bisect search IPv6 ranges without keeping a Python int per range
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // 16
+
+    def __getitem__(self, index):
+        return int.from_bytes(self.data[index * 16:(index + 1) * 16], "big")
+
+
+class LocalBackend:
+    """In-memory IP range -> (lat, lon, country) index"""
+    remote = False
+
+    def __init__(self, path=GEOIP_DB_FILE):
+        with open(path, "rb") as file:
+            raw = file.read()
+        magic, v4_count, v6_count, loc_count = HEADER.unpack_from(raw)
+        if magic != MAGIC:
+            raise ValueError(f"{ path } is not a compiled GeoIP database")
+        offset = HEADER.size
+
+        def take(typecode, count):
+            nonlocal offset
+            column = array.array(typecode)
+            size = column.itemsize * count
+            column.frombytes(raw[offset:offset + size])
+            offset += size
+            return column
+
+        self.v4_starts = take("I", v4_count)
+        self.v4_ends = take("I", v4_count)
+        self.v4_locs = take("I", v4_count)
+        self.v6_starts = _IPv6Column(raw[offset:offset + (v6_count * 16)])
+        offset += v6_count * 16
+        self.v6_ends = _IPv6Column(raw[offset:offset + (v6_count * 16)])
+        offset += v6_count * 16
+        self.v6_locs = take("I", v6_count)
+        self.lats = take("f", loc_count)
+        self.lons = take("f", loc_count)
+        self.countries = raw[offset:offset + (loc_count * 2)].decode("ascii")
+
+    def __len__(self):
+        return len(self.v4_starts) + len(self.v6_starts)
+
+    def lookup(self, ip_addr):
+        """Return ipinfo-style data for `ip_addr`, or None on a miss"""
+        if ip_addr.version == 4:
+            starts, ends, locs = self.v4_starts, self.v4_ends, self.v4_locs
+        else:
+            starts, ends, locs = self.v6_starts, self.v6_ends, self.v6_locs
+        value = int(ip_addr)
+        index = bisect.bisect_right(starts, value) - 1
+        if index < 0 or value > ends[index]:
+            return None
+        loc = locs[index]
+        return {"ip": str(ip_addr),
+                "loc": f"{ self.lats[loc]:.4f},{ self.lons[loc]:.4f}",
+                "country": self.countries[loc * 2:(loc * 2) + 2].strip()}
+
+
+class IPInfoBackend:
+    """Look addresses up with ipinfo.io"""
+    remote = True
+
+    def lookup(self, ip_addr):
+        """Return ipinfo.io's data for `ip_addr`"""
+        try:
+            response = upstream.request("GET", ipinfo_url(ip_addr))
+            if response.status == 429:
+                print("Rate limited by ipinfo.io. Backing off...")
+                return dict(UNAVAILABLE)
+            return json.loads(response.data)
+        except upstream.CircuitOpen:
+            return dict(UNAVAILABLE)
+        except (urllib3.exceptions.HTTPError, ValueError):
+            print("Could not reach ipinfo.io. No internet access?")
+            return None
+
+
+class GeoLocator:
+    """Try each backend in turn until one knows where an address is"""
+    def __init__(self, backends):
+        self.backends = backends
+
+    @property
+    def has_remote(self):
+        """Whether any backend has to go over the network"""
+        return any(each.remote for each in self.backends)
+
+    def locate(self, ip_addr, remote=True):
+        """Get ipinfo-style location data for an IP address
+
+        Bogons and unparsable addresses are answered locally in the same
+        shape ipinfo.io would use, without asking any backend. With `remote`
+        off, backends that go over the network are skipped and None is
+        returned if no local backend knows the address.
+        """
+        try:
+            parsed = ipaddress.ip_address(str(ip_addr))
+        except ValueError:
+            return {"error": {"title": "Wrong ip",
+                              "message": "Please provide a valid IP address"}}
+        if not parsed.is_global:
+            return {"ip": str(parsed), "bogon": True}
+        for each in self.backends:
+            if each.remote and not remote:
+                continue
+            data = each.lookup(parsed)
+            if data is not None:
+                return data
+        if not remote:
+            return None
+        return {"bogon": True}
+
+
+LOCATOR = None
+CACHE = cache.SharedCache(GEOIP_CACHE_FILE, size=common.get_setting("geo_cache_size", 100000))
+
+
+def get_locator():
+    """Get the process-wide GeoLocator, building it on first use"""
+    global LOCATOR
+    if LOCATOR is None:
+        backends = []
+        try:
+            backends.append(LocalBackend())
+        except (FileNotFoundError, PermissionError):
+            print(f"{ GEOIP_DB_FILE } not found. Using ipinfo.io for all lookups...")
+        except (ValueError, struct.error) as error:
+            print(f"Could not load { GEOIP_DB_FILE }: { error }")
+        if common.get_setting("ipinfo_fallback", True):
+            backends.append(IPInfoBackend())
+        LOCATOR = GeoLocator(backends)
+    return LOCATOR
+
+
+def cache_key(ip_addr):
+    """Get the cache key for an IP address
+
+    With the `geo_cache_prefix` setting on, every address in the same IPv4 /24
+    or IPv6 /48 shares one entry.
+    """
+    ip_addr = str(ip_addr)
+    if not common.get_setting("geo_cache_prefix", False):
+        return ip_addr
+    try:
+        parsed = ipaddress.ip_address(ip_addr)
+    except ValueError:
+        return ip_addr
+    prefix = 24 if parsed.version == 4 else 48
+    return str(ipaddress.ip_network(f"{ parsed }/{ prefix }", strict=False))
+
+
+def ipinfo_url(ip_addr):
+    """Get the ipinfo.io URL for an IP address"""
+    return str(ip_addr).join([common.get_setting("ipinfo_url", IPINFO[0]), IPINFO[1]])
+
+
+def store(key, data):
+    """Cache a lookup result"""
+    if data.get("unavailable"):
+        return
+    # bogons, errors and lookups that came back without a location are
+    # cached too, just not for as long
+    if ("loc" in data) and ("bogon" not in data):
+        ttl = common.get_setting("geo_cache_ttl", 86400)
+    else:
+        ttl = common.get_setting("geo_cache_negative_ttl", 900)
+    CACHE.set(key, data, ttl=ttl)
+
+
+def locate(ip_addr):
+    """Get ipinfo-style location data for an IP address, using the cache"""
+    key = cache_key(ip_addr)
+    data = CACHE.get(key)
+    if data is None:
+        data = get_locator().locate(ip_addr)
+        store(key, data)
+    return data
+
+
+def __find_columns__(row):
+    """Map column names to indexes if `row` is a header, else return None"""
+    try:
+        ipaddress.ip_address(row[0].strip())
+        return None
+    except ValueError:
+        if row[0].strip().isnumeric():
+            return None
+    names = [each.strip().lower() for each in row]
+    found = {}
+    for key, aliases in COLUMNS.items():
+        for each in aliases:
+            if each in names:
+                found[key] = names.index(each)
+                break
+        else:
+            raise ValueError(f"GeoIP CSV header has no { key } column")
+    return found
+
+
+def __parse_ip__(value):
+    """Parse an IP address given either in dotted/colon form or as an integer"""
+    value = value.strip()
+    if value.isnumeric():
+        value = int(value)
+    return ipaddress.ip_address(value)
+
+
+def compile_database(csv_path, db_path=GEOIP_DB_FILE):
+    """Compile a CSV of IP ranges into a binary database. Returns range count"""
+    ranges = {4: [], 6: []}
+    locations = {}
+    with open(csv_path, "r", newline="") as file:
+        reader = csv.reader(file)
+        columns = None
+        for row in reader:
+            if row == [] or row[0].startswith("#"):
+                continue
+            if columns is None:
+                columns = __find_columns__(row)
+                if columns is not None:
+                    continue
+                columns = {"start": 0, "end": 1, "country": 2, "lat": 3, "lon": 4}
+            start = __parse_ip__(row[columns["start"]])
+            end = __parse_ip__(row[columns["end"]])
+            if start.version != end.version:
+                raise ValueError(f"Mixed IP versions in range: { row }")
+            loc = (round(float(row[columns["lat"]]), 4),
+                   round(float(row[columns["lon"]]), 4),
+                   row[columns["country"]].strip().upper()[:2].ljust(2))
+            if loc not in locations:
+                locations[loc] = len(locations)
+            ranges[start.version].append((int(start), int(end), locations[loc]))
+    for each in ranges.values():
+        each.sort()
+    lats = array.array("f", (each[0] for each in locations))
+    lons = array.array("f", (each[1] for each in locations))
+    countries = "".join(each[2] for each in locations).encode("ascii")
+    tmp = f"{ db_path }.tmp"
+    with open(tmp, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(ranges[4]), len(ranges[6]), len(locations)))
+        for column in range(3):
+            file.write(array.array("I", (each[column] for each in ranges[4])).tobytes())
+        for column in range(2):
+            file.write(b"".join(each[column].to_bytes(16, "big") for each in ranges[6]))
+        file.write(array.array("I", (each[2] for each in ranges[6])).tobytes())
+        file.write(lats.tobytes())
+        file.write(lons.tobytes())
+        file.write(countries)
+    os.replace(tmp, db_path)
+    return len(ranges[4]) + len(ranges[6])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "compile":
+        print("Usage: geoip.py compile <ranges.csv> [database]")
+        sys.exit(1)
+    if len(sys.argv) > 3:
+        count = compile_database(sys.argv[2], sys.argv[3])
+    else:
+        count = compile_database(sys.argv[2])
+    print(f"Compiled { count } ranges")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  health.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Mirror health checking
+
+A single background process probes every mirror concurrently on an
+interval and writes the results to `HEALTH_FILE`. Workers only ever read
+that file (re-reading it when it changes), so no probe happens while a
+user is waiting on a redirect.
+"""
+import concurrent.futures
+import json
+import os
+import time
+import urllib3
+import common
+import upstream
+
+HEALTH_FILE = "mirror_health.json"
+
+
+def probe(url, timeout):
+    """HEAD a mirror. Returns latency in seconds, or None if it is down"""
+    start = time.monotonic()
+    for each in ("ISOs", "hash_files"):
+        try:
+            # always probe, even with the circuit open, or we'd never see it come back
+            response = upstream.request("HEAD", url + each, timeout=timeout, retries=False,
+                                        breaker=False, redirect=False)
+        except urllib3.exceptions.TimeoutError:
+            # too slow is as good as down. Don't wait out a second timeout
+            return None
+        except urllib3.exceptions.HTTPError:
+            continue
+        if response.status < 500:
+            return time.monotonic() - start
+    return None
+
+
+def check_all(urls, previous=None, timeout=2.0):
+    """Probe every mirror at once and build a new health table"""
+    if previous is None:
+        previous = {"generation": 0, "mirrors": {}}
+    now = time.time()
+    workers = max(1, min(32, len(urls)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        latencies = pool.map(lambda url: probe(url, timeout), urls)
+        latencies = dict(zip(urls, latencies))
+    table = {"generation": previous["generation"], "checked": now, "mirrors": {}}
+    changed = False
+    for url, latency in latencies.items():
+        old = previous["mirrors"].get(url, {"up": True, "last_seen": None, "failures": 0})
+        entry = {"up": latency is not None, "latency": latency,
+                 "last_seen": now if latency is not None else old["last_seen"],
+                 "failures": 0 if latency is not None else old["failures"] + 1}
+        if entry["up"] != old["up"]:
+            changed = True
+            state = "UP" if entry["up"] else "**DOWN**"
+            print(f"Mirror { url } is { state }")
+        table["mirrors"][url] = entry
+    if changed or set(table["mirrors"]) != set(previous["mirrors"]):
+        # lets anything caching on health know to throw its results out
+        table["generation"] += 1
+    return table
+
+
+def write_table(table, path=HEALTH_FILE):
+    """Atomically replace the health table on disk"""
+    tmp = f"{ path }.{ os.getpid() }.tmp"
+    with open(tmp, "w") as file:
+        json.dump(table, file)
+    os.replace(tmp, path)
+
+
+def run(registry):
+    """Probe mirrors forever. Meant to be the target of its own process"""
+    table = None
+    while True:
+        interval = common.get_setting("health_interval", 30)
+        timeout = common.get_setting("health_timeout", 2.0)
+        urls = [each.url for each in registry.get_mirrors()]
+        table = check_all(urls, previous=table, timeout=timeout)
+        write_table(table)
+        time.sleep(max(0, interval - (time.time() - table["checked"])))
+
+
+class HealthTable:
+    """Read-only, in-memory view of the shared health table"""
+    def __init__(self, path=HEALTH_FILE, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.table = {"generation": 0, "checked": 0, "mirrors": {}}
+        self.mtime = None
+        self.last_check = 0
+
+    def refresh(self):
+        """Re-read the table if the checker has written a new one"""
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path, "r") as file:
+                self.table = json.load(file)
+            self.mtime = mtime
+        except (FileNotFoundError, PermissionError, ValueError):
+            pass
+
+    @property
+    def generation(self):
+        """Counter that goes up every time a mirror changes state"""
+        self.refresh()
+        return self.table["generation"]
+
+    def is_stale(self):
+        """True if the checker hasn't written anything in 3 intervals"""
+        self.refresh()
+        interval = common.get_setting("health_interval", 30)
+        return time.time() - self.table["checked"] > interval * 3
+
+    def is_up(self, url):
+        """Whether a mirror was up at the last check
+
+        Mirrors are assumed up if the checker hasn't seen them yet, or if the
+        checker has stopped running, so a broken checker never takes every
+        mirror out of rotation.
+        """
+        self.refresh()
+        if self.is_stale():
+            return True
+        return self.table["mirrors"].get(url, {"up": True})["up"]
+
+    def get(self, url):
+        """Get the full health entry for a mirror, or None"""
+        self.refresh()
+        return self.table["mirrors"].get(url)
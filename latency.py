@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  latency.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Measured round trip times and throughput from clients to mirrors
+
+Clients can report how a download went with a beacon: the round trip time
+and throughput they saw from a mirror. Reports are kept per region (a
+`latency_cell_degrees` by `latency_cell_degrees` cell of the map) and
+mirror, as exponentially weighted averages with a half-life of
+`latency_half_life` seconds, and per mirror across every region.
+
+The estimates live in a fixed-size, memory-mapped hash table shared by
+every worker, so memory use doesn't grow with the number of regions.
+When the table has no room left near a key, the entry there that was
+updated longest ago is dropped.
+
+Where there are few reports, estimates lean on a prior instead: a round
+trip time from the distance to the mirror plus its latency as the health
+checker last saw it, and the mirror's throughput across every region, or
+`latency_default_throughput` if nobody has reported any.
+"""
+import hashlib
+import ipaddress
+import mmap
+import os
+import struct
+import time
+import common
+import counters
+
+LATENCY_FILE = "mirror_latency.bin"
+# when each client last had a beacon taken, in the same layout
+SOURCES_FILE = "beacon_sources.bin"
+MAGIC = 0x594e_4554_414c  # "LATENY"
+VERSION = 1
+# magic, version, slots, padded to a slot
+HEADER = struct.Struct("<QQQ24x")
+# key, last update, round trip weight and average, throughput weight and
+# average seconds per byte
+SLOT = struct.Struct("<Qddddd")
+# slots looked at for a key before giving up on finding it
+PROBES = 8
+# region for a mirror's estimates across every region
+EVERYWHERE = -1
+# round trip seconds for every km to a mirror: light in fibre there and
+# back, with room for routes that aren't straight lines
+RTT_PER_KM = 1 / 50000
+
+
+def region(loc, degrees=None):
+    """Index of the map cell a [lat, lon] pair is in"""
+    if degrees is None:
+        degrees = common.get_setting("latency_cell_degrees", 5)
+    rows = -(-180 // degrees)
+    columns = -(-360 // degrees)
+    row = min(int((float(loc[0]) + 90) // degrees), rows - 1)
+    column = int((float(loc[1]) + 180) // degrees) % columns
+    return int(row * columns + column)
+
+
+def __digest__(area, url):
+    """64 bit key for a region and mirror. 0 marks an empty slot"""
+    digest = hashlib.blake2b(f"{ area } { url }".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def source(ip_addr):
+    """Who a beacon is from, for rate limiting: an IPv4 address or IPv6 /64"""
+    try:
+        parsed = ipaddress.ip_address(ip_addr)
+    except ValueError:
+        return str(ip_addr)
+    if parsed.version == 4:
+        return str(parsed)
+    return str(ipaddress.ip_network(f"{ parsed }/64", strict=False))
+
+
+class LatencyTable:
+    """Shared, bounded table of (region, mirror) -> round trip time and throughput"""
+    def __init__(self, path=LATENCY_FILE, slots=None, check_interval=1):
+        if slots is None:
+            slots = common.get_setting("latency_table_size", 65536)
+        self.path = path
+        self.slots = slots
+        self.check_interval = check_interval
+        self.last_check = None
+        # half-life, prior weight, default throughput
+        self.config = (86400, 3, 12500000)
+        self.keys = {}
+        self.lock = None
+        self.lock_pid = None
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = HEADER.size + (SLOT.size * slots)
+        with self.__locked__():
+            if os.fstat(self.fd).st_size != size or not self.__valid__():
+                print(f"Creating new latency table at { path }...")
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                self.mmap = mmap.mmap(self.fd, size)
+                # magic last, so a half-written header is never taken as valid
+                HEADER.pack_into(self.mmap, 0, 0, VERSION, slots)
+                HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, slots)
+            else:
+                self.mmap = mmap.mmap(self.fd, size)
+
+    def __valid__(self):
+        """Whether the file on disk has the layout we expect"""
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) != HEADER.size:
+            return False
+        return HEADER.unpack(header) == (MAGIC, VERSION, self.slots)
+
+    def __locked__(self):
+        """Context manager holding the table lock, across processes and threads"""
+        if self.lock_pid != os.getpid():
+            self.lock = counters._FileLock(os.open(self.path, os.O_RDWR))
+            self.lock_pid = os.getpid()
+        return self.lock
+
+    def __key__(self, area, url):
+        """__digest__(), remembered"""
+        key = self.keys.get((area, url))
+        if key is None:
+            # at most every region for every mirror, so no need to bound it
+            key = self.keys[(area, url)] = __digest__(area, url)
+        return key
+
+    def __offsets__(self, key):
+        """Byte offsets of the slots a key may be in"""
+        return [HEADER.size + (SLOT.size * ((key + each) % self.slots)) for each in range(PROBES)]
+
+    def refresh(self):
+        """Re-read settings, at most every `check_interval` seconds"""
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        self.config = (common.get_setting("latency_half_life", 86400),
+                       common.get_setting("latency_prior_weight", 3),
+                       common.get_setting("latency_default_throughput", 12500000))
+
+    def __read__(self, key):
+        """A key's slot, or None"""
+        for each in range(PROBES):
+            slot = SLOT.unpack_from(self.mmap, HEADER.size + (SLOT.size * ((key + each) % self.slots)))
+            if slot[0] == key:
+                return slot
+            if slot[0] == 0:
+                return None
+        return None
+
+    def get(self, area, url, now=None):
+        """Estimates for a mirror from a region, or None
+
+        Returns (round trip weight, round trip, throughput weight, seconds
+        per byte), with the weights decayed to `now`.
+        """
+        # written without a lock held against us. At worst we get half an update
+        slot = self.__read__(self.__key__(area, url))
+        if slot is None:
+            return None
+        if now is None:
+            now = time.time()
+        self.refresh()
+        decay = 0.5 ** (max(0, now - slot[1]) / self.config[0])
+        return (slot[2] * decay, slot[3], slot[4] * decay, slot[5])
+
+    def record(self, area, url, rtt=None, throughput=None, now=None):
+        """Add a report of a mirror's round trip time (s) and throughput (bytes/s)"""
+        if now is None:
+            now = time.time()
+        self.refresh()
+        with self.__locked__():
+            for each in (area, EVERYWHERE):
+                self.__update__(self.__key__(each, url), rtt, throughput, now, self.config[0])
+
+    def claim(self, area, url, interval, now=None):
+        """Mark a key as updated now, unless it was less than `interval` seconds ago
+
+        Returns True if it was marked. Used to rate limit beacons, with the
+        client in place of the region.
+        """
+        if now is None:
+            now = time.time()
+        # not kept in self.keys, which would grow with every client
+        key = __digest__(area, url)
+        with self.__locked__():
+            target = self.__slot__(key)
+            slot = SLOT.unpack_from(self.mmap, target)
+            if slot[0] == key and 0 <= now - slot[1] < interval:
+                return False
+            SLOT.pack_into(self.mmap, target, key, now, 0.0, 0.0, 0.0, 0.0)
+        return True
+
+    def __slot__(self, key):
+        """Offset of a key's slot, or of the one to put it in. The table lock must be held"""
+        offsets = self.__offsets__(key)
+        target = None
+        oldest = None
+        for offset in offsets:
+            slot = SLOT.unpack_from(self.mmap, offset)
+            if slot[0] == key or slot[0] == 0:
+                target = offset
+                break
+            if oldest is None or slot[1] < oldest[1]:
+                oldest = (offset, slot[1])
+        if target is None:
+            target = oldest[0]
+        return target
+
+    def __update__(self, key, rtt, throughput, now, half_life):
+        """Fold a report into a key's slot. The table lock must be held"""
+        target = self.__slot__(key)
+        slot = SLOT.unpack_from(self.mmap, target)
+        if slot[0] != key:
+            slot = (key, now, 0.0, 0.0, 0.0, 0.0)
+        decay = 0.5 ** (max(0, now - slot[1]) / half_life)
+        weights = [slot[2] * decay, slot[4] * decay]
+        means = [slot[3], slot[5]]
+        for index, value in enumerate((rtt, 1 / throughput if throughput else None)):
+            if value is not None:
+                weights[index] += 1
+                means[index] += (value - means[index]) / weights[index]
+        SLOT.pack_into(self.mmap, target, key, now, weights[0], means[0], weights[1], means[1])
+
+    def expected(self, area, url, km, size, latency=None, now=None):
+        """Expected seconds to download `size` bytes of a mirror `km` away from a region
+
+        `latency` is the mirror's latency at its last health check.
+        """
+        self.refresh()
+        prior = self.config[1]
+        rtt = (km * RTT_PER_KM) + (latency or 0)
+        per_byte = 1 / self.config[2]
+        local = self.get(area, url, now)
+        for each in (self.get(EVERYWHERE, url, now), local):
+            # each is shrunk towards what we had before it
+            if each is not None and each[2] > 0:
+                per_byte = ((each[2] * each[3]) + (prior * per_byte)) / (each[2] + prior)
+        if local is not None and local[0] > 0:
+            rtt = ((local[0] * local[1]) + (prior * rtt)) / (local[0] + prior)
+        return rtt + (size * per_byte)
+
+    def stats(self):
+        """Slots in use and in all"""
+        keys = memoryview(self.mmap)[HEADER.size:].cast("Q")[::SLOT.size // 8]
+        used = self.slots - keys.tolist().count(0)
+        keys.release()
+        return {"entries": used, "slots": self.slots}
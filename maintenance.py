@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  maintenance.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Background maintenance service
+
+Everything the app needs done in the background, and only once no matter
+how many workers there are:
+
+ - folding the event log into the stored download counts, deduplicating
+   the long-term count file and archiving old years
+ - probing the mirrors (health.run)
+ - crawling the mirrors for file sizes (filemeta.run)
+
+Each runs in its own child process, restarted if it dies. Run this as a
+uWSGI mule (see download.ini), or on its own with `python3 maintenance.py`.
+"""
+import datetime
+import multiprocessing
+import os
+import threading
+import time
+import archive
+import common
+import counters
+import eventlog
+import filemeta
+import health
+import metrics
+import mirrors
+
+# how often, in seconds, to check on the services
+SUPERVISE_INTERVAL = 5
+
+
+def update_download_count():
+    """Periodically fold the event log into the stored download counts"""
+    table = counters.CounterTable()
+    committed = __last_committed__()
+    __seed_today__()
+    while True:
+        time.sleep(common.get_setting("eventlog_compact_interval", 60))
+        start = time.perf_counter()
+        try:
+            daily = eventlog.compact()
+        except (OSError, ValueError) as error:
+            print(f"ERROR COMPACTING EVENT LOG: { error }")
+            continue
+        # everything the workers counted up to now is in the log, or will be
+        # by next time, so these only need to cover the gap until then
+        table.collect()
+        metrics.observe("compact", time.perf_counter() - start)
+        today = daily["days"].get(eventlog.day_key(time.time()), {"downloads": 0, "bytes": 0})
+        tmp = f"{ common.CURRENT_COUNT_FILE }.tmp"
+        with open(tmp, "w") as file:
+            file.write(f"{ today['downloads'] },{ today['bytes'] / 1073741824 }")
+        os.replace(tmp, common.CURRENT_COUNT_FILE)
+        # give every worker time to seal its last segment for a day before
+        # that day goes into long-term storage
+        grace = common.get_setting("eventlog_segment_seconds", 60) * 2 + 60
+        finished = datetime.date.fromisoformat(eventlog.day_key(time.time() - grace))
+        finished -= datetime.timedelta(days=1)
+        if committed is None and daily["days"]:
+            committed = datetime.date.fromisoformat(min(daily["days"])) - datetime.timedelta(days=1)
+        if committed is None or committed >= finished:
+            continue
+        while committed < finished:
+            committed += datetime.timedelta(days=1)
+            totals = daily["days"].get(committed.isoformat(), {"downloads": 0, "bytes": 0})
+            date = committed.strftime("%B %d %Y").split(" ")
+            data_count = totals["bytes"] / 1073741824
+            common.write_data_file(common.LONG_TERM_COUNT_FILE,
+                                   write=[date, totals["downloads"], data_count])
+            print(f"Download count for { date }: { totals['downloads'] }, { data_count } GB")
+        dedup_entries()
+        archive.create_archive()
+
+
+def __seed_today__():
+    """Carry today's count in daily_count.txt over to the event log, the first time it runs
+
+    Otherwise the first compaction after an upgrade would overwrite it with
+    only what was logged since.
+    """
+    today = eventlog.day_key(time.time())
+    try:
+        if eventlog.day_key(os.stat(common.CURRENT_COUNT_FILE).st_mtime) != today:
+            # left over from another day
+            return
+        with open(common.CURRENT_COUNT_FILE, "r") as file:
+            downloads, data_count = file.read().split(",")
+        downloads = int(downloads)
+        size = round(float(data_count) * 1073741824)
+    except (FileNotFoundError, ValueError):
+        return
+    if eventlog.seed(today, downloads, size):
+        print(f"Carried over { downloads } downloads counted today before the event log")
+
+
+def __last_committed__():
+    """Last day in long-term storage, or None if there isn't one"""
+    data = common.parse_data_file(common.LONG_TERM_COUNT_FILE)
+    if not data:
+        return None
+    return datetime.datetime.strptime(" ".join(data[-1][0]), "%B %d %Y").date()
+
+
+def dedup_entries(file=common.LONG_TERM_COUNT_FILE):
+    """Merge download count entries for the same date, keeping them in order"""
+    merged = {}
+    duplicates = 0
+    try:
+        for entry in common.iter_data_file(file):
+            key = tuple(entry[0])
+            if key not in merged:
+                merged[key] = entry
+                continue
+            duplicates += 1
+            kept = merged[key]
+            kept[1] += entry[1]
+            if len(entry) > 2:
+                if len(kept) > 2:
+                    kept[2] += entry[2]
+                else:
+                    kept.append(entry[2])
+    except FileNotFoundError:
+        return
+    if duplicates:
+        common.replace_data_file(file, merged.values())
+
+
+def __orphaned__(parent):
+    """Exit once `parent` has gone, so no service outlives the supervisor"""
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+def __service__(target, args, parent):
+    """Run a service in its own process"""
+    threading.Thread(target=__orphaned__, args=(parent,), daemon=True).start()
+    target(*args)
+
+
+def get_services():
+    """Get every service: name, target and arguments"""
+    registry = mirrors.MirrorRegistry()
+    return {"counts": (update_download_count, ()),
+            "health": (health.run, (registry,)),
+            "crawl": (filemeta.run, (registry, health.HealthTable()))}
+
+
+def __spawn__(name, target, args):
+    """Start one service"""
+    proc = multiprocessing.Process(target=__service__, args=(target, args, os.getpid()),
+                                   name=name, daemon=True)
+    proc.start()
+    return proc
+
+
+def start():
+    """Start every service in the background, without supervising them"""
+    common.init_data_files()
+    # before any service can write to it, and so no worker has to
+    common.get_store()
+    return [__spawn__(name, *service) for name, service in get_services().items()]
+
+
+def main():
+    """Run every service, restarting any that die"""
+    common.init_data_files()
+    common.get_store()
+    services = get_services()
+    running = {name: __spawn__(name, *service) for name, service in services.items()}
+    while True:
+        time.sleep(SUPERVISE_INTERVAL)
+        for name, proc in running.items():
+            if not proc.is_alive():
+                print(f"WARNING: { name } service exited with { proc.exitcode }. Restarting...")
+                running[name] = __spawn__(name, *services[name])
+
+
+if __name__ == "__main__":
+    main()
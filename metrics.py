@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Prometheus-style metrics
+
+Latency histograms for each stage of a redirect and for background work,
+and request and error counts for every upstream host, are kept in a
+counter table shared by every worker (see counters.py). Recording a value
+is a few adds to memory only the recording thread writes to. Buckets are
+not cumulative in the table. render() adds them up for the text format.
+
+Host names get a column each the first time they are seen, recorded in
+`METRICS_HOSTS_FILE`. Past `MAX_HOSTS`, hosts share an "other" column.
+"""
+import bisect
+import fcntl
+import threading
+import counters
+
+METRICS_FILE = "metrics.bin"
+METRICS_HOSTS_FILE = "metrics_hosts.txt"
+PREFIX = "download_optimizer"
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+           0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGES = {"geo": "geolocating the client",
+          "health": "reading the health table",
+          "rank": "finding the closest mirrors, or their cached decision",
+          "select": "picking one with the selection policy",
+          "count": "counting the download",
+          "total": "the whole redirect",
+          "head": "HEAD requests for file sizes, in the background",
+          "flush": "writing the event log to disk",
+          "compact": "compacting the event log and collecting counters"}
+MAX_HOSTS = 64
+HOST_FIELDS = ("requests", "errors", "rejected")
+# every bucket, then +Inf, then the sum in nanoseconds
+HISTOGRAM_WIDTH = len(BUCKETS) + 2
+STAGE_BASE = {name: index * HISTOGRAM_WIDTH for index, name in enumerate(STAGES)}
+HOST_BASE = len(STAGES) * HISTOGRAM_WIDTH
+HOSTS = {}
+# opened on first use, so importing this doesn't touch the disk
+TABLE = None
+LOCK = threading.Lock()
+
+
+def get_table():
+    """Get the shared metrics table"""
+    global TABLE
+    if TABLE is None:
+        with LOCK:
+            if TABLE is None:
+                TABLE = counters.CounterTable(
+                    METRICS_FILE, slots=64,
+                    fields=[f"{ stage }_{ index }" for stage in STAGES
+                            for index in range(HISTOGRAM_WIDTH)] +
+                           [f"host{ column }_{ name }" for column in range(MAX_HOSTS + 1)
+                            for name in HOST_FIELDS])
+    return TABLE
+
+
+def observe(stage, seconds):
+    """Record how long a stage took"""
+    base = STAGE_BASE[stage]
+    (TABLE or get_table()).add_at((base + bisect.bisect_left(BUCKETS, seconds), 1),
+                 (base + HISTOGRAM_WIDTH - 1, int(seconds * 1000000000)))
+
+
+def __host_column__(host):
+    """Get the column a host's counts go in, giving it one if it's new"""
+    column = HOSTS.get(host)
+    if column is not None:
+        return column
+    with open(METRICS_HOSTS_FILE, "a+") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        names = file.read().split("\n")[:-1]
+        if host not in names and len(names) < MAX_HOSTS:
+            file.write(f"{ host }\n")
+            names.append(host)
+    HOSTS.update((name, index) for index, name in enumerate(names))
+    return HOSTS.get(host, MAX_HOSTS)
+
+
+def count_upstream(host, requests=0, errors=0, rejected=0):
+    """Count requests to an upstream host, and how many failed or were refused"""
+    base = HOST_BASE + (__host_column__(host) * len(HOST_FIELDS))
+    (TABLE or get_table()).add_at((base, requests), (base + 1, errors), (base + 2, rejected))
+
+
+def __labels__(**labels):
+    """Format Prometheus labels"""
+    text = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        text.append(f'{ key }="{ value }"')
+    return "{" + ",".join(text) + "}"
+
+
+def render(caches=None, mirrors=None, downloads=None):
+    """Everything, in the Prometheus text format
+
+    `caches` maps a cache's name to its stats() (hits, misses, evictions),
+    `mirrors` is the health table's mirrors, and `downloads` is a
+    (downloads, bytes) pair.
+    """
+    totals = get_table().totals()
+    lines = [f"# HELP { PREFIX }_stage_seconds Time spent in each stage of a redirect, "
+             "and in background work",
+             f"# TYPE { PREFIX }_stage_seconds histogram"]
+    for stage, base in STAGE_BASE.items():
+        count = 0
+        for index, bound in enumerate(BUCKETS + ("+Inf",)):
+            count += totals[base + index]
+            lines.append(f"{ PREFIX }_stage_seconds_bucket{ __labels__(stage=stage, le=bound) } { count }")
+        lines.append(f"{ PREFIX }_stage_seconds_sum{ __labels__(stage=stage) } "
+                     f"{ totals[base + HISTOGRAM_WIDTH - 1] / 1000000000 }")
+        lines.append(f"{ PREFIX }_stage_seconds_count{ __labels__(stage=stage) } { count }")
+    try:
+        with open(METRICS_HOSTS_FILE, "r") as file:
+            names = file.read().split("\n")[:-1]
+    except FileNotFoundError:
+        names = []
+    names = names[:MAX_HOSTS] + ["other"]
+    columns = list(range(len(names) - 1)) + [MAX_HOSTS]
+    for offset, name in enumerate(HOST_FIELDS):
+        lines.append(f"# TYPE { PREFIX }_upstream_{ name }_total counter")
+        for host, column in zip(names, columns):
+            lines.append(f"{ PREFIX }_upstream_{ name }_total{ __labels__(host=host) } "
+                         f"{ totals[HOST_BASE + (column * len(HOST_FIELDS)) + offset] }")
+    for name in ("hits", "misses", "evictions"):
+        lines.append(f"# TYPE { PREFIX }_cache_{ name }_total counter")
+        for cache, stats in (caches or {}).items():
+            lines.append(f"{ PREFIX }_cache_{ name }_total{ __labels__(cache=cache) } "
+                         f"{ stats.get(name, 0) }")
+    lines.append(f"# TYPE { PREFIX }_cache_hit_ratio gauge")
+    for cache, stats in (caches or {}).items():
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        ratio = stats.get("hits", 0) / lookups if lookups else 0
+        lines.append(f"{ PREFIX }_cache_hit_ratio{ __labels__(cache=cache) } { ratio }")
+    if mirrors is not None:
+        lines.append(f"# TYPE { PREFIX }_mirror_up gauge")
+        for url, entry in mirrors.items():
+            lines.append(f"{ PREFIX }_mirror_up{ __labels__(mirror=url) } { int(entry['up']) }")
+        lines.append(f"# TYPE { PREFIX }_mirror_latency_seconds gauge")
+        for url, entry in mirrors.items():
+            if entry.get("latency") is not None:
+                lines.append(f"{ PREFIX }_mirror_latency_seconds{ __labels__(mirror=url) } "
+                             f"{ entry['latency'] }")
+    if downloads is not None:
+        lines.append(f"# TYPE { PREFIX }_downloads_total counter")
+        lines.append(f"{ PREFIX }_downloads_total { downloads[0] }")
+        lines.append(f"# TYPE { PREFIX }_download_bytes_total counter")
+        lines.append(f"{ PREFIX }_download_bytes_total { downloads[1] }")
+    return "\n".join(lines) + "\n"
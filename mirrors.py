@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mirrors.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Mirror registry
+
+servers.json is parsed once and kept in memory with coordinates already
+converted to radians, so picking a mirror for a request is arithmetic
+only. The file is watched by mtime and swapped in atomically when it
+changes.
+
+With NumPy installed, large mirror lists are ranked in a single vectorized
+pass and many client locations can be ranked at once. Every load also
+builds a k-d tree of the mirrors (see spatial.py), so finding the closest
+few is O(log n) however many mirrors there are.
+"""
+import json
+import math
+import os
+import random as rand
+import time
+import urllib3
+import spatial
+import upstream
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SERVERS_FILE = "servers.json"
+BACKUP_URL = "https://raw.githubusercontent.com/drauger-os-development/download-optimizer/master/servers.json"
+# Radius of earth in kilometers
+EARTH_RADIUS = 6371
+# below this many mirrors, plain Python is faster than setting up NumPy arrays
+VECTOR_THRESHOLD = 32
+# below this many mirrors, checking every one is faster than the k-d tree
+TREE_THRESHOLD = 64
+# longest wait, in seconds, between tries at loading a mirror list that failed
+MAX_BACKOFF = 300
+
+
+class NoMirrors(LookupError):
+    """Raised when there is no mirror list to pick from"""
+
+
+class Mirror:
+    """A single mirror and its precomputed coordinates
+
+    `capacity` is how much bandwidth the mirror has, in Gbit/s, from the
+    optional third item of its entry in servers.json, {"capacity": 10}.
+    """
+    __slots__ = ("url", "region", "lat", "lon", "lat_rad", "lon_rad", "cos_lat", "capacity")
+
+    def __init__(self, url, region, lat, lon, capacity=1.0):
+        self.url = url
+        self.region = region
+        self.capacity = float(capacity)
+        self.lat = float(lat)
+        self.lon = float(lon)
+        self.lat_rad = math.radians(self.lat)
+        self.lon_rad = math.radians(self.lon)
+        self.cos_lat = math.cos(self.lat_rad)
+
+    def __repr__(self):
+        return f"Mirror({ self.url!r}, { self.region!r}, { self.lat }, { self.lon })"
+
+
+class MirrorRegistry:
+    """In-memory, hot-reloadable list of mirrors"""
+    def __init__(self, path=SERVERS_FILE, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        # (mirrors, coordinate arrays, k-d tree) swapped as one object
+        self.state = ((), None, None)
+        self.mtime = None
+        self.last_check = 0
+        # failed loads in a row, and when to try again after the last one
+        self.failures = 0
+        self.retry_at = 0
+        # bumped on every reload so dependent caches know to throw things out
+        self.version = 0
+
+    def refresh(self):
+        """Reload servers.json if it has changed since we last looked"""
+        now = time.monotonic()
+        if self.mtime is not None and now - self.last_check < self.check_interval:
+            return
+        if now < self.retry_at:
+            return
+        self.last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except (FileNotFoundError, PermissionError):
+            mtime = None
+        if mtime is not None and mtime == self.mtime:
+            return
+        if mtime is None and self.state[0] != ():
+            # keep serving whatever we had last
+            return
+        try:
+            self.load(mtime)
+        except (ValueError, KeyError, TypeError, IndexError, urllib3.exceptions.HTTPError) as error:
+            print(f"ERROR LOADING MIRROR LIST: { error }")
+            print("Keeping previous mirror list...")
+            # don't retry a broken file until it changes again
+            self.mtime = mtime
+            if mtime is None:
+                # nor a missing one on every request while the backup can't be had
+                self.failures += 1
+                self.retry_at = now + min(MAX_BACKOFF,
+                                          self.check_interval * (2 ** min(self.failures - 1, 16)))
+            return
+        self.failures = 0
+        self.retry_at = 0
+
+    def load(self, mtime=None):
+        """Parse the mirror list and swap it in"""
+        if mtime is None:
+            print(f"{ self.path } not found. Fetching { BACKUP_URL }...")
+            data = json.loads(upstream.request("GET", BACKUP_URL).data)
+            # pretend the backup has an mtime so we don't fetch it again
+            mtime = 0
+        else:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        mirrors = []
+        for region in data:
+            for server in data[region]:
+                extra = server[2] if len(server) > 2 else {}
+                if not isinstance(extra, dict):
+                    raise ValueError(f"options for { server[0] } must be an object")
+                capacity = extra.get("capacity", 1.0)
+                if isinstance(capacity, bool) or not isinstance(capacity, (int, float)) \
+                   or not capacity >= 0:
+                    raise ValueError(f"capacity of { server[0] } must be a number of at least 0")
+                mirrors.append(Mirror(server[0], region, server[1][0], server[1][1], capacity))
+        if mirrors == []:
+            raise ValueError("mirror list is empty")
+        coords = None
+        if numpy is not None:
+            coords = numpy.array([[each.lat_rad for each in mirrors],
+                                  [each.lon_rad for each in mirrors],
+                                  [each.cos_lat for each in mirrors]])
+        tree = spatial.KDTree(spatial.to_vector(each.lat, each.lon) for each in mirrors)
+        # a single assignment, so readers always see a complete list
+        self.state = (tuple(mirrors), coords, tree)
+        self.mtime = mtime
+        self.version += 1
+
+    @property
+    def mirrors(self):
+        """The mirror list as last loaded"""
+        return self.state[0]
+
+    def get_mirrors(self):
+        """Get the current mirror list, reloading it if needed"""
+        self.refresh()
+        return self.state[0]
+
+    def distances(self, loc):
+        """Get (distance in km, mirror) for every mirror, from a (lat, lon) pair"""
+        lat = math.radians(float(loc[0]))
+        lon = math.radians(float(loc[1]))
+        cos_lat = math.cos(lat)
+        output = []
+        for each in self.get_mirrors():
+            a = (math.sin((each.lat_rad - lat) / 2) ** 2) + \
+                (cos_lat * each.cos_lat * (math.sin((each.lon_rad - lon) / 2) ** 2))
+            output.append((2 * EARTH_RADIUS * math.asin(math.sqrt(a)), each))
+        return output
+
+    def rank(self, loc, k=None):
+        """Get mirror URLs ordered from closest to furthest from `loc`
+
+        Only the closest `k` are returned if `k` is given. Equally distant
+        mirrors keep the order they have in servers.json.
+        """
+        self.refresh()
+        mirrors, coords, tree = self.state
+        if k is not None and len(mirrors) >= TREE_THRESHOLD:
+            return [mirrors[each[1]].url for each in tree.nearest(spatial.to_vector(*loc), k)]
+        if coords is None or len(mirrors) < VECTOR_THRESHOLD:
+            ranked = sorted(self.distances(loc), key=lambda x: x[0])
+            return [each[1].url for each in ranked[:k]]
+        points = numpy.radians(numpy.array([[float(loc[0]), float(loc[1])]]))
+        distances = __great_circle__(points, coords)[0]
+        return [mirrors[each].url for each in __top_k__(distances, k)]
+
+    def rank_many(self, locs, k=1):
+        """Rank mirrors for many (lat, lon) pairs at once
+
+        Returns a list with the `k` closest mirror URLs for each location,
+        for precomputing region -> mirror tables.
+        """
+        self.refresh()
+        mirrors, coords = self.state[:2]
+        if coords is None:
+            return [self.rank(each, k) for each in locs]
+        points = numpy.radians(numpy.array(locs, dtype=float).reshape(-1, 2))
+        distances = __great_circle__(points, coords)
+        k = min(k, len(mirrors))
+        if k < len(mirrors):
+            picked = numpy.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            picked = numpy.broadcast_to(numpy.arange(len(mirrors)), distances.shape)
+        picked_distances = numpy.take_along_axis(distances, picked, axis=1)
+        order = numpy.lexsort((picked, picked_distances), axis=1)
+        picked = numpy.take_along_axis(picked, order, axis=1)
+        output = []
+        for row in enumerate(picked):
+            if k < len(mirrors) and \
+               numpy.count_nonzero(distances[row[0]] <= picked_distances[row[0]].max()) > k:
+                # a tie at the cut off, argpartition may have kept the wrong one
+                row = (row[0], __top_k__(distances[row[0]], k))
+            output.append([mirrors[each].url for each in row[1]])
+        return output
+
+    def nearest(self, loc, k=1, healthy=None, distances=False):
+        """Get the URLs of the `k` closest mirrors to `loc`, closest first
+
+        Only mirrors for which `healthy(url)` is true are counted, so this
+        can be fewer than `k`. Down mirrors are skipped while searching,
+        rather than the tree being rebuilt without them. With `distances`,
+        (distance in km, mirror) pairs are returned instead of URLs.
+        """
+        self.refresh()
+        mirrors, coords, tree = self.state
+        if len(mirrors) < TREE_THRESHOLD:
+            if distances:
+                ranked = sorted(self.distances(loc), key=lambda x: x[0])
+                if healthy is not None:
+                    ranked = [each for each in ranked if healthy(each[1].url)]
+                return ranked[:k]
+            ranked = self.rank(loc)
+            if healthy is not None:
+                ranked = [each for each in ranked if healthy(each)]
+            return ranked[:k]
+        accept = None
+        if healthy is not None:
+            accept = lambda index: healthy(mirrors[index].url)
+        found = tree.nearest(spatial.to_vector(*loc), k, accept)
+        if distances:
+            return [(spatial.chord_to_km(each[0], EARTH_RADIUS), mirrors[each[1]]) for each in found]
+        return [mirrors[each[1]].url for each in found]
+
+    def random_url(self):
+        """Get the URL of a random mirror"""
+        mirrors = self.get_mirrors()
+        if not mirrors:
+            raise NoMirrors(f"no mirror list: { self.path } could not be loaded, nor { BACKUP_URL }")
+        return rand.choice(mirrors).url
+
+
+def __great_circle__(points, coords):
+    """Distances in km from each (lat, lon) in radians in `points` to every mirror"""
+    lat = points[:, 0:1]
+    lon = points[:, 1:2]
+    a = (numpy.sin((coords[0] - lat) / 2) ** 2) + \
+        (numpy.cos(lat) * coords[2] * (numpy.sin((coords[1] - lon) / 2) ** 2))
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+
+def __top_k__(distances, k=None):
+    """Indexes of the `k` smallest distances, closest first, ties by index"""
+    if k is None or k >= len(distances):
+        return numpy.argsort(distances, kind="stable")
+    cut_off = distances[numpy.argpartition(distances, k - 1)[k - 1]]
+    # everything at or under the cut off, so ties at the edge are all considered
+    candidates = numpy.flatnonzero(distances <= cut_off)
+    order = numpy.lexsort((candidates, distances[candidates]))
+    return candidates[order][:k]
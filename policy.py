@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  policy.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Mirror selection policies
+
+Picked with the `selection_policy` setting:
+
+ - "nearest" (the default): the closest mirror that is up
+ - "weighted": one of the closest few mirrors, at random, by weight
+ - "p2c": two of the closest few drawn by weight, and whichever of them
+   is less loaded for its capacity
+ - "measured": whichever of the closest few clients nearby can expect to
+   download from fastest, going by their reports in latency.py
+
+The closest few, the candidates, are at most `policy_candidates` mirrors,
+none more than `policy_slack_km` further away than the closest, except
+under "measured", where distance is only what the estimates fall back on.
+A candidate's weight is its capacity from servers.json, halved for every
+`policy_distance_km` it is further away than the closest, and cut down
+by its latency as last measured by the health checker. Load is this
+worker's recent redirects to a mirror, decayed with a half-life of
+`policy_half_life` seconds. "weighted" divides the weight by the load per
+Gbit/s of capacity too, so a busy mirror is picked less.
+"""
+import random
+import time
+import common
+
+POLICIES = ("nearest", "weighted", "p2c", "measured")
+# latency at which a mirror's weight is halved, in seconds
+LATENCY_SCALE = 0.1
+# capacity a mirror is loaded against when servers.json gives it none
+MIN_CAPACITY = 0.001
+
+
+class LoadTracker:
+    """Exponentially decaying count of recent redirects to each mirror"""
+    def __init__(self, half_life=None):
+        self.half_life = half_life
+        # url: (count, as of)
+        self.counts = {}
+
+    def get(self, url, now=None):
+        """Recent redirects to a mirror"""
+        if now is None:
+            now = time.monotonic()
+        count, when = self.counts.get(url, (0.0, now))
+        half_life = self.half_life or common.get_setting("policy_half_life", 60)
+        return count * (0.5 ** ((now - when) / half_life))
+
+    def add(self, url, now=None):
+        """Count a redirect to a mirror"""
+        if now is None:
+            now = time.monotonic()
+        self.counts[url] = (self.get(url, now) + 1, now)
+
+
+LOAD = LoadTracker()
+
+
+def get_policy():
+    """Get the selection policy in use"""
+    name = common.get_setting("selection_policy", "nearest")
+    return name if name in POLICIES else "nearest"
+
+
+def candidates(registry, loc, healthy=None, policy=None):
+    """Mirrors worth sending a client at `loc` to, as (km, mirror), closest first"""
+    if (policy or get_policy()) == "nearest":
+        return registry.nearest(loc, 1, healthy, distances=True)
+    found = registry.nearest(loc, common.get_setting("policy_candidates", 4), healthy,
+                             distances=True)
+    if (policy or get_policy()) == "measured":
+        return found
+    slack = common.get_setting("policy_slack_km", 1500)
+    return [each for each in found if each[0] <= found[0][0] + slack]
+
+
+def weights(found, latency=None):
+    """Weight of each of the candidates"""
+    scale = common.get_setting("policy_distance_km", 1000)
+    closest = found[0][0]
+    output = []
+    for distance, mirror in found:
+        value = mirror.capacity * (0.5 ** ((distance - closest) / scale))
+        measured = latency(mirror.url) if latency is not None else None
+        if measured is not None:
+            value /= 1 + (measured / LATENCY_SCALE)
+        output.append(value)
+    return output
+
+
+def choose(found, latency=None, policy=None, load=LOAD, now=None, expected=None):
+    """Pick a mirror URL from the candidates
+
+    `latency(url)` gives a mirror's last measured latency in seconds, or
+    None. `expected(km, mirror)` gives the seconds a download from a mirror
+    is expected to take, for "measured". `now` is for simulations, which
+    keep their own clock.
+    """
+    policy = policy or get_policy()
+    if policy == "nearest" or (policy == "measured" and expected is None):
+        return found[0][1].url
+    if len(found) == 1:
+        url = found[0][1].url
+    elif policy == "measured":
+        # the closer one wins a tie
+        url = min(enumerate(found), key=lambda each: (expected(*each[1]), each[0]))[1][1].url
+    else:
+        weight = weights(found, latency)
+        if sum(weight) <= 0:
+            # a capacity of 0 everywhere. Don't let that stop us
+            weight = [1.0] * len(found)
+        pressure = [load.get(each[1].url, now) / max(each[1].capacity, MIN_CAPACITY)
+                    for each in found]
+        if policy == "weighted":
+            weight = [each / (1 + pressure[index]) for index, each in enumerate(weight)]
+            url = random.choices(found, weight)[0][1].url
+        else:
+            first = random.choices(range(len(found)), weight)[0]
+            weight[first] = 0
+            second = first
+            if sum(weight) > 0:
+                second = random.choices(range(len(found)), weight)[0]
+            # the closer one, by index, wins a tie
+            if pressure[second] < pressure[first] or \
+               (pressure[second] == pressure[first] and second < first):
+                first = second
+            url = found[first][1].url
+    load.add(url, now)
+    return url
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  spatial.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Nearest-neighbour search over points on the Earth
+
+Points are stored as 3D unit vectors in a k-d tree. The straight-line
+(chord) distance between two unit vectors only grows with the great circle
+distance between them, so the closest by one is the closest by the other,
+and a plane through the tree is an exact bound to prune against.
+"""
+import heapq
+import math
+
+# more points than this in a leaf are just scanned
+LEAF_SIZE = 8
+
+
+def to_vector(lat, lon):
+    """Unit vector for a latitude and longitude in degrees"""
+    lat = math.radians(float(lat))
+    lon = math.radians(float(lon))
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord, radius=6371):
+    """Great circle distance for a chord between two unit vectors"""
+    return 2 * radius * math.asin(min(1.0, chord / 2))
+
+
+class KDTree:
+    """k-d tree over unit vectors, each with the index it was given at
+
+    Nodes live in flat lists rather than objects. A node is either a split
+    (axis, value, left child, right child) or a leaf (axis of -1, and the
+    start and end of its points in `order`).
+    """
+    def __init__(self, vectors):
+        self.vectors = list(vectors)
+        self.order = list(range(len(self.vectors)))
+        self.nodes = []
+        if self.vectors:
+            self.__build__(0, len(self.order))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __build__(self, start, end):
+        """Build the subtree over order[start:end]. Returns its node number"""
+        node = len(self.nodes)
+        if end - start <= LEAF_SIZE:
+            self.nodes.append((-1, 0.0, start, end))
+            return node
+        points = self.order[start:end]
+        # split on whichever axis the points are most spread out along
+        spreads = []
+        for axis in range(3):
+            values = [self.vectors[each][axis] for each in points]
+            spreads.append(max(values) - min(values))
+        axis = spreads.index(max(spreads))
+        points.sort(key=lambda each: self.vectors[each][axis])
+        self.order[start:end] = points
+        middle = start + ((end - start) // 2)
+        value = self.vectors[self.order[middle]][axis]
+        self.nodes.append(None)
+        left = self.__build__(start, middle)
+        right = self.__build__(middle, end)
+        self.nodes[node] = (axis, value, left, right)
+        return node
+
+    def nearest(self, vector, k=1, accept=None):
+        """Get (chord distance, index) of the `k` closest points, closest first
+
+        Points for which `accept(index)` is false are passed over, without
+        changing the tree. Equally distant points come lowest index first.
+        """
+        if not self.nodes or k < 1:
+            return []
+        x, y, z = vector
+        # max heap, by negated (distance, index), of the best found so far
+        best = []
+        # every node we might still need to look in, with a lower bound on
+        # how close anything in it can be
+        stack = [(0.0, 0)]
+        vectors = self.vectors
+        while stack:
+            bound, node = stack.pop()
+            if len(best) == k and bound > -best[0][0]:
+                continue
+            axis, value, left, right = self.nodes[node]
+            if axis == -1:
+                for index in self.order[left:right]:
+                    point = vectors[index]
+                    distance = math.sqrt(((point[0] - x) ** 2) + ((point[1] - y) ** 2) +
+                                         ((point[2] - z) ** 2))
+                    if len(best) == k and (distance, index) >= (-best[0][0], -best[0][1]):
+                        continue
+                    if accept is not None and not accept(index):
+                        continue
+                    if len(best) == k:
+                        heapq.heapreplace(best, (-distance, -index))
+                    else:
+                        heapq.heappush(best, (-distance, -index))
+                continue
+            gap = vector[axis] - value
+            near, far = (left, right) if gap < 0 else (right, left)
+            # the far side is pushed first, so the near side is looked at first
+            stack.append((max(bound, abs(gap)), far))
+            stack.append((bound, near))
+        return sorted((-distance, -index) for distance, index in best)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  stats.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Download statistics engine
+
+Totals per day, week, month and year (rollups) are kept up to date from
+the statistics store a row at a time: a new day is added to them, and
+more downloads on the last day are added to that day. The whole history is
+only read again if the store is rewritten. Range queries bisect into a
+rollup, so they cost the same however much history there is.
+
+The rendered /stats page is kept too, along with an ETag that changes with
+the store, today's count and the settings. Until one of those changes the
+same bytes are served, or a 304 if the browser already has them.
+"""
+import bisect
+import datetime
+import os
+from flask import render_template
+import common
+import statstore
+
+# most buckets one page of a query can hold
+MAX_PAGE = 1000
+
+
+def __day__(ordinal):
+    """First day of a day"""
+    return ordinal
+
+
+def __week__(ordinal):
+    """First day of a week. Weeks start on Monday"""
+    return ordinal - datetime.date.fromordinal(ordinal).weekday()
+
+
+def __month__(ordinal):
+    """First day of a month"""
+    return datetime.date.fromordinal(ordinal).replace(day=1).toordinal()
+
+
+def __year__(ordinal):
+    """First day of a year"""
+    return datetime.date.fromordinal(ordinal).replace(month=1, day=1).toordinal()
+
+
+PERIODS = {"day": __day__, "week": __week__, "month": __month__, "year": __year__}
+
+
+class Rollup:
+    """Downloads, bytes and day counts per period, in date order"""
+    def __init__(self, period):
+        self.period = period
+        # ordinal of the first day of each period
+        self.starts = []
+        self.downloads = []
+        self.sizes = []
+        self.days = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, ordinal, downloads, size, new_day):
+        """Count a day, or more of the last day, in its period"""
+        start = self.period(ordinal)
+        if not self.starts or self.starts[-1] != start:
+            self.starts.append(start)
+            self.downloads.append(0)
+            self.sizes.append(0)
+            self.days.append(0)
+        self.downloads[-1] += downloads
+        self.sizes[-1] += size
+        if new_day:
+            self.days[-1] += 1
+
+    def query(self, start=None, end=None, page=1, per_page=100):
+        """One page of the periods from `start` to `end` (ordinals, inclusive)
+
+        Returns (total periods in range, [(start, downloads, bytes, days), ...]).
+        Every period that overlaps the range is included, whole.
+        """
+        low = 0 if start is None else bisect.bisect_left(self.starts, self.period(start))
+        high = len(self.starts) if end is None else bisect.bisect_right(self.starts, end)
+        high = max(low, high)
+        first = low + ((page - 1) * per_page)
+        last = min(high, first + per_page)
+        return high - low, [(self.starts[index], self.downloads[index],
+                             self.sizes[index], self.days[index])
+                            for index in range(first, last)]
+
+
+class StatsEngine:
+    """Incrementally maintained rollups over the statistics store"""
+    def __init__(self):
+        self.stamp = None
+        self.page = None
+        self.__reset__()
+
+    def __reset__(self):
+        """Forget everything, so the next refresh reads the whole store"""
+        self.applied = 0
+        self.last = None
+        self.rollups = {name: Rollup(period) for name, period in PERIODS.items()}
+        self.overall = 0
+
+    def __fold__(self, ordinal, downloads, size, new_day):
+        """Fold one day, or more of the last day, into every rollup"""
+        for rollup in self.rollups.values():
+            rollup.add(ordinal, downloads, size, new_day)
+        self.overall += downloads
+
+    def refresh(self):
+        """Catch up with the store. Returns True if anything changed"""
+        store = common.get_store()
+        stamp = store.stamp()
+        if stamp == self.stamp:
+            return False
+        ordinals = store.ordinals
+        downloads = store.downloads
+        sizes = store.sizes
+        if self.stamp is None or stamp[0] != self.stamp[0] or stamp[1] < self.stamp[1] or \
+           not self.__continues__(ordinals, downloads):
+            # rewritten, not appended to. A new file can get an old inode back
+            # and the same size, so the rows already folded in are checked too
+            self.__reset__()
+        if self.applied:
+            index = self.applied - 1
+            self.__fold__(self.last[0], downloads[index] - self.last[1],
+                          sizes[index] - self.last[2], False)
+        for index in range(self.applied, len(ordinals)):
+            self.__fold__(ordinals[index], downloads[index], sizes[index], True)
+        self.applied = len(ordinals)
+        if self.applied:
+            self.last = (ordinals[-1], downloads[-1], sizes[-1])
+        self.stamp = stamp
+        return True
+
+    def __continues__(self, ordinals, downloads):
+        """Whether the store still starts with the rows already folded in"""
+        if not self.applied:
+            return True
+        index = self.applied - 1
+        return len(ordinals) >= self.applied and ordinals[index] == self.last[0] and \
+            downloads[index] >= self.last[1]
+
+    def query(self, granularity, start=None, end=None, page=1, per_page=100):
+        """Totals per `granularity` from `start` to `end`, a page at a time"""
+        self.refresh()
+        total, rows = self.rollups[granularity].query(start, end, page, per_page)
+        return {"granularity": granularity, "page": page, "per_page": per_page,
+                "total": total, "pages": -(-total // per_page),
+                "data": [{"start": datetime.date.fromordinal(ordinal).isoformat(),
+                          "downloads": downloads, "bytes": size, "days": days}
+                         for ordinal, downloads, size, days in rows]}
+
+    def etag(self, live=True):
+        """ETag and Last-Modified time for what would be served now
+
+        With `live`, today's count and the settings are taken into account.
+        """
+        stamps = [common.get_store().stamp()]
+        for each in (common.CURRENT_COUNT_FILE, common.SETTINGS_FILE) if live else ():
+            try:
+                stat = os.stat(each)
+                stamps.append((stat.st_ino, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stamps.append((0, 0))
+        etag = "-".join(f"{ value:x}" for each in stamps for value in each)
+        modified = max([stamps[0][2]] + [each[1] for each in stamps[1:]]) / 1000000000
+        return etag, modified
+
+    def today(self):
+        """Downloads so far today, as of the last time the counts were written"""
+        try:
+            with open(common.CURRENT_COUNT_FILE, "r") as file:
+                return int(file.read().split(",")[0])
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def context(self, current):
+        """Template variables for stats.html"""
+        days = self.rollups["day"]
+        labels = [" ".join(statstore.date_parts(each)) for each in days.starts[-7:]]
+        values = days.downloads[-7:]
+        if len(days) >= 7:
+            week_avrg = " ".join(labels[0].split(" ")[:-1]) + " thru " + \
+                        " ".join(labels[-1].split(" ")[:-1]) + " - " + \
+                        "%.2f" % (sum(values) / 7)
+        else:
+            week_avrg = "0"
+        return {"overall_total": self.overall + current,
+                "week_avrg": week_avrg,
+                "week_total_labels": labels,
+                "week_total_values": values,
+                "first_day": datetime.date.fromordinal(days.starts[0]).isoformat(),
+                "last_day": datetime.date.fromordinal(days.starts[-1]).isoformat(),
+                "daily_total": current,
+                "about_link": common.get_setting("about_link",
+                                                 "https://download-optimizer.draugeros.org/about")}
+
+    def render(self):
+        """Get (etag, last modified, page), rendering only if something changed"""
+        etag, modified = self.etag()
+        if self.page is not None and self.page[0] == etag:
+            return self.page
+        self.refresh()
+        current = self.today()
+        if not len(self.rollups["day"]):
+            page = render_template("stats-none.html", daily_total=current)
+        else:
+            page = render_template("stats.html", **self.context(current))
+        self.page = (etag, modified, page)
+        return self.page
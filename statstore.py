@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  statstore.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Binary store for long-term download statistics
+
+One fixed-width row per day: (date ordinal, downloads, bytes), as three
+signed 64 bit integers, kept in date order. The first row is a header.
+Readers memory-map the file and read rows and columns straight out of the
+map, finding date ranges with bisect. Adding a day after the last one is
+a single append.
+
+To build the store from the text file and archives:
+
+    python3 statstore.py migrate [store]
+"""
+import bisect
+import calendar
+import datetime
+import mmap
+import os
+import sys
+
+STATS_STORE_FILE = "download_stats.bin"
+MAGIC = 0x5453_5453_4f44  # "DOSTST"
+VERSION = 1
+FIELDS = 3
+ROW = FIELDS * 8
+GB = 1073741824
+MONTHS = list(calendar.month_name)
+# date ordinal: ("Month", "DD", "YYYY"), filled as entries() needs them
+DATES = {}
+
+
+class StatStore:
+    """Daily (ordinal, downloads, bytes) rows in a memory-mapped file"""
+    def __init__(self, path=STATS_STORE_FILE):
+        self.path = path
+        self.key = None
+        self.mmap = None
+        self.words = memoryview(b"").cast("q")
+
+    def __map__(self):
+        """Get the rows as 64 bit words, remapping if the file has changed"""
+        stat = os.stat(self.path)
+        # the mtime too, in case a rewrite got the old inode and size back
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if key != self.key:
+            with open(self.path, "rb") as file:
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            # ignore a row torn by a crash mid-append
+            words = memoryview(self.mmap)[:len(self.mmap) - (len(self.mmap) % ROW)].cast("q")
+            if len(words) < FIELDS or words[0] != MAGIC or words[1] != VERSION:
+                raise ValueError(f"{ self.path } is not a statistics store")
+            self.words = words[FIELDS:]
+            self.key = key
+        return self.words
+
+    def stamp(self):
+        """Something that changes whenever the store does"""
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def __len__(self):
+        return len(self.__map__()) // FIELDS
+
+    @property
+    def ordinals(self):
+        """Every row's date ordinal, without copying"""
+        return self.__map__()[0::FIELDS]
+
+    @property
+    def downloads(self):
+        """Every row's download count, without copying"""
+        return self.__map__()[1::FIELDS]
+
+    @property
+    def sizes(self):
+        """Every row's bytes served, without copying"""
+        return self.__map__()[2::FIELDS]
+
+    def span(self, start=None, end=None):
+        """Indexes of the first row on or after `start`, and the first after `end`
+
+        `start` and `end` are date ordinals, or None for no limit.
+        """
+        ordinals = self.ordinals
+        low = 0 if start is None else bisect.bisect_left(ordinals, start)
+        high = len(ordinals) if end is None else bisect.bisect_right(ordinals, end)
+        return low, max(low, high)
+
+    def rows(self, start=None, end=None):
+        """Rows from `start` to `end`, inclusive, as a flat view of words"""
+        low, high = self.span(start, end)
+        return self.__map__()[low * FIELDS:high * FIELDS]
+
+    def get(self, ordinal):
+        """(downloads, bytes) for a day, or None"""
+        words = self.rows(ordinal, ordinal)
+        if len(words) == 0:
+            return None
+        return words[1], words[2]
+
+    def add(self, ordinal, downloads, size=0):
+        """Add to a day's totals, appending a row for it if needed
+
+        Only one process should write to a store at a time. Only the last
+        row is ever changed in place. Anything else rewrites the file, so
+        readers can tell the two apart by its inode.
+        """
+        if not os.path.exists(self.path):
+            self.replace([])
+        ordinals = self.ordinals
+        index = bisect.bisect_left(ordinals, ordinal)
+        if index == len(ordinals) - 1 and ordinals[index] == ordinal:
+            row = __row__(ordinal, self.downloads[index] + downloads, self.sizes[index] + size)
+            offset = (index + 1) * ROW
+        elif index == len(ordinals):
+            row = __row__(ordinal, downloads, size)
+            # right after the last whole row, over anything torn by a crash
+            offset = (index + 1) * ROW
+        else:
+            # a day before the last one. Rare enough to just rewrite
+            rows = list(self.iter_rows())
+            if ordinals[index] == ordinal:
+                rows[index] = (ordinal, rows[index][1] + downloads, rows[index][2] + size)
+            else:
+                rows.insert(index, (ordinal, downloads, size))
+            self.replace(rows)
+            return
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, row, offset)
+            if index == len(ordinals):
+                os.ftruncate(fd, offset + ROW)
+        finally:
+            os.close(fd)
+
+    def iter_rows(self, start=None, end=None):
+        """(ordinal, downloads, bytes) tuples from `start` to `end`"""
+        words = self.rows(start, end)
+        for index in range(0, len(words), FIELDS):
+            yield words[index], words[index + 1], words[index + 2]
+
+    def replace(self, rows):
+        """Atomically replace every row. `rows` must be in date order"""
+        tmp = f"{ self.path }.{ os.getpid() }.tmp"
+        with open(tmp, "wb") as file:
+            file.write(__row__(MAGIC, VERSION, 0))
+            for each in rows:
+                file.write(__row__(*each))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
+
+    def entries(self, start=None, end=None):
+        """Rows as common.parse_data() entries: [[month, day, year], count, GB]"""
+        words = self.rows(start, end)
+        ordinals = words[0::FIELDS].tolist()
+        downloads = words[1::FIELDS].tolist()
+        sizes = words[2::FIELDS].tolist()
+        return [[list(DATES.get(ordinal) or date_parts(ordinal)), downloads[index], sizes[index] / GB]
+                for index, ordinal in enumerate(ordinals)]
+
+
+def date_parts(ordinal):
+    """("Month", "DD", "YYYY") for a date ordinal, remembering it for next time"""
+    if ordinal in DATES:
+        return DATES[ordinal]
+    date = datetime.date.fromordinal(ordinal)
+    # much faster than strftime() and split(), and the same names
+    DATES[ordinal] = (MONTHS[date.month], f"{ date.day:02d}", str(date.year))
+    return DATES[ordinal]
+
+
+def __row__(*words):
+    """Pack a row"""
+    return b"".join(each.to_bytes(8, "little", signed=True) for each in words)
+
+
+def to_ordinal(date):
+    """Date ordinal for a ["Month", "DD", "YYYY"] date from a data file"""
+    return datetime.datetime.strptime(" ".join(date), "%B %d %Y").toordinal()
+
+
+def migrate(text_file="download_count_longterm.txt", path=STATS_STORE_FILE):
+    """Build a store from the long-term text file and every archive. Returns row count"""
+    # only needed once, and both of these need common, which needs us
+    import archive
+    import common
+    totals = {}
+    texts = []
+    if os.path.isdir("archives"):
+        for name in sorted(os.listdir("archives")):
+            if name.endswith(archive.SUFFIXES):
+                try:
+                    texts.append(archive.read_archive(name))
+                except archive.ERRORS as error:
+                    print(f"ERROR READING ARCHIVE { name }: { error }. Skipping it...")
+    if os.path.exists(text_file):
+        with open(text_file, "r") as file:
+            texts.append(file.read())
+    for text in texts:
+        for entry in common.parse_data(text):
+            ordinal = to_ordinal(entry[0])
+            downloads, size = totals.get(ordinal, (0, 0))
+            size += round(entry[2] * GB) if len(entry) > 2 else 0
+            totals[ordinal] = (downloads + entry[1], size)
+    store = StatStore(path)
+    store.replace((ordinal, *totals[ordinal]) for ordinal in sorted(totals))
+    return len(totals)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: statstore.py migrate [store]")
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        count = migrate(path=sys.argv[2])
+    else:
+        count = migrate()
+    print(f"Migrated { count } days")
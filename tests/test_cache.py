@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_cache.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the SQLite cache shared between workers
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cache
+
+THREADS = 8
+KEYS = 200
+
+
+class Locked:
+    """Stands in for a connection to a database someone else has locked"""
+    def execute(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+
+class SharedCacheTest(unittest.TestCase):
+    """SharedCache in a temporary directory"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cache.SharedCache(os.path.join(self.tmp.name, "cache.sqlite3"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"loc": "1,2"})
+        self.assertEqual(self.cache.get("a"), {"loc": "1,2"})
+        self.cache.set("b", 1, ttl=-1)
+        self.assertIsNone(self.cache.get("b"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 2, 2))
+
+    def test_connection_per_thread(self):
+        conns = []
+        errors = []
+
+        def worker(number):
+            conns.append(self.cache.__connect__())
+            try:
+                for each in range(KEYS):
+                    self.cache.set(f"{ number }-{ each }", each)
+                    if self.cache.get(f"{ number }-{ each }") != each:
+                        errors.append(each)
+            except sqlite3.Error as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=worker, args=(each,)) for each in range(THREADS)]
+        for each in threads:
+            each.start()
+        for each in threads:
+            each.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len({id(each) for each in conns}), THREADS)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["entries"]), (THREADS * KEYS, THREADS * KEYS))
+
+    def test_stats_while_locked(self):
+        self.cache.set("a", 1)
+        self.cache.get("a")
+        before = self.cache.stats()
+        self.cache.local.conn = Locked()
+        self.assertEqual(self.cache.stats(), before)
+        self.assertIsNone(self.cache.get("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_counters.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the shared download counters
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import counters
+
+SLOTS = 64
+SIZE = 2147483648
+
+
+def hammer(path, threads, increments):
+    """Count from several threads of one process"""
+    table = counters.CounterTable(path, slots=SLOTS)
+
+    def work():
+        for each in range(increments):
+            table.add(1, SIZE)
+
+    pool = [threading.Thread(target=work) for each in range(threads)]
+    for each in pool:
+        each.start()
+    for each in pool:
+        each.join()
+
+
+def collector(path, stop, results):
+    """Collect until told to stop, then report the totals"""
+    table = counters.CounterTable(path, slots=SLOTS)
+    downloads = data = 0
+    while not stop.is_set():
+        count, size = table.collect()
+        downloads += count
+        data += size
+    results.put((downloads, data))
+
+
+class CounterTableTest(unittest.TestCase):
+    """CounterTable, from one process and from many"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "counters.bin")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_collect_takes_each_increment_once(self):
+        table = counters.CounterTable(self.path, slots=SLOTS)
+        table.add(2, 10)
+        table.add_at((1, 5))
+        self.assertEqual(table.pending(), (2, 15))
+        self.assertEqual(table.collect(), (2, 15))
+        self.assertEqual(table.collect(), (0, 0))
+        table.add(1, 1)
+        self.assertEqual(table.collect(), (1, 1))
+        self.assertEqual(table.totals(), (3, 16))
+
+    def test_exact_under_concurrent_load(self):
+        # every round starts new processes, so slots left by dead ones get reused
+        rounds, processes, threads, increments = 3, 4, 3, 2000
+        counters.CounterTable(self.path, slots=SLOTS)
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        watcher = multiprocessing.Process(target=collector, args=(self.path, stop, results))
+        watcher.start()
+        for each in range(rounds):
+            pool = [multiprocessing.Process(target=hammer, args=(self.path, threads, increments))
+                    for each in range(processes)]
+            for proc in pool:
+                proc.start()
+            for proc in pool:
+                proc.join()
+                self.assertEqual(proc.exitcode, 0)
+        stop.set()
+        downloads, data = results.get(timeout=60)
+        watcher.join()
+        count, size = counters.CounterTable(self.path, slots=SLOTS).collect()
+        expected = rounds * processes * threads * increments
+        self.assertEqual(downloads + count, expected)
+        self.assertEqual(data + size, expected * SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()
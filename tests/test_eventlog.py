@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_eventlog.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for compacting the download event log, and recovering it after a crash
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import eventlog
+
+SIZE = 2147483648
+# logs and flushes, then dies without sealing its segment
+CRASH = f"""
+import os, sys
+sys.path.insert(0, { repr(ROOT) })
+import eventlog
+for each in range(50):
+    eventlog.log("ISOs/Drauger_OS-7.7.iso", { SIZE }, "https://mirror.example/", "DE")
+eventlog.flush()
+os._exit(0)
+"""
+
+
+def segments():
+    """Names of every segment left in the event log"""
+    return sorted(os.listdir(eventlog.EVENT_LOG_DIR))
+
+
+class CompactTest(unittest.TestCase):
+    """compact() into a temporary directory"""
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.today = eventlog.day_key(time.time())
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def log(self, count, country="US"):
+        """Log `count` downloads and seal the segment they went to"""
+        for each in range(count):
+            eventlog.log("ISOs/Drauger_OS-7.7.iso", SIZE, "https://mirror.example/", country)
+        eventlog.flush(seal=True)
+
+    def test_totals(self):
+        self.log(3)
+        # size not known yet, then logged on its own
+        eventlog.log("ISOs/Drauger_OS-7.7.iso", 0, "https://other.example/", "DE")
+        eventlog.log("ISOs/Drauger_OS-7.7.iso", SIZE, "https://other.example/", "DE", downloads=0)
+        eventlog.flush(seal=True)
+        daily = eventlog.compact()
+        day = daily["days"][self.today]
+        self.assertEqual((day["downloads"], day["bytes"]), (4, 4 * SIZE))
+        self.assertEqual(sum(each[0] for each in day["hours"]), 4)
+        self.assertEqual(day["mirrors"], {"https://mirror.example/": [3, 3 * SIZE],
+                                          "https://other.example/": [1, SIZE]})
+        self.assertEqual(day["countries"], {"US": [3, 3 * SIZE], "DE": [1, SIZE]})
+        self.assertEqual(segments(), [])
+        self.assertEqual(eventlog.load(), daily)
+
+    def test_adds_up_across_runs(self):
+        self.log(3)
+        eventlog.compact()
+        self.log(2)
+        daily = eventlog.compact()
+        self.assertEqual(daily["days"][self.today]["downloads"], 5)
+
+    def test_applied_segment_not_counted_twice(self):
+        self.log(3)
+        name = segments()[0]
+        saved = os.path.join(self.tmp.name, "saved")
+        shutil.copy(os.path.join(eventlog.EVENT_LOG_DIR, name), saved)
+        eventlog.compact()
+        # a crash after the totals were saved, but before the segment was deleted
+        shutil.copy(saved, os.path.join(eventlog.EVENT_LOG_DIR, name))
+        daily = eventlog.compact()
+        self.assertEqual(daily["days"][self.today]["downloads"], 3)
+        self.assertEqual(segments(), [])
+        # and once it's gone, there's no need to remember it
+        self.assertEqual(eventlog.compact()["applied"], [])
+        self.assertEqual(eventlog.load()["applied"], [])
+
+    def test_recovers_dead_writer(self):
+        subprocess.run([sys.executable, "-c", CRASH], check=True)
+        left = segments()
+        self.assertEqual(len(left), 1)
+        self.assertTrue(left[0].endswith(".open"))
+        # torn by the crash, halfway through a line
+        with open(os.path.join(eventlog.EVENT_LOG_DIR, left[0]), "a") as file:
+            file.write(f"{ time.time():.3f}\t1\t{ SIZE }\thttps://mirror.exa")
+        daily = eventlog.compact()
+        self.assertEqual(daily["days"][self.today]["downloads"], 50)
+        self.assertEqual(daily["days"][self.today]["countries"], {"DE": [50, 50 * SIZE]})
+        self.assertEqual(segments(), [])
+
+    def test_leaves_live_writer(self):
+        os.makedirs(eventlog.EVENT_LOG_DIR)
+        name = f"{ os.getpid() }-{ time.time_ns() }.open"
+        with open(os.path.join(eventlog.EVENT_LOG_DIR, name), "w") as file:
+            file.write(f"{ time.time():.3f}\t1\t{ SIZE }\thttps://mirror.example/\tUS\tISOs/a.iso\n")
+        daily = eventlog.compact()
+        self.assertNotIn(self.today, daily["days"])
+        self.assertEqual(segments(), [name])
+
+    def test_seed(self):
+        self.assertTrue(eventlog.seed(self.today, 100, 10 * SIZE))
+        self.log(2)
+        daily = eventlog.compact()
+        day = daily["days"][self.today]
+        self.assertEqual((day["downloads"], day["bytes"]), (102, 12 * SIZE))
+        # only ever before the first compact()
+        self.assertFalse(eventlog.seed(self.today, 100, 10 * SIZE))
+        self.assertEqual(eventlog.load()["days"][self.today]["downloads"], 102)
+
+
+if __name__ == "__main__":
+    unittest.main()
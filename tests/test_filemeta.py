@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_filemeta.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for crawling a mirror's listing into the file metadata cache
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "benchmarks"))
+import cache
+import filemeta
+from stubs import MirrorHandler, StubServer
+
+
+class QuotingMirrorHandler(MirrorHandler):
+    """A mirror that only has files by their exact names, percent-encoded in its listing"""
+    files = ("Drauger%20OS%207.7.iso", "Drauger_OS-7.7.iso.sha256sum", "beta%231/")
+    names = ("/ISOs/Drauger%20OS%207.7.iso", "/ISOs/Drauger_OS-7.7.iso.sha256sum",
+             "/ISOs/beta%231/Drauger%20OS%207.7.iso", "/ISOs/beta%231/Drauger_OS-7.7.iso.sha256sum")
+
+    def do_HEAD(self):
+        if self.path not in self.names:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_HEAD()
+
+
+class CrawlTest(unittest.TestCase):
+    """crawl() into a cache in a temporary directory"""
+    def setUp(self):
+        # metrics.bin goes wherever we are
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.cache = mock.patch.object(filemeta, "CACHE", cache.SharedCache("meta.sqlite3"))
+        self.cache.start()
+
+    def tearDown(self):
+        self.cache.stop()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_decoded_paths(self):
+        with StubServer(QuotingMirrorHandler) as stub:
+            self.assertEqual(filemeta.crawl(stub.url), 4)
+        for path in ("ISOs/Drauger OS 7.7.iso", "ISOs/beta#1/Drauger OS 7.7.iso",
+                     "ISOs/beta#1/Drauger_OS-7.7.iso.sha256sum"):
+            self.assertEqual(filemeta.get(path)["size"], MirrorHandler.size)
+        self.assertIsNone(filemeta.cached("ISOs/Drauger%20OS%207.7.iso"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_health.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the mirror health checker, against local stub mirrors
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "benchmarks"))
+import health
+from stubs import MirrorHandler, StubServer, dead_url
+
+TIMEOUT = 0.5
+
+
+class CheckAllTest(unittest.TestCase):
+    """check_all() against a healthy, a slow and a dead mirror"""
+    @classmethod
+    def setUpClass(cls):
+        # the probes count requests in metrics.bin, which goes wherever we are
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+        cls.healthy = StubServer(MirrorHandler).__enter__()
+        # answers, but well after the timeout
+        cls.slow = StubServer(MirrorHandler, latency=TIMEOUT * 4).__enter__()
+        cls.dead = dead_url()
+        cls.urls = [cls.healthy.url, cls.slow.url, cls.dead]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.healthy.__exit__()
+        cls.slow.__exit__()
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def test_up_and_down(self):
+        table = health.check_all(self.urls, timeout=TIMEOUT)
+        mirrors = table["mirrors"]
+        self.assertTrue(mirrors[self.healthy.url]["up"])
+        self.assertIsNotNone(mirrors[self.healthy.url]["latency"])
+        self.assertEqual(mirrors[self.healthy.url]["last_seen"], table["checked"])
+        for url in (self.slow.url, self.dead):
+            self.assertFalse(mirrors[url]["up"])
+            self.assertIsNone(mirrors[url]["latency"])
+            self.assertIsNone(mirrors[url]["last_seen"])
+            self.assertEqual(mirrors[url]["failures"], 1)
+
+    def test_failures_add_up(self):
+        table = health.check_all(self.urls, timeout=TIMEOUT)
+        table = health.check_all(self.urls, previous=table, timeout=TIMEOUT)
+        self.assertEqual(table["mirrors"][self.healthy.url]["failures"], 0)
+        self.assertEqual(table["mirrors"][self.slow.url]["failures"], 2)
+        self.assertEqual(table["mirrors"][self.dead]["failures"], 2)
+
+    def test_recovery_resets_failures(self):
+        previous = {"generation": 5, "mirrors": {
+            url: {"up": False, "last_seen": 1.0, "failures": 3} for url in self.urls}}
+        table = health.check_all(self.urls, previous=previous, timeout=TIMEOUT)
+        self.assertEqual(table["mirrors"][self.healthy.url]["failures"], 0)
+        self.assertEqual(table["mirrors"][self.dead]["failures"], 4)
+        # down mirrors remember when they were last up
+        self.assertEqual(table["mirrors"][self.dead]["last_seen"], 1.0)
+
+    def test_generation(self):
+        table = health.check_all(self.urls, timeout=TIMEOUT)
+        # the list of mirrors changed from nothing
+        self.assertEqual(table["generation"], 1)
+        table = health.check_all(self.urls, previous=table, timeout=TIMEOUT)
+        self.assertEqual(table["generation"], 1)
+        # a mirror going down
+        table["mirrors"][self.dead]["up"] = True
+        table = health.check_all(self.urls, previous=table, timeout=TIMEOUT)
+        self.assertEqual(table["generation"], 2)
+        # a mirror coming back
+        table["mirrors"][self.healthy.url]["up"] = False
+        table = health.check_all(self.urls, previous=table, timeout=TIMEOUT)
+        self.assertEqual(table["generation"], 3)
+        # a mirror leaving the list
+        table = health.check_all(self.urls[:2], previous=table, timeout=TIMEOUT)
+        self.assertEqual(table["generation"], 4)
+
+    def test_timeout_bound(self):
+        # every mirror is probed at once, and a timeout ends a probe
+        start = time.monotonic()
+        health.check_all(self.urls * 4, timeout=TIMEOUT)
+        self.assertLess(time.monotonic() - start, TIMEOUT * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
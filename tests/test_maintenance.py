@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_maintenance.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the maintenance service's download count upkeep
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import common
+import eventlog
+import maintenance
+
+
+class MaintenanceTest(unittest.TestCase):
+    """Run in a temporary directory, where the count files go"""
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+
+class DedupEntriesTest(MaintenanceTest):
+    """dedup_entries()"""
+    def write(self, lines):
+        with open("counts.txt", "w") as file:
+            file.write("\n".join(lines))
+
+    def read(self):
+        with open("counts.txt", "r") as file:
+            return file.read().split("\n")
+
+    def test_merges_in_order(self):
+        self.write(["January 01 2023 - 5 - 1.000",
+                    "January 02 2023 - 7",
+                    "January 01 2023 - 3 - 0.500",
+                    "January 03 2023 - 1 - 0.250",
+                    "January 02 2023 - 2 - 0.125"])
+        maintenance.dedup_entries("counts.txt")
+        self.assertEqual(self.read(), ["January 01 2023 - 8 - 1.500",
+                                       "January 02 2023 - 9 - 0.125",
+                                       "January 03 2023 - 1 - 0.250"])
+
+    def test_leaves_clean_file(self):
+        self.write(["January 01 2023 - 5 - 1.000", "January 02 2023 - 7 - 2.000"])
+        before = os.stat("counts.txt").st_mtime_ns
+        maintenance.dedup_entries("counts.txt")
+        self.assertEqual(os.stat("counts.txt").st_mtime_ns, before)
+
+    def test_missing_file(self):
+        maintenance.dedup_entries("counts.txt")
+        self.assertFalse(os.path.exists("counts.txt"))
+
+
+class SeedTodayTest(MaintenanceTest):
+    """Today's count from before the event log survives the first compaction"""
+    def setUp(self):
+        super().setUp()
+        self.today = eventlog.day_key(time.time())
+        with open(common.CURRENT_COUNT_FILE, "w") as file:
+            file.write("120,3.5")
+
+    def test_carried_over(self):
+        maintenance.__seed_today__()
+        eventlog.log("ISOs/Drauger_OS-7.7.iso", 1073741824, "https://mirror.example/", "US")
+        eventlog.flush(seal=True)
+        day = eventlog.compact()["days"][self.today]
+        self.assertEqual((day["downloads"], day["bytes"]), (121, round(4.5 * 1073741824)))
+        # and only the first time
+        maintenance.__seed_today__()
+        self.assertEqual(eventlog.compact()["days"][self.today]["downloads"], 121)
+
+    def test_not_from_another_day(self):
+        stale = time.time() - 86400 * 2
+        os.utime(common.CURRENT_COUNT_FILE, (stale, stale))
+        maintenance.__seed_today__()
+        self.assertNotIn(self.today, eventlog.compact()["days"])
+
+
+if __name__ == "__main__":
+    unittest.main()
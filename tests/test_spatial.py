@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_spatial.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the k-d tree, against checking every mirror
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mirrors
+import spatial
+
+CLIENTS = 200
+
+
+def brute_force(vectors, vector, k, accept=None):
+    """(chord distance, index) of the `k` closest accepted points, by checking every one"""
+    x, y, z = vector
+    # the same sum the tree does, so equal distances come out exactly equal
+    ranked = sorted((math.sqrt(((point[0] - x) ** 2) + ((point[1] - y) ** 2) +
+                               ((point[2] - z) ** 2)), index)
+                    for index, point in enumerate(vectors) if accept is None or accept(index))
+    return ranked[:k]
+
+
+def random_points(count):
+    """`count` random (lat, lon) pairs"""
+    return [(random.uniform(-90, 90), random.uniform(-180, 180)) for each in range(count)]
+
+
+class KDTreeTest(unittest.TestCase):
+    """KDTree.nearest() against brute force"""
+    def setUp(self):
+        random.seed(2)
+        self.clients = [spatial.to_vector(*each) for each in random_points(CLIENTS)]
+
+    def check(self, points, k, accept=None):
+        vectors = [spatial.to_vector(*each) for each in points]
+        tree = spatial.KDTree(vectors)
+        for client in self.clients:
+            self.assertEqual(tree.nearest(client, k, accept), brute_force(vectors, client, k, accept))
+
+    def test_matches_brute_force(self):
+        for size in (1, 10, 100, 1000):
+            for k in (1, 5):
+                with self.subTest(size=size, k=k):
+                    self.check(random_points(size), k)
+
+    def test_skips_unhealthy(self):
+        points = random_points(500)
+        down = set(random.sample(range(len(points)), len(points) // 3))
+        self.check(points, 5, lambda index: index not in down)
+        # nothing accepted, nothing found
+        self.check(points, 5, lambda index: False)
+
+    def test_ties(self):
+        # a few places with several mirrors each. Equally close ones come lowest index first
+        places = random_points(20)
+        points = [places[each % len(places)] for each in range(200)]
+        self.check(points, 7)
+        self.check(points, 7, lambda index: index % 3 != 0)
+
+    def test_more_than_there_are(self):
+        self.check(random_points(6), 10)
+
+
+class RegistryNearestTest(unittest.TestCase):
+    """MirrorRegistry.nearest(), which picks the tree or a scan by size"""
+    def setUp(self):
+        random.seed(3)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def registry(self, points):
+        path = os.path.join(self.tmp.name, f"servers-{ len(points) }.json")
+        with open(path, "w") as file:
+            json.dump({"x": [[f"https://mirror{ index }.example/", [f"{ lat:.4f}", f"{ lon:.4f}"]]
+                             for index, (lat, lon) in enumerate(points)]}, file)
+        registry = mirrors.MirrorRegistry(path)
+        registry.refresh()
+        return registry
+
+    def test_matches_brute_force(self):
+        for size in (mirrors.TREE_THRESHOLD // 2, mirrors.TREE_THRESHOLD * 8):
+            registry = self.registry(random_points(size))
+            down = {each.url for each in random.sample(registry.mirrors, size // 3)}
+
+            def healthy(url):
+                return url not in down
+
+            for lat, lon in random_points(50):
+                loc = [f"{ lat:.4f}", f"{ lon:.4f}"]
+                want = sorted((distance, index, mirror.url) for index, (distance, mirror)
+                              in enumerate(registry.distances(loc)) if healthy(mirror.url))[:5]
+                got = registry.nearest(loc, 5, healthy)
+                with self.subTest(size=size, loc=loc):
+                    self.assertFalse(down & set(got))
+                    if got != [each[2] for each in want]:
+                        # only a tie, to within rounding, may come out either way
+                        distances = dict((mirror.url, distance)
+                                         for distance, mirror in registry.distances(loc))
+                        for have, expected in zip(got, want):
+                            self.assertAlmostEqual(distances[have], expected[0], places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_upstream.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the upstream circuit breakers, against a local stub that rate limits
+
+Run from the repository's root with: python3 -m unittest discover tests
+"""
+import email.utils
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "benchmarks"))
+import cache
+import geoip
+import upstream
+from stubs import IPInfoHandler, StubServer
+
+
+class RateLimitedHandler(IPInfoHandler):
+    """ipinfo.io, once it has had enough of us"""
+    retry_after = None
+
+    def do_GET(self):
+        self.send_response(429)
+        if self.retry_after is not None:
+            self.send_header("Retry-After", self.retry_after)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class UpstreamTest(unittest.TestCase):
+    """Every stub is on 127.0.0.1, so they share one breaker. Start each test with none"""
+    def setUp(self):
+        # metrics.bin goes wherever we are
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        upstream.get_manager()
+        upstream.BREAKERS.clear()
+
+    def tearDown(self):
+        upstream.BREAKERS.clear()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+
+class RetryAfterTest(unittest.TestCase):
+    """retry_after()"""
+    def test_seconds(self):
+        self.assertEqual(upstream.retry_after("5", 600), 5)
+
+    def test_date(self):
+        value = email.utils.formatdate(time.time() + 100, usegmt=True)
+        self.assertAlmostEqual(upstream.retry_after(value, 600), 100, delta=2)
+
+    def test_capped(self):
+        self.assertEqual(upstream.retry_after("86400", 600), 600)
+        self.assertEqual(upstream.retry_after("-5", 600), 0)
+
+    def test_unusable(self):
+        self.assertIsNone(upstream.retry_after(None, 600))
+        self.assertIsNone(upstream.retry_after("soon", 600))
+
+
+class BreakerTest(UpstreamTest):
+    """request() against a stub answering 429"""
+    def test_opens_for_retry_after(self):
+        with StubServer(RateLimitedHandler, retry_after="1") as stub:
+            self.assertEqual(upstream.request("GET", stub.url).status, 429)
+            # straight away, not after "failures" of them
+            with self.assertRaises(upstream.CircuitOpen):
+                upstream.request("GET", stub.url)
+        breaker = upstream.BREAKERS["127.0.0.1"]
+        self.assertEqual((breaker.errors, breaker.rejected, breaker.trips), (1, 1, 1))
+        # let through again after the second it asked for, not the 30s cooldown
+        time.sleep(1.1)
+        with StubServer(IPInfoHandler) as stub:
+            self.assertEqual(upstream.request("GET", stub.url).status, 200)
+        self.assertIsNone(breaker.opened)
+
+    def test_counts_as_failure(self):
+        with StubServer(RateLimitedHandler) as stub:
+            for each in range(upstream.DEFAULTS["failures"] - 1):
+                upstream.request("GET", stub.url)
+            breaker = upstream.BREAKERS["127.0.0.1"]
+            self.assertIsNone(breaker.opened)
+            upstream.request("GET", stub.url)
+            self.assertIsNotNone(breaker.opened)
+            self.assertEqual(breaker.errors, upstream.DEFAULTS["failures"])
+
+
+class GeoIPTest(UpstreamTest):
+    """Lookups ipinfo.io rate limited aren't cached"""
+    def setUp(self):
+        super().setUp()
+        self.cache = mock.patch.object(geoip, "CACHE", cache.SharedCache("geoip_cache.sqlite3"))
+        self.cache.start()
+
+    def tearDown(self):
+        self.cache.stop()
+        super().tearDown()
+
+    def locate(self, url):
+        with mock.patch.object(geoip, "IPINFO", [url, "/json"]):
+            data = geoip.GeoLocator([geoip.IPInfoBackend()]).locate("8.8.8.8")
+        geoip.store("8.8.8.8", data)
+        return data
+
+    def test_not_cached(self):
+        with StubServer(RateLimitedHandler, retry_after="60") as stub:
+            self.assertTrue(self.locate(stub.url)["unavailable"])
+            self.assertIsNone(geoip.CACHE.get("8.8.8.8"))
+            # and while the circuit is open
+            self.assertTrue(self.locate(stub.url)["unavailable"])
+            self.assertIsNone(geoip.CACHE.get("8.8.8.8"))
+
+    def test_answer_cached(self):
+        with StubServer(IPInfoHandler) as stub:
+            self.assertEqual(self.locate(stub.url)["country"], "US")
+        self.assertEqual(geoip.CACHE.get("8.8.8.8")["country"], "US")
+
+
+if __name__ == "__main__":
+    unittest.main()
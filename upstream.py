@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  upstream.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Outbound HTTP
+
+Every request this app makes to ipinfo.io or a mirror goes through here.
+There is one connection pool per process, keeping connections alive per
+host, and every host gets its own timeouts, retry budget and circuit
+breaker, so one slow or dead upstream can't pin a worker.
+
+Per-host settings go under "upstreams" in settings.json, keyed by host
+name, with "default" used for anything not listed:
+
+    "upstreams": {"default": {"connect": 1.0, "read": 5.0, "retries": 1},
+                  "ipinfo.io": {"read": 2.0, "failures": 3, "cooldown": 60}}
+
+A 429 counts as a failure. If it comes with a Retry-After header, the
+breaker opens straight away for that long, up to "max_retry_after" seconds.
+"""
+import email.utils
+import os
+import threading
+import time
+import urllib.parse
+import urllib3
+import common
+import metrics
+
+DEFAULTS = {"connect": 1.0, "read": 5.0, "retries": 1,
+            # consecutive failures before the breaker opens, and for how long
+            "failures": 5, "cooldown": 30,
+            # longest a Retry-After header can keep the breaker open for
+            "max_retry_after": 600}
+MANAGER = None
+PID = None
+BREAKERS = {}
+LOCK = threading.Lock()
+
+
+class CircuitOpen(urllib3.exceptions.HTTPError):
+    """Raised instead of making a request to an upstream that keeps failing"""
+
+
+class Breaker:
+    """Circuit breaker for one upstream host"""
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened = None
+        # how long it stays open, if the upstream told us
+        self.wait = None
+        self.trips = 0
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def allow(self, cooldown):
+        """Whether a request may go ahead
+
+        Once the cooldown has passed, requests are let through again. The
+        first success closes the breaker, the first failure re-opens it.
+        """
+        if self.opened is None:
+            return True
+        if time.monotonic() - self.opened >= (cooldown if self.wait is None else self.wait):
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        """Record a request that got a response"""
+        self.requests += 1
+        self.failures = 0
+        if self.opened is not None:
+            print(f"Upstream { self.host } is back. Closing circuit...")
+            self.opened = None
+            self.wait = None
+
+    def failure(self, limit, retry_after=None):
+        """Record a request that failed, opening the breaker if needed
+
+        With `retry_after`, the upstream asked us to back off for that many
+        seconds, so the breaker opens for that long whatever the count.
+        """
+        self.requests += 1
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= limit or retry_after is not None:
+            if self.opened is None:
+                if retry_after is None:
+                    reason = f"failed { self.failures } times"
+                else:
+                    reason = f"asked us to wait { retry_after:.0f}s"
+                print(f"WARNING: Upstream { self.host } { reason }. Opening circuit...")
+                self.trips += 1
+            self.opened = time.monotonic()
+            self.wait = retry_after
+
+
+def failed(status):
+    """Whether a response status means the upstream is struggling"""
+    return status >= 500 or status == 429
+
+
+def retry_after(value, limit):
+    """Seconds a Retry-After header value asks us to wait, up to `limit`, or None"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), limit)
+
+
+def get_manager():
+    """Get this process's pool manager. Pools can't be shared across a fork"""
+    global MANAGER, PID
+    if PID != os.getpid():
+        with LOCK:
+            if PID != os.getpid():
+                MANAGER = urllib3.PoolManager(num_pools=64, maxsize=8, block=False)
+                BREAKERS.clear()
+                PID = os.getpid()
+    return MANAGER
+
+
+def get_config(host):
+    """Get the settings for an upstream host"""
+    config = dict(DEFAULTS)
+    upstreams = common.get_setting("upstreams", {})
+    config.update(upstreams.get("default", {}))
+    config.update(upstreams.get(host, {}))
+    return config
+
+
+def get_breaker(host):
+    """Get the circuit breaker for an upstream host"""
+    breaker = BREAKERS.get(host)
+    if breaker is None:
+        with LOCK:
+            breaker = BREAKERS.setdefault(host, Breaker(host))
+    return breaker
+
+
+def request(method, url, timeout=None, retries=None, breaker=True, **kwargs):
+    """Make an HTTP request to an upstream
+
+    `timeout` (seconds, for both connect and read) and `retries` override the
+    host's settings. With `breaker` off the request is made even if the
+    host's circuit is open, which the health checker needs to notice that a
+    mirror came back. Raises CircuitOpen, or any urllib3 HTTPError.
+    """
+    manager = get_manager()
+    host = urllib.parse.urlsplit(url).hostname
+    config = get_config(host)
+    circuit = get_breaker(host)
+    if breaker and not circuit.allow(config["cooldown"]):
+        metrics.count_upstream(host, rejected=1)
+        raise CircuitOpen(f"circuit open for { host }")
+    if timeout is None:
+        timeout = urllib3.Timeout(connect=config["connect"], read=config["read"])
+    else:
+        timeout = urllib3.Timeout(connect=timeout, read=timeout)
+    if retries is None:
+        # the breaker backs off for a Retry-After, rather than this worker sleeping through it
+        retries = urllib3.Retry(total=config["retries"], redirect=0, raise_on_redirect=False,
+                                respect_retry_after_header=False)
+    try:
+        response = manager.request(method, url, timeout=timeout, retries=retries, **kwargs)
+    except urllib3.exceptions.HTTPError:
+        circuit.failure(config["failures"])
+        metrics.count_upstream(host, requests=1, errors=1)
+        raise
+    if response.status == 429:
+        circuit.failure(config["failures"], retry_after(response.headers.get("Retry-After"),
+                                                        config["max_retry_after"]))
+    elif failed(response.status):
+        circuit.failure(config["failures"])
+    else:
+        circuit.success()
+    metrics.count_upstream(host, requests=1, errors=int(failed(response.status)))
+    return response
+
+
+def stats():
+    """Request, error and connection reuse counts per upstream, for this process"""
+    manager = get_manager()
+    output = {}
+    for host, breaker in list(BREAKERS.items()):
+        output[host] = {"requests": breaker.requests, "errors": breaker.errors,
+                        "rejected": breaker.rejected, "trips": breaker.trips,
+                        "open": breaker.opened is not None,
+                        "connections": 0, "reused": 0}
+    for key in manager.pools.keys():
+        pool = manager.pools.get(key)
+        if pool is None or pool.host not in output:
+            continue
+        # each request that didn't need a new connection reused one
+        output[pool.host]["connections"] += pool.num_connections
+        output[pool.host]["reused"] += max(0, pool.num_requests - pool.num_connections)
+    return output
@@ -22,7 +22,9 @@
 #
 #
 """WSGI Loader"""
-from download import APP
+from download import create_app
+
+APP = create_app()
 
 if __name__ == "__main__":
     APP.run()